@@ -113,6 +113,10 @@ _pkg_install_script = rule(
         # This is private for now -- one could perhaps imagine making this
         # public, but that would require more documentation of the underlying
         # scripts and expected interfaces.
+        "_manifest_format": attr.label(
+            default = Label("//pkg:manifest_format"),
+            providers = [BuildSettingInfo],
+        ),
         "_script_template": attr.label(
             allow_single_file = True,
             default = "//pkg/private:install.py.tpl",
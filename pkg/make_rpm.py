@@ -25,12 +25,12 @@ import pprint
 import re
 import shutil
 import subprocess
-import sys
 import tempfile
 from string import Template
 
 from pkg.private import build_info
 from pkg.private import helpers
+from pkg.private import persistent_worker
 
 
 # Setup to safely create a temporary directory and clean it up when done.
@@ -636,6 +636,8 @@ def main(argv):
 
 
 if __name__ == '__main__':
-  sys.exit(main(sys.argv[1:]))
+  # RpmBuilder changes the working directory while it runs, so requests
+  # must not overlap.
+  persistent_worker.main_or_worker(main, multiplex=False)
 
 # vim: ts=2:sw=2:
@@ -14,6 +14,7 @@
 """Archive reader library for the .deb file testing."""
 
 import io
+import mmap
 import os
 
 class SimpleArReader(object):
@@ -30,6 +31,14 @@ class SimpleArReader(object):
       print('This archive contains', nextFile.filename)
       nextFile = ar.next()
 
+  Members can also be looked up by name. The first lookup builds an index of
+  the member headers, seeking over their content:
+
+  with SimpleArReader(filename) as ar:
+    control = ar.read('control.tar.gz')
+    with ar.open('data.tar.xz') as data:
+      ...
+
   Upon error, this class will raise a ArError exception.
   """
 
@@ -46,10 +55,12 @@ class SimpleArReader(object):
       group_id: numeric id of the user and group owning the file.
       mode: unix permission mode of the file
       size: size of the file
-      data: the content of the file.
+      offset: position of the content of the file in the archive.
+      data: the content of the file, read on first access.
     """
 
     def __init__(self, f):
+      self._f = f
       self.filename = f.read(16).decode('utf-8').strip()
       if self.filename.endswith('/'):  # SysV variant
         self.filename = self.filename[:-1]
@@ -61,29 +72,137 @@ class SimpleArReader(object):
       pad = f.read(2)
       if pad != b'\x60\x0a':
         raise SimpleArReader.ArError('Invalid AR file header')
-      self.data = f.read(self.size)
+      self.offset = f.tell()
+      self._data = None
+
+    @property
+    def data(self):
+      if self._data is None:
+        self._f.seek(self.offset)
+        self._data = self._f.read(self.size)
+      return self._data
+
+    def open(self):
+      """Returns a file object reading the content of the file in place."""
+      return SimpleArReader.ArMemberFile(self._f, self.offset, self.size)
+
+  class ArMemberFile(io.RawIOBase):
+    """Read only file object bounded to a byte range of the archive.
+
+    Several views may share the archive file, each one seeks it to its own
+    position before reading.
+    """
+
+    def __init__(self, f, offset, size):
+      super(SimpleArReader.ArMemberFile, self).__init__()
+      self._f = f
+      self._offset = offset
+      self._size = size
+      self._pos = 0
+
+    def readable(self):
+      return True
+
+    def seekable(self):
+      return True
+
+    def tell(self):
+      return self._pos
+
+    def seek(self, pos, whence=io.SEEK_SET):
+      if whence == io.SEEK_CUR:
+        pos += self._pos
+      elif whence == io.SEEK_END:
+        pos += self._size
+      if pos < 0:
+        raise ValueError('negative seek position %d' % pos)
+      self._pos = pos
+      return self._pos
+
+    def readinto(self, b):
+      size = min(len(b), self._size - self._pos)
+      if size <= 0:
+        return 0
+      self._f.seek(self._offset + self._pos)
+      with memoryview(b) as view:
+        size = self._f.readinto(view[:size])
+      self._pos += size
+      return size
 
   MAGIC_STRING = b'!<arch>\n'
 
   def __init__(self, filename):
     self.filename = filename
+    self._index = None
+    self._by_name = {}
+    self._mmap = None
 
   def __enter__(self):
     self.f = open(self.filename, 'rb')
     if self.f.read(len(self.MAGIC_STRING)) != self.MAGIC_STRING:
       raise self.ArError('Not a ar file: ' + self.filename)
+    self._next_offset = self.f.tell()
     return self
 
   def __exit__(self, t, v, traceback):
+    if self._mmap is not None:
+      self._mmap.close()
+      self._mmap = None
     self.f.close()
 
-  def next(self):
-    """Read the next file. Returns None when reaching the end of file."""
+  def _read_entry(self, offset):
+    """Reads the header of the entry at or after `offset`, or returns None."""
     # AR sections are two bit aligned using new lines.
-    if self.f.tell() % 2 != 0:
-      self.f.read(1)
+    offset += offset % 2
     # An AR sections is at least 60 bytes. Some file might contains garbage
     # bytes at the end of the archive, ignore them.
-    if self.f.tell() > os.fstat(self.f.fileno()).st_size - 60:
+    if offset > os.fstat(self.f.fileno()).st_size - 60:
       return None
+    self.f.seek(offset)
     return self.SimpleArFileEntry(self.f)
+
+  def next(self):
+    """Read the next file. Returns None when reaching the end of file.
+
+    The content of the file is not read, see SimpleArFileEntry.data and
+    SimpleArFileEntry.open().
+    """
+    entry = self._read_entry(self._next_offset)
+    if entry:
+      self._next_offset = entry.offset + entry.size
+    return entry
+
+  def members(self):
+    """Returns the entries of the archive, in order."""
+    if self._index is None:
+      self._index = []
+      entry = self._read_entry(len(self.MAGIC_STRING))
+      while entry:
+        self._index.append(entry)
+        self._by_name.setdefault(entry.filename, entry)
+        entry = self._read_entry(entry.offset + entry.size)
+    return self._index
+
+  def getmember(self, name):
+    """Returns the first entry called `name`.
+
+    Raises:
+      ArError: if there is no such entry.
+    """
+    self.members()
+    if name in self._by_name:
+      return self._by_name[name]
+    raise self.ArError('No member %s in %s' % (name, self.filename))
+
+  def open(self, name):
+    """Returns a seekable file object reading the content of entry `name`."""
+    return self.getmember(name).open()
+
+  def read(self, name):
+    """Returns the content of entry `name`, read through a memory map."""
+    entry = self.getmember(name)
+    if not entry.size:
+      return b''
+    if self._mmap is None:
+      self._mmap = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+    return self._mmap[entry.offset:entry.offset + entry.size]
@@ -13,11 +13,20 @@
 # limitations under the License.
 """Rule for creating Debian packages."""
 
+load("@bazel_skylib//rules:common_settings.bzl", "BuildSettingInfo")
 load("//pkg:providers.bzl", "PackageVariablesInfo")
+load(
+    "//pkg/private:pkg_files.bzl",
+    "add_label_list",
+    "create_mapping_context_from_ctx",
+    "write_manifest",
+)
 load("//pkg/private:util.bzl", "setup_output_files", "substitute_package_variables")
 
 _tar_filetype = [".tar", ".tar.gz", ".tgz", ".tar.bz2", "tar.xz", "tar.zst"]
 
+_ZSTD_TOOLCHAIN_TYPE = "@rules_pkg//toolchains/zstd:zstd_toolchain_type"
+
 def _pkg_deb_impl(ctx):
     """The implementation for the pkg_deb rule."""
 
@@ -40,11 +49,44 @@ def _pkg_deb_impl(ctx):
 
     package = substitute_package_variables(ctx, ctx.attr.package)
 
-    files = [ctx.file.data]
+    files = []
+    transitive_files = []
+    tools = []
     args = ctx.actions.args()
     args.add("--output", output_file)
     args.add("--changes", changes_file)
-    args.add("--data", ctx.file.data)
+    if ctx.attr.data and ctx.attr.srcs:
+        fail("Both data and srcs attributes were specified")
+    if ctx.attr.data:
+        files.append(ctx.file.data)
+        args.add("--data", ctx.file.data)
+    elif ctx.attr.srcs:
+        # Build the data tarball inside the deb rather than in a pkg_tar.
+        mapping_context = create_mapping_context_from_ctx(
+            ctx,
+            label = ctx.label,
+            default_mode = None,
+        )
+        add_label_list(mapping_context, srcs = ctx.attr.srcs)
+        manifest_file = ctx.actions.declare_file(ctx.label.name + ".manifest")
+        write_manifest(ctx, manifest_file, mapping_context.content_map)
+        files.append(manifest_file)
+        files.extend(mapping_context.file_deps_direct)
+        transitive_files.extend(mapping_context.file_deps_transitive)
+        args.add("--manifest", manifest_file)
+        args.add("--data_compression", ctx.attr.data_compression)
+        args.add("--data_mode", ctx.attr.data_mode)
+        if ctx.attr.data_compression == "zst":
+            zstd_toolchain = ctx.toolchains[_ZSTD_TOOLCHAIN_TYPE]
+            if zstd_toolchain and zstd_toolchain.zstd.valid:
+                if zstd_toolchain.zstd.path:
+                    args.add("--data_zstd", zstd_toolchain.zstd.path)
+                else:
+                    zstd_binary = zstd_toolchain.zstd.label[DefaultInfo].files_to_run
+                    args.add("--data_zstd", zstd_binary.executable.path)
+                    tools.append(zstd_binary)
+    else:
+        fail("One of the data or srcs attributes must be specified")
     args.add("--package", package)
     args.add("--maintainer", substitute_package_variables(ctx, ctx.attr.maintainer))
 
@@ -80,6 +122,12 @@ def _pkg_deb_impl(ctx):
     if ctx.attr.md5sums:
         args.add("--md5sums", "@" + ctx.file.md5sums.path)
         files.append(ctx.file.md5sums)
+    elif (ctx.attr.data and OutputGroupInfo in ctx.attr.data and
+          hasattr(ctx.attr.data[OutputGroupInfo], "member_digests")):
+        # Digests recorded by pkg_tar(member_digests = True).
+        member_digests = ctx.attr.data[OutputGroupInfo].member_digests.to_list()
+        args.add("--member_digests", member_digests[0])
+        files.extend(member_digests)
 
     # Conffiles can be specified by a file or a string list
     if ctx.attr.conffiles_file:
@@ -184,7 +232,8 @@ def _pkg_deb_impl(ctx):
         mnemonic = "MakeDeb",
         executable = ctx.executable._make_deb,
         arguments = [args],
-        inputs = files,
+        inputs = depset(direct = files, transitive = transitive_files),
+        tools = tools,
         outputs = [output_file, changes_file],
         env = {
             "LANG": "en_US.UTF-8",
@@ -192,6 +241,11 @@ def _pkg_deb_impl(ctx):
             "PYTHONIOENCODING": "UTF-8",
             "PYTHONUTF8": "1",
         },
+        execution_requirements = {
+            "requires-worker-protocol": "json",
+            "supports-multiplex-workers": "1",
+            "supports-workers": "1",
+        },
     )
     output_groups = {
         "out": [ctx.outputs.out],
@@ -224,10 +278,33 @@ pkg_deb_impl = rule(
     attrs = {
         # @unsorted-dict-items
         "data": attr.label(
-            doc = """A tar file that contains the data for the debian package.""",
-            mandatory = True,
+            doc = """A tar file that contains the data for the debian package.
+            Either this or `srcs` must be specified.""",
             allow_single_file = _tar_filetype,
         ),
+        "srcs": attr.label_list(
+            doc = """Inputs which will become part of the data of the debian
+            package, as for the `srcs` of pkg_tar. The data tarball is then
+            written directly into the package, without a separate pkg_tar
+            action. It is the same as that of a pkg_tar of `srcs` with the
+            default attributes, `data_mode` and `data_compression`. Must not
+            be used with `data`.""",
+            allow_files = True,
+        ),
+        "data_compression": attr.string(
+            doc = """Compression of the data tarball built from `srcs`.
+
+            `zst` uses the zstd binary from the optional
+            `@rules_pkg//toolchains/zstd:zstd_toolchain_type` toolchain, as
+            pkg_tar does.""",
+            default = "gz",
+            values = ["", "gz", "bz2", "xz", "zst"],
+        ),
+        "data_mode": attr.string(
+            doc = """Mode of the files built from `srcs` which do not set one,
+            as for the `mode` of pkg_tar.""",
+            default = "0555",
+        ),
         "package": attr.string(
             doc = "The name of the package",
             mandatory = True,
@@ -310,7 +387,10 @@ pkg_deb_impl = rule(
         ),
         "md5sums": attr.label(
             doc = """A file listing md5 checksums of files in the data archive.
-            This file is optional.
+            This file is optional. If it is not set and `data` is a pkg_tar
+            with `member_digests = True`, it is generated from the digests
+            recorded by that pkg_tar. With `srcs`, it is generated from the
+            files of `srcs`.
             See https://manpages.debian.org/bookworm/dpkg-dev/deb-md5sums.5.en.html.
             """,
             allow_single_file = True,
@@ -409,6 +489,10 @@ See https://www.debian.org/doc/debian-policy/ch-files.html#s-config-files.""",
         ),
 
         # Implicit dependencies.
+        "_manifest_format": attr.label(
+            default = Label("//pkg:manifest_format"),
+            providers = [BuildSettingInfo],
+        ),
         "_make_deb": attr.label(
             default = Label("//pkg/private/deb:make_deb"),
             cfg = "exec",
@@ -416,6 +500,9 @@ See https://www.debian.org/doc/debian-policy/ch-files.html#s-config-files.""",
             allow_files = True,
         ),
     },
+    toolchains = [
+        config_common.toolchain_type(_ZSTD_TOOLCHAIN_TYPE, mandatory = False),
+    ],
 )
 
 def pkg_deb(name, out = None, **kwargs):
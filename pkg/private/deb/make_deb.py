@@ -29,7 +29,11 @@ if sys.version_info < (3, 7):
 else:
   OrderedDict = dict
 
+from pkg.private import digests
 from pkg.private import helpers
+from pkg.private import manifest
+from pkg.private import persistent_worker
+from pkg.private.tar import build_tar
 
 Multiline = Enum('Multiline', ['NO', 'YES', 'YES_ADD_NEWLINE'])
 
@@ -67,6 +71,26 @@ DEBIAN_FIELDS = [
 # to tune it.
 _COPY_CHUNK_SIZE = 1024 * 32
 
+# Offset and width of the size field in an AR file entry header.
+_AR_SIZE_OFFSET = 48
+_AR_SIZE_WIDTH = 10
+
+# Checksums listed in the .changes file.
+_CHANGES_HASH_FNS = {
+    'md5': hashlib.md5,
+    'sha1': hashlib.sha1,
+    'sha256': hashlib.sha256,
+}
+
+# Extension of the data member for each --data_compression.
+DATA_COMPRESSIONS = {
+    '': 'tar',
+    'gz': 'tar.gz',
+    'bz2': 'tar.bz2',
+    'xz': 'tar.xz',
+    'zst': 'tar.zst',
+}
+
 
 def AddControlFlags(parser):
   """Creates a flag for each of the control file fields."""
@@ -86,6 +110,82 @@ def AddControlFlags(parser):
       parser.add_argument(flag_name, required=required, help=msg)
 
 
+class HashingWriter(object):
+  """Write-through file object which digests the bytes written to it.
+
+  The digests cover the output as long as it is written sequentially from
+  the start. Writing anywhere else, e.g. to patch a header, makes them
+  unavailable, unless a checkpoint() was taken before: the output after
+  the checkpoint is then read back once to finish the digests.
+  """
+
+  def __init__(self, fileobj, hash_fns):
+    self._fileobj = fileobj
+    self._hashes = {k: fn() for (k, fn) in hash_fns.items()}
+    self._pos = fileobj.tell()
+    self._hashed = 0 if self._pos == 0 else None
+    self._checkpoint = None
+
+  def checkpoint(self):
+    """Keeps the digests of the output so far, see digests()."""
+    if self._hashed is not None and self._hashed == self._pos:
+      self._checkpoint = (
+          self._pos, {k: fn.copy() for (k, fn) in self._hashes.items()})
+
+  def write(self, data):
+    size = self._fileobj.write(data)
+    if self._hashed is not None:
+      if self._pos == self._hashed:
+        for hashfn in self._hashes.values():
+          hashfn.update(data)
+        self._hashed += size
+      else:
+        self._hashed = None
+    self._pos += size
+    return size
+
+  def seek(self, offset, whence=io.SEEK_SET):
+    self._pos = self._fileobj.seek(offset, whence)
+    return self._pos
+
+  def tell(self):
+    return self._pos
+
+  def flush(self):
+    self._fileobj.flush()
+
+  def digests(self):
+    """Returns {name: hexdigest} of the output, or None.
+
+    If the output was not written sequentially, it is read back from the
+    last checkpoint(), which needs a file object open for reading too. None
+    if there is no checkpoint or the file object cannot be read.
+    """
+    if self._hashed is not None and self._hashed == self._pos:
+      return {k: fn.hexdigest() for (k, fn) in self._hashes.items()}
+    if self._checkpoint is None:
+      return None
+    offset, hashes = self._checkpoint
+    end = self._pos
+    self._fileobj.flush()
+    self._fileobj.seek(offset)
+    try:
+      # Resume from copies of the hash objects, so that digests() can be
+      # called again.
+      with digests.ParallelDigester(
+          {k: fn.copy for (k, fn) in hashes.items()}) as digester:
+        while True:
+          buf = self._fileobj.read(digests.DEFAULT_BUFFER_SIZE)
+          if not buf:
+            break
+          digester.update(buf)
+        return digester.hexdigests()
+    except io.UnsupportedOperation:
+      return None
+    finally:
+      self._fileobj.seek(end)
+
+
 def ConvertToFileLike(content, content_len, converter):
   if content_len < 0:
     content_len = len(content)
@@ -93,24 +193,29 @@ def ConvertToFileLike(content, content_len, converter):
   return content_len, content
 
 
-def AddArFileEntry(fileobj, filename,
-                   content='', content_len=-1, timestamp=0,
-                   owner_id=0, group_id=0, mode=0o644):
-  """Add a AR file entry to fileobj."""
-  # If we got the content as a string, turn it into a file like thing.
-  if isinstance(content, (str, bytes)):
-    content_len, content = ConvertToFileLike(content, content_len, io.BytesIO)
+def _ArFileHeader(filename, content_len, timestamp, owner_id, group_id, mode):
+  """Returns the header of a AR file entry."""
   inputs = [
       (filename + '/').ljust(16),  # filename (SysV)
       str(timestamp).ljust(12),  # timestamp
       str(owner_id).ljust(6),  # owner id
       str(group_id).ljust(6),  # group id
       str(oct(mode)).replace('0o', '0').ljust(8),  # mode
-      str(content_len).ljust(10),  # size
+      str(content_len).ljust(_AR_SIZE_WIDTH),  # size
       '\x60\x0a',  # end of file entry
   ]
-  for i in inputs:
-    fileobj.write(i.encode('ascii'))
+  return ''.join(inputs).encode('ascii')
+
+
+def AddArFileEntry(fileobj, filename,
+                   content='', content_len=-1, timestamp=0,
+                   owner_id=0, group_id=0, mode=0o644):
+  """Add a AR file entry to fileobj."""
+  # If we got the content as a string, turn it into a file like thing.
+  if isinstance(content, (str, bytes)):
+    content_len, content = ConvertToFileLike(content, content_len, io.BytesIO)
+  fileobj.write(_ArFileHeader(filename, content_len, timestamp, owner_id,
+                              group_id, mode))
   size = 0
   while True:
     data = content.read(_COPY_CHUNK_SIZE)
@@ -122,6 +227,69 @@ def AddArFileEntry(fileobj, filename,
     fileobj.write(b'\n')  # 2-byte alignment padding
 
 
+def AddArFileEntryFromWriter(fileobj, filename, write_content, timestamp=0,
+                             owner_id=0, group_id=0, mode=0o644):
+  """Add a AR file entry whose content is written by write_content(fileobj).
+
+  The size is not known up front, so the header is written with a size of 0
+  and patched once the content is written. fileobj must be seekable.
+  """
+  header_offset = fileobj.tell()
+  fileobj.write(_ArFileHeader(filename, 0, timestamp, owner_id, group_id,
+                              mode))
+  start = fileobj.tell()
+  write_content(fileobj)
+  size = fileobj.seek(0, os.SEEK_END) - start
+  size_field = str(size).ljust(_AR_SIZE_WIDTH)
+  if len(size_field) > _AR_SIZE_WIDTH:
+    raise ValueError('%s is too large for an AR file entry (%d bytes)' % (
+        filename, size))
+  fileobj.seek(header_offset + _AR_SIZE_OFFSET)
+  fileobj.write(size_field.encode('ascii'))
+  fileobj.seek(0, os.SEEK_END)
+  if size % 2 != 0:
+    fileobj.write(b'\n')  # 2-byte alignment padding
+
+
+def WriteDataTar(fileobj, manifest_path, compression='gz',
+                 compression_level=-1, default_mode=None, default_mtime=None,
+                 zstd_path=None):
+  """Writes the data tarball for the entries of a manifest to fileobj.
+
+  The tarball is the one pkg_tar builds from the same manifest with its
+  default attributes, which include create_parents, and the same
+  compression, mode and mtime.
+
+  Args:
+    fileobj: seekable binary file to write to, from its current position.
+    manifest_path: manifest of the files to package, as written for pkg_tar.
+    compression: one of DATA_COMPRESSIONS.
+    compression_level: compression level, -1 for the default.
+    default_mode: mode for the entries which do not set one, as for pkg_tar.
+    default_mtime: mtime of the entries, an integer or 'portable'.
+    zstd_path: zstd tool for zst compression, instead of the zstandard
+        module.
+  """
+  def file_attributes(_):
+    return {'mode': default_mode, 'ids': (0, 0), 'names': ('', '')}
+
+  with build_tar.TarFile(
+      'data.' + DATA_COMPRESSIONS[compression],
+      directory='',
+      compression=compression,
+      compressor=None,
+      create_parents=True,
+      allow_dups_from_deps=False,
+      default_mtime=default_mtime,
+      compression_level=compression_level,
+      zstd_path=zstd_path,
+      preserve_mode=False,
+      preserve_mtime=False,
+      outfile=fileobj) as data:
+    for entry in manifest.iter_entries_from(manifest_path):
+      data.add_manifest_entry(entry, file_attributes)
+
+
 def MakeDebianControlField(name: str, value: str, multiline:Multiline=Multiline.NO) -> str:
   """Add a field to a debian control file.
 
@@ -157,6 +325,57 @@ def MakeDebianControlField(name: str, value: str, multiline:Multiline=Multiline.
   return result
 
 
+def Md5sumsFromMemberDigests(member_digests):
+  """Returns the md5sums control file for the digests recorded by build_tar.
+
+  Args:
+    member_digests: path of a build_tar --member_digests file, with one
+        "<md5> <sha256> <name>" line per file in the data tarball.
+  """
+  lines = []
+  with open(member_digests, 'r', encoding='utf-8') as f:
+    for line in f:
+      md5, _, name = line.rstrip('\n').split(' ', 2)
+      lines.append(_Md5sumsLine(md5, name))
+  return ''.join(lines)
+
+
+def _Md5sumsLine(md5, name):
+  # md5sums paths are relative to the root, without a leading ./
+  if name.startswith('./'):
+    name = name[2:]
+  return '%s  %s\n' % (md5, name.lstrip('/'))
+
+
+def Md5sumsFromManifest(manifest_path):
+  """Returns the md5sums control file for the data tarball of a manifest.
+
+  The md5sums member precedes the data member, so the files of the
+  manifest, and those of its tree artifacts, are digested ahead of writing
+  the data tarball.
+  """
+  lines = []
+
+  def add(name, path):
+    md5 = digests.file_digests(path, {'md5': hashlib.md5})['md5']
+    lines.append(_Md5sumsLine(md5, build_tar.normpath(name)))
+
+  for entry in manifest.iter_entries_from(manifest_path):
+    if entry.type == manifest.ENTRY_IS_FILE:
+      add(entry.dest, entry.src)
+    elif entry.type == manifest.ENTRY_IS_EMPTY_FILE:
+      lines.append(_Md5sumsLine(hashlib.md5().hexdigest(),
+                                build_tar.normpath(entry.dest)))
+    elif entry.type == manifest.ENTRY_IS_TREE:
+      for root, dirs, files in os.walk(entry.src):
+        dirs.sort()
+        rel_root = os.path.relpath(root, entry.src)
+        for name in sorted(files):
+          add(os.path.join(entry.dest, rel_root, name),
+              os.path.join(root, name))
+  return ''.join(lines)
+
+
 def CreateDebControl(extrafiles=None, **kwargs):
   """Create the control.tar.gz file."""
   # create the control file
@@ -204,8 +423,30 @@ def CreateDeb(output,
               md5sums=None,
               conffiles=None,
               changelog=None,
+              member_digests=None,
+              data_manifest=None,
+              data_compression='gz',
+              data_compression_level=-1,
+              data_mode=None,
+              data_mtime=None,
+              data_zstd_path=None,
               **kwargs):
-  """Create a full debian package."""
+  """Create a full debian package.
+
+  The data member is either copied from the `data` tarball or, if
+  `data_manifest` is set, written directly into the package from the files
+  of that manifest; see WriteDataTar() for the data_* arguments.
+
+  Without `md5sums`, the md5sums control file is generated from
+  `member_digests`, the digests build_tar recorded for `data`, if set, or
+  from the files of `data_manifest`.
+
+  Returns:
+    The checksums of the package for its .changes file as
+    {name: hexdigest}, computed while writing it. With `data_manifest`, the
+    data member is read back once to finish them, as its size is only
+    known, and written to its header, once the member is written.
+  """
   extrafiles = OrderedDict()
   if preinst:
     extrafiles['preinst'] = (preinst, 0o755)
@@ -221,6 +462,10 @@ def CreateDeb(output,
     extrafiles['templates'] = (templates, 0o644)
   if triggers:
     extrafiles['triggers'] = (triggers, 0o644)
+  if not md5sums and member_digests:
+    md5sums = Md5sumsFromMemberDigests(member_digests)
+  elif not md5sums and data_manifest:
+    md5sums = Md5sumsFromManifest(data_manifest)
   if md5sums:
     extrafiles['md5sums'] = (md5sums, 0o644)
   if conffiles:
@@ -230,10 +475,22 @@ def CreateDeb(output,
   control = CreateDebControl(extrafiles=extrafiles, **kwargs)
 
   # Write the final AR archive (the deb package)
-  with open(output, 'wb') as f:
+  # Opened for reading too, to finish the checksums with data_manifest.
+  with open(output, 'w+b') as out:
+    f = HashingWriter(out, _CHANGES_HASH_FNS)
     f.write(b'!<arch>\n')  # Magic AR header
     AddArFileEntry(f, 'debian-binary', b'2.0\n')
     AddArFileEntry(f, 'control.tar.gz', control)
+    if data_manifest:
+      f.checkpoint()
+      AddArFileEntryFromWriter(
+          f, 'data.' + DATA_COMPRESSIONS[data_compression],
+          lambda fileobj: WriteDataTar(
+              fileobj, data_manifest, compression=data_compression,
+              compression_level=data_compression_level,
+              default_mode=data_mode, default_mtime=data_mtime,
+              zstd_path=data_zstd_path))
+      return f.digests()
     # Tries to preserve the extension name
     ext = os.path.basename(data).split('.')[-2:]
     if len(ext) < 2:
@@ -249,32 +506,28 @@ def CreateDeb(output,
     data_size = os.stat(data).st_size
     with open(data, 'rb') as datafile:
       AddArFileEntry(f, 'data.' + ext, datafile, content_len=data_size)
+    return f.digests()
 
 
-def GetChecksumsFromFile(filename, hash_fns=None):
+def GetChecksumsFromFile(filename, hash_fns=None,
+                         buffer_size=digests.DEFAULT_BUFFER_SIZE):
   """Computes MD5 and/or other checksums of a file.
 
+  The checksums are computed on one thread each, see
+  digests.ParallelDigester.
+
   Args:
     filename: Name of the file.
     hash_fns: Mapping of hash functions.
               Default is {'md5': hashlib.md5}
+    buffer_size: Size of the buffers read from the file.
 
   Returns:
     Mapping of hash names to hexdigest strings.
     { <hashname>: <hexdigest>, ... }
   """
   hash_fns = hash_fns or {'md5': hashlib.md5}
-  checksums = {k: fn() for (k, fn) in hash_fns.items()}
-
-  with open(filename, 'rb') as file_handle:
-    while True:
-      buf = file_handle.read(1048576)  # 1 MiB
-      if not buf:
-        break
-      for hashfn in checksums.values():
-        hashfn.update(buf)
-
-  return {k: fn.hexdigest() for (k, fn) in checksums.items()}
+  return digests.file_digests(filename, hash_fns, buffer_size=buffer_size)
 
 
 def CreateChanges(output,
@@ -288,11 +541,16 @@ def CreateChanges(output,
                   priority,
                   distribution,
                   urgency,
-                  timestamp=0):
-  """Create the changes file."""
-  checksums = GetChecksumsFromFile(deb_file, {'md5': hashlib.md5,
-                                              'sha1': hashlib.sha1,
-                                              'sha256': hashlib.sha256})
+                  timestamp=0,
+                  checksums=None):
+  """Create the changes file.
+
+  Args:
+    checksums: md5, sha1 and sha256 of deb_file, as returned by CreateDeb().
+        Computed from the file if None.
+  """
+  if checksums is None:
+    checksums = GetChecksumsFromFile(deb_file, _CHANGES_HASH_FNS)
   debsize = str(os.path.getsize(deb_file))
   deb_basename = os.path.basename(deb_file)
 
@@ -341,7 +599,7 @@ def GetFlagValues(flagvalues):
     return None
 
 
-def main():
+def main(argv=None):
   parser = argparse.ArgumentParser(
       description='Helper for building deb packages',
       fromfile_prefix_chars='@')
@@ -350,8 +608,30 @@ def main():
                       help='The output file, mandatory')
   parser.add_argument('--changes', required=True,
                       help='The changes output file, mandatory.')
-  parser.add_argument('--data', required=True,
-                      help='Path to the data tarball, mandatory')
+  data = parser.add_mutually_exclusive_group(required=True)
+  data.add_argument('--data',
+                    help='Path to the data tarball.')
+  data.add_argument('--manifest',
+                    help='Manifest of the files to package. The data tarball'
+                         ' is built directly into the package.')
+  parser.add_argument(
+      '--data_compression', default='gz', choices=sorted(DATA_COMPRESSIONS),
+      help='Compression of the data tarball built from --manifest.')
+  parser.add_argument(
+      '--data_compression_level', default=-1, type=int,
+      help='Compression level of the data tarball built from --manifest.')
+  parser.add_argument(
+      '--data_mode',
+      help='Mode (in octal) of the files built from --manifest which do not'
+           ' set one.')
+  parser.add_argument(
+      '--data_mtime', default='portable',
+      help='mtime of the files built from --manifest. May be an integer or'
+           ' "portable".')
+  parser.add_argument(
+      '--data_zstd',
+      help='Path to the zstd tool to compress the data tarball built from'
+           ' --manifest with, instead of the zstandard Python module.')
   parser.add_argument(
       '--preinst',
       help='The preinst script (prefix with @ to provide a path).')
@@ -376,6 +656,11 @@ def main():
   parser.add_argument(
       '--md5sums',
       help='The md5sums file (prefix with @ to provide a path).')
+  parser.add_argument(
+      '--member_digests',
+      help='Digests of the files in --data, as written by build_tar'
+           ' --member_digests, to generate the md5sums file from if'
+           ' --md5sums is not set.')
   # see
   # https://www.debian.org/doc/manuals/debian-faq/ch-pkg_basics.en.html#s-conffile
   parser.add_argument(
@@ -385,9 +670,9 @@ def main():
       '--changelog',
       help='The changelog file (prefix item with @ to provide a path).')
   AddControlFlags(parser)
-  options = parser.parse_args()
+  options = parser.parse_args(argv)
 
-  CreateDeb(
+  checksums = CreateDeb(
       options.output,
       options.data,
       preinst=helpers.GetFlagValue(options.preinst, False),
@@ -398,8 +683,15 @@ def main():
       templates=helpers.GetFlagValue(options.templates, False),
       triggers=helpers.GetFlagValue(options.triggers, False),
       md5sums=helpers.GetFlagValue(options.md5sums, False),
+      member_digests=options.member_digests,
       conffiles=GetFlagValues(options.conffile),
       changelog=helpers.GetFlagValue(options.changelog, False),
+      data_manifest=options.manifest,
+      data_compression=options.data_compression,
+      data_compression_level=options.data_compression_level,
+      data_mode=int(options.data_mode, 8) if options.data_mode else None,
+      data_mtime=options.data_mtime,
+      data_zstd_path=options.data_zstd,
       package=options.package,
       version=helpers.GetFlagValue(options.version),
       description=helpers.GetFlagValue(options.description),
@@ -430,7 +722,7 @@ def main():
       maintainer=helpers.GetFlagValue(options.maintainer), package=options.package,
       version=helpers.GetFlagValue(options.version), section=options.section,
       priority=options.priority, distribution=options.distribution,
-      urgency=options.urgency)
+      urgency=options.urgency, checksums=checksums)
 
 if __name__ == '__main__':
-  main()
+  persistent_worker.main_or_worker(main)
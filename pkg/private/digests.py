@@ -0,0 +1,108 @@
+# Copyright 2026 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Computes several digests of large files at once, on several threads."""
+
+import concurrent.futures
+import mmap
+import os
+
+# Size of the buffers read from files. hashlib releases the GIL for buffers
+# larger than 2 KiB, large ones keep the per buffer overhead low.
+DEFAULT_BUFFER_SIZE = 1 << 20
+
+
+class ParallelDigester(object):
+  """Feeds the same data to several hash objects, one thread each.
+
+  update() hands its data to the hash threads and returns without waiting
+  for them, once the previous update is done. The caller thus prepares the
+  next buffer, e.g. reads it, while the current one is hashed.
+
+  The data given to update() must not be modified afterwards.
+  """
+
+  def __init__(self, hash_fns, threads=None):
+    """Create a digester.
+
+    Args:
+      hash_fns: mapping of names to hash constructors, e.g.
+          {'sha256': hashlib.sha256}.
+      threads: number of hash threads, default one per hash up to the
+          number of CPUs.
+    """
+    self.hashes = {k: fn() for (k, fn) in hash_fns.items()}
+    if not threads:
+      threads = min(len(self.hashes), os.cpu_count() or 1) or 1
+    self._executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=threads)
+    self._pending = []
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, t, v, traceback):
+    self.close()
+
+  def _wait(self):
+    for future in self._pending:
+      future.result()
+    self._pending = []
+
+  def update(self, data):
+    self._wait()
+    self._pending = [self._executor.submit(hashfn.update, data)
+                     for hashfn in self.hashes.values()]
+
+  def hexdigests(self):
+    """Returns {name: hexdigest} of the data so far."""
+    self._wait()
+    return {k: fn.hexdigest() for (k, fn) in self.hashes.items()}
+
+  def close(self):
+    self._wait()
+    self._executor.shutdown(wait=True)
+
+
+def file_digests(filename, hash_fns, buffer_size=DEFAULT_BUFFER_SIZE,
+                 threads=None, use_mmap=False):
+  """Computes several digests of a file in a single read.
+
+  Args:
+    filename: Name of the file.
+    hash_fns: mapping of names to hash constructors.
+    buffer_size: size of the buffers read from the file.
+    threads: number of hash threads, default one per hash up to the number
+        of CPUs.
+    use_mmap: hash slices of a memory map of the file instead of buffers
+        read from it, which saves copying the content.
+
+  Returns:
+    Mapping of hash names to hexdigest strings.
+  """
+  with open(filename, 'rb') as f, ParallelDigester(hash_fns,
+                                                   threads) as digester:
+    size = os.fstat(f.fileno()).st_size if use_mmap else 0
+    if size:
+      with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        with memoryview(mapped) as view:
+          for offset in range(0, size, buffer_size):
+            digester.update(view[offset:offset + buffer_size])
+          # The slices must be hashed before the map is closed.
+          return digester.hexdigests()
+    while True:
+      buf = f.read(buffer_size)
+      if not buf:
+        break
+      digester.update(buf)
+    return digester.hexdigests()
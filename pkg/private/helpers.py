@@ -30,6 +30,10 @@ def SplitNameValuePairAtSeparator(arg, sep):
     The unquoted string before the separator and the string after the
     separator.
   """
+  if '\\' not in arg:
+    # Nothing is quoted.
+    head, _, tail = arg.partition(sep)
+    return (head, tail)
   head = ''
   i = 0
   while i < len(arg):
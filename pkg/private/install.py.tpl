@@ -180,16 +180,24 @@ class NativeInstaller(object):
         self._do_symlink(entry.src, entry.dest, entry.mode, entry.user, entry.group)
 
     def include_manifest(self, path):
-        for entry in manifest.read_entries_from(path):
+        # Read and locate all the entries now, so that a bad manifest or a
+        # missing runfile fails before do_the_thing() wipes destdir.
+        self.entries.extend(self._read_manifest(path))
+
+    def _read_manifest(self, path):
+        for entry in manifest.iter_entries_from(path):
             # Swap out the source with the actual "runfile" location, except for
             # symbolic links as their targets denote installation paths
             if entry.type != manifest.ENTRY_IS_LINK and entry.src is not None:
-                entry.src = locate(entry.src, entry.repository)
+                src = entry.src
+                entry.src = locate(src, entry.repository)
+                if entry.src is None:
+                    raise ValueError("{}: cannot locate {}".format(path, src))
             # Prepend the destdir path to all installation paths, if one is
             # specified.
             if self.destdir is not None:
                 entry.dest = os.path.join(self.destdir, entry.dest)
-            self.entries.append(entry)
+            yield entry
 
     def do_the_thing(self):
         logging.info("Installing to %s", self.destdir)
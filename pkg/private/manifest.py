@@ -15,7 +15,9 @@
 """Common package builder manifest helpers
 """
 
+import io
 import json
+import sys
 
 
 # These must be kept in sync with the declarations in private/pkg_files.bzl
@@ -26,8 +28,23 @@ ENTRY_IS_DIR = "dir"  # Entry is an empty dir
 ENTRY_IS_TREE = "tree" # Entry is a tree artifact: take tree from <src>
 ENTRY_IS_EMPTY_FILE = "empty-file"  # Entry is a an empty file
 
+# Start of the first line of a compact manifest, followed by the format
+# version and the number of entries. See _write_compact_manifest() in
+# private/pkg_files.bzl.
+COMPACT_MANIFEST_MAGIC = "#rules_pkg-manifest"
+COMPACT_MANIFEST_VERSION = 1
+
+# Approximate number of bytes of compact manifest rows decoded at once.
+_COMPACT_BATCH_SIZE = 1 << 20
+
 class ManifestEntry(object):
-    """Structured wrapper around rules_pkg-produced manifest entries"""
+    """Structured wrapper around rules_pkg-produced manifest entries
+
+    Manifests can hold millions of entries, so entries have no __dict__ and
+    the often repeated strings are interned, to be shared between entries.
+    """
+    __slots__ = ("type", "dest", "src", "mode", "user", "group", "uid", "gid",
+                 "origin", "repository")
     type: str
     dest: str
     src: str
@@ -36,34 +53,113 @@ class ManifestEntry(object):
     group: str
     uid: int
     gid: int
-    origin: str = None
-    repository: str = None
+    origin: str
+    repository: str
 
     def __init__(self, type, dest, src, mode, user, group, uid = None, gid = None, origin = None, repository = None):
-        self.type = type
+        self.type = _intern(type)
         self.dest = dest
         self.src = src
-        self.mode = mode
-        self.user = user
-        self.group = group
+        self.mode = _intern(mode)
+        self.user = _intern(user)
+        self.group = _intern(group)
         self.uid = uid
         self.gid = gid
-        self.origin = origin
-        self.repository = repository
+        self.origin = _intern(origin)
+        self.repository = _intern(repository)
 
     def __repr__(self):
-        return "ManifestEntry<{}>".format(vars(self))
+        return "ManifestEntry<{}>".format(
+            {k: getattr(self, k) for k in self.__slots__})
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+def _new_shared_entry(type, dest, src, mode, user, group, uid, gid, origin, repository):
+    """ManifestEntry() for strings that are shared between entries already."""
+    entry = object.__new__(ManifestEntry)
+    entry.type = type
+    entry.dest = dest
+    entry.src = src
+    entry.mode = mode
+    entry.user = user
+    entry.group = group
+    entry.uid = uid
+    entry.gid = gid
+    entry.origin = origin
+    entry.repository = repository
+    return entry
 
 def read_entries_from(path):
     """Return a list of ManifestEntry's from the manifest file at `path`"""
-    # Subtle: decode the content with read() rather than in json.load() because
-    # the load in older python releases (< 3.7?) does not know how to decode.
-    # Moreover, prior to Bazel 8 (bazelbuild/bazel#24231), non-ASCII characters
-    # led files to be UTF-16LE-encoded on Windows.
+    return list(iter_entries_from(path))
+
+def iter_entries_from(path):
+    """Yield the ManifestEntry's from the manifest file at `path` one by one.
+
+    write_manifest() in pkg_files.bzl puts "[" and "]" on lines of their own
+    and each entry on a single line in between. Such manifests are decoded a
+    line at a time, so that only one entry is in memory at once. Any other
+    layout, e.g. a pretty printed manifest, is decoded as a whole.
+
+    Compact manifests, selected with --@rules_pkg//pkg:manifest_format, are
+    read in batches of lines. Their string table makes equal strings shared
+    between entries without interning.
+    """
+    # Subtle: decode the content in the reader rather than in json.load()
+    # because the load in older python releases (< 3.7?) does not know how to
+    # decode. Moreover, prior to Bazel 8 (bazelbuild/bazel#24231), non-ASCII
+    # characters led files to be UTF-16LE-encoded on Windows.
     with open(path, "rb") as fh:
-        raw = fh.read()
-    raw_entries = json.loads(raw.decode("utf-16-le" if raw[1:2] == b"\0" else "utf-8"))
-    return [ManifestEntry(**entry) for entry in raw_entries]
+        encoding = "utf-16-le" if fh.read(2)[1:2] == b"\0" else "utf-8"
+        fh.seek(0)
+        with io.TextIOWrapper(fh, encoding=encoding) as text:
+            first = text.readline()
+            if first.startswith(COMPACT_MANIFEST_MAGIC):
+                yield from _iter_compact_entries(path, first, text)
+                return
+            second = text.readline()
+            if first.strip() != "[" or not _is_entry_line(second.strip()):
+                text.seek(0)
+                for entry in json.load(text):
+                    yield ManifestEntry(**entry)
+                return
+            line = second
+            while line:
+                line = line.strip()
+                if line == "]":
+                    break
+                yield ManifestEntry(**json.loads(line.rstrip(",")))
+                line = text.readline()
+            else:
+                raise ValueError("{}: unterminated manifest".format(path))
+
+def _iter_compact_entries(path, header, text):
+    _, version, count = header.split()
+    if int(version) != COMPACT_MANIFEST_VERSION:
+        raise ValueError("{}: unsupported manifest version {}".format(
+            path, version))
+    # Null strings are written as -1.
+    strings = json.loads(text.readline()) + [None]
+    remaining = int(count)
+    while remaining > 0:
+        # Decoding a batch of rows at once is much faster than one by one.
+        lines = text.readlines(_COMPACT_BATCH_SIZE)
+        if not lines:
+            raise ValueError("{}: unterminated manifest".format(path))
+        rows = json.loads("[" + ",".join(lines) + "]")
+        remaining -= len(rows)
+        for (type, dest, src, mode, user, group, uid, gid, origin,
+             repository) in rows:
+            yield _new_shared_entry(
+                strings[type], strings[dest], strings[src], strings[mode],
+                strings[user], strings[group], uid, gid, strings[origin],
+                strings[repository])
+    if remaining < 0 or text.readline():
+        raise ValueError("{}: more entries than announced".format(path))
+
+def _is_entry_line(line):
+    return line.startswith("{") and line.rstrip(",").endswith("}")
 
 def entry_type_to_string(et):
     """Entry type stringifier"""
@@ -0,0 +1,326 @@
+# Copyright 2026 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Bazel persistent worker harness shared by the packaging tools.
+
+A tool opts in by routing its entry point through main_or_worker():
+
+  if __name__ == '__main__':
+    persistent_worker.main_or_worker(main)
+
+where main takes the argument list and returns an exit code (or None).
+When Bazel starts the tool with --persistent_worker, the harness reads
+WorkRequests from stdin using the JSON worker protocol and calls main once
+per request. See https://bazel.build/remote/creating for the protocol.
+
+Startup flags understood by the harness (pass them with
+--worker_extra_flag=<Mnemonic>=<flag>):
+  --worker_threads=N: maximum number of multiplexed requests run at once.
+  --worker_max_rss_mb=N: once the peak RSS of the worker exceeds N MiB, finish
+      the outstanding requests and exit so that Bazel starts a fresh worker.
+"""
+
+import concurrent.futures
+import io
+import json
+import os
+import sys
+import threading
+import traceback
+
+try:
+  import resource  # pylint: disable=g-import-not-at-top
+except ImportError:
+  resource = None
+
+PERSISTENT_WORKER_FLAG = '--persistent_worker'
+
+
+class _ThreadLocalStream(object):
+  """Routes writes to a per-thread buffer while a work request is running.
+
+  Multiplexed requests run concurrently in one interpreter, so a plain
+  redirect of sys.stdout would interleave their output. Threads that are not
+  serving a request write through to the real stream.
+  """
+
+  def __init__(self, stream):
+    self._stream = stream
+    self._local = threading.local()
+
+  def capture(self, buffer):
+    self._local.buffer = buffer
+
+  def release(self):
+    self._local.buffer = None
+
+  def write(self, data):
+    buffer = getattr(self._local, 'buffer', None)
+    return (buffer or self._stream).write(data)
+
+  def flush(self):
+    buffer = getattr(self._local, 'buffer', None)
+    (buffer or self._stream).flush()
+
+
+def _read_work_requests(stream):
+  """Yields JSON work requests from `stream` until it is closed."""
+  decoder = json.JSONDecoder()
+  pending = ''
+  for line in stream:
+    pending += line
+    if not pending.strip():
+      pending = ''
+      continue
+    try:
+      request, _ = decoder.raw_decode(pending.strip())
+    except ValueError:
+      # Requests may span several lines; keep reading.
+      continue
+    pending = ''
+    yield request
+
+
+class _SharedLock(object):
+  """A lock that many holders may share, or one may hold exclusively.
+
+  Requests that leave the working directory alone share it, a request that
+  changes it holds it exclusively. Waiting exclusive holders block new
+  shared ones, so a sandboxed request is not starved by a steady stream of
+  others.
+  """
+
+  def __init__(self):
+    self._cond = threading.Condition()
+    self._shared = 0
+    self._exclusive = False
+    self._waiting = 0
+
+  def acquire_shared(self):
+    with self._cond:
+      while self._exclusive or self._waiting:
+        self._cond.wait()
+      self._shared += 1
+
+  def release_shared(self):
+    with self._cond:
+      self._shared -= 1
+      if not self._shared:
+        self._cond.notify_all()
+
+  def acquire_exclusive(self):
+    with self._cond:
+      self._waiting += 1
+      while self._exclusive or self._shared:
+        self._cond.wait()
+      self._waiting -= 1
+      self._exclusive = True
+
+  def release_exclusive(self):
+    with self._cond:
+      self._exclusive = False
+      self._cond.notify_all()
+
+
+def _peak_rss_mb():
+  """Returns the peak resident set size of this process in MiB, or None."""
+  if resource is None:
+    return None
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # ru_maxrss is in bytes on macOS and in KiB everywhere else.
+  if sys.platform == 'darwin':
+    return peak / (1024 * 1024)
+  return peak / 1024
+
+
+class PersistentWorker(object):
+  """Serves work requests for one tool entry point.
+
+  Requests with a requestId of 0 come from a singleplex worker and are run
+  in order on the main thread. Non-zero ids come from a multiplex worker and
+  are run on a thread pool, unless the tool is not thread safe, in which case
+  they are run in order as well.
+
+  Requests that carry a sandboxDir are run with the process working
+  directory set to that directory. Since the working directory is process
+  wide, a sandboxed request runs alone: it waits for the running requests
+  to finish, and no other request starts until it is done.
+
+  A cancel request only cancels a request that has not started yet, which
+  is answered with wasCancelled. Python cannot interrupt a running thread,
+  so a request that already runs is left to finish and gets its normal
+  response, which the protocol allows.
+  """
+
+  def __init__(self, main_fn, multiplex=True, max_threads=None,
+               max_rss_mb=None, stdin=None, stdout=None, stderr=None):
+    """Create a worker.
+
+    Args:
+      main_fn: callable taking an argument list and returning an exit code.
+      multiplex: whether main_fn may run concurrently with itself.
+      max_threads: size of the thread pool for multiplexed requests.
+      max_rss_mb: peak RSS after which the worker retires itself.
+      stdin: stream to read requests from, default sys.stdin.
+      stdout: stream to write responses to, default sys.stdout.
+      stderr: real stderr stream, default sys.stderr.
+    """
+    self.main_fn = main_fn
+    self.multiplex = multiplex
+    self.max_threads = max_threads or os.cpu_count() or 1
+    self.max_rss_mb = max_rss_mb
+    self.stdin = stdin or sys.stdin
+    self.protocol_out = stdout or sys.stdout
+    self.real_stderr = stderr or sys.stderr
+    self._out_lock = threading.Lock()
+    self._cwd_lock = _SharedLock()
+    self._pending_lock = threading.Lock()
+    self._pending = {}
+    self._retire = threading.Event()
+    self._captures = (_ThreadLocalStream(self.protocol_out),
+                      _ThreadLocalStream(self.real_stderr))
+
+  def _respond(self, response):
+    with self._out_lock:
+      self.protocol_out.write(json.dumps(response) + '\n')
+      self.protocol_out.flush()
+
+  def _call_main(self, arguments, output):
+    """Runs main_fn and returns its exit code."""
+    try:
+      result = self.main_fn(arguments)
+    except SystemExit as e:
+      # argparse reports usage errors through sys.exit().
+      result = e.code
+      if result is not None and not isinstance(result, int):
+        output.write(str(result) + '\n')
+        result = 1
+    except Exception:  # pylint: disable=broad-except
+      output.write(traceback.format_exc())
+      result = 1
+    return result or 0
+
+  def _run_request(self, request):
+    """Runs one work request and writes its response."""
+    request_id = request.get('requestId', 0)
+    output = io.StringIO()
+    for capture in self._captures:
+      capture.capture(output)
+    try:
+      sandbox_dir = request.get('sandboxDir')
+      if sandbox_dir:
+        self._cwd_lock.acquire_exclusive()
+        try:
+          previous_dir = os.getcwd()
+          os.chdir(sandbox_dir)
+          try:
+            exit_code = self._call_main(request.get('arguments', []), output)
+          finally:
+            os.chdir(previous_dir)
+        finally:
+          self._cwd_lock.release_exclusive()
+      else:
+        self._cwd_lock.acquire_shared()
+        try:
+          exit_code = self._call_main(request.get('arguments', []), output)
+        finally:
+          self._cwd_lock.release_shared()
+    finally:
+      for capture in self._captures:
+        capture.release()
+    with self._pending_lock:
+      self._pending.pop(request_id, None)
+    self._respond({
+        'exitCode': exit_code,
+        'output': output.getvalue(),
+        'requestId': request_id,
+    })
+    if self.max_rss_mb:
+      peak = _peak_rss_mb()
+      if peak is not None and peak > self.max_rss_mb:
+        self._retire.set()
+
+  def _cancel(self, request_id):
+    """Cancels a request if it has not started yet.
+
+    A running request is not interrupted; it answers with its normal
+    response once main_fn returns.
+    """
+    with self._pending_lock:
+      future = self._pending.get(request_id)
+      if future is None or not future.cancel():
+        # Unknown, running or finished: the normal response will do.
+        return
+      del self._pending[request_id]
+    self._respond({
+        'exitCode': 0,
+        'output': '',
+        'requestId': request_id,
+        'wasCancelled': True,
+    })
+
+  def run(self):
+    """Serves requests until stdin is closed or the worker retires.
+
+    Returns:
+      The process exit code.
+    """
+    saved_streams = (sys.stdout, sys.stderr)
+    sys.stdout, sys.stderr = self._captures
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=self.max_threads)
+    try:
+      for request in _read_work_requests(self.stdin):
+        request_id = request.get('requestId', 0)
+        if request.get('cancel'):
+          self._cancel(request_id)
+        elif request_id == 0 or not self.multiplex:
+          self._run_request(request)
+        else:
+          with self._pending_lock:
+            self._pending[request_id] = executor.submit(
+                self._run_request, request)
+        if self._retire.is_set():
+          break
+    finally:
+      executor.shutdown(wait=True)
+      sys.stdout, sys.stderr = saved_streams
+    return 0
+
+
+def _parse_startup_flags(argv):
+  """Extracts the harness flags from the worker startup arguments."""
+  flags = {}
+  for arg in argv:
+    if arg.startswith('--worker_threads='):
+      flags['max_threads'] = int(arg.split('=', 1)[1])
+    elif arg.startswith('--worker_max_rss_mb='):
+      flags['max_rss_mb'] = int(arg.split('=', 1)[1])
+  return flags
+
+
+def main_or_worker(main_fn, multiplex=True, argv=None):
+  """Runs main_fn once, or serves it as a persistent worker.
+
+  Args:
+    main_fn: callable taking an argument list and returning an exit code.
+    multiplex: whether main_fn may run concurrently with itself.
+    argv: command line arguments, default sys.argv[1:].
+  """
+  if argv is None:
+    argv = sys.argv[1:]
+  if PERSISTENT_WORKER_FLAG in argv:
+    worker = PersistentWorker(main_fn, multiplex=multiplex,
+                              **_parse_startup_flags(argv))
+    sys.exit(worker.run())
+  sys.exit(main_fn(argv))
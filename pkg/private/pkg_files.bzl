@@ -31,6 +31,7 @@ Concepts and terms:
             by rule implementations and passed to the build_*.py helpers.
 """
 
+load("@bazel_skylib//rules:common_settings.bzl", "BuildSettingInfo")
 load("//pkg:path.bzl", "compute_data_path", "dest_path")
 load(
     "//pkg:providers.bzl",
@@ -52,6 +53,13 @@ ENTRY_IS_DIR = "dir"  # Entry is an empty dir
 ENTRY_IS_TREE = "tree"  # Entry is a tree artifact: take tree from <src>
 ENTRY_IS_EMPTY_FILE = "empty-file"  # Entry is a an empty file
 
+# First line of a compact manifest. Must be kept in sync with
+# private/manifest.py.
+COMPACT_MANIFEST_HEADER = "#rules_pkg-manifest 1"
+
+# Fields of a compact manifest row, in order.
+_MANIFEST_FIELDS = ["type", "dest", "src", "mode", "user", "group", "uid", "gid", "origin", "repository"]
+
 # buildifier: disable=name-conventions
 _DestFile = provider(
     doc = """Information about each destination in the final package.""",
@@ -651,6 +659,10 @@ def write_manifest(ctx, manifest_file, content_map, use_short_path = False, pret
       use_short_path: write out the manifest file destinations in terms of "short" paths, suitable for `bazel run`.
       pretty_print: indent the output nicely. Takes more space so it is off by default.
     """
+    if (hasattr(ctx.attr, "_manifest_format") and
+        ctx.attr._manifest_format[BuildSettingInfo].value == "compact"):
+        _write_compact_manifest(ctx, manifest_file, content_map, use_short_path)
+        return
     ctx.actions.write(
         manifest_file,
         "[\n" + ",\n".join(
@@ -661,7 +673,45 @@ def write_manifest(ctx, manifest_file, content_map, use_short_path = False, pret
         ) + "\n]\n",
     )
 
+def _write_compact_manifest(ctx, manifest_file, content_map, use_short_path):
+    """Write a content map to a compact manifest file.
+
+    The first line is COMPACT_MANIFEST_HEADER followed by the number of
+    entries. The second line is a JSON list of all the distinct strings of
+    the entries. Each following line is an entry: a JSON list of the values
+    of _MANIFEST_FIELDS, where strings are replaced by their index in the
+    string list, and null strings by -1.
+    """
+    strings = {}
+    rows = []
+    for dst in sorted(content_map.keys()):
+        data = _manifest_entry_data(ctx, dst, content_map[dst], use_short_path)
+        row = []
+        for field in _MANIFEST_FIELDS:
+            value = data[field]
+            if field in ("uid", "gid"):
+                row.append(value)
+            elif value == None:
+                row.append(-1)
+            else:
+                row.append(strings.setdefault(value, len(strings)))
+        rows.append(json.encode(row))
+    ctx.actions.write(
+        manifest_file,
+        "\n".join([
+            "%s %d" % (COMPACT_MANIFEST_HEADER, len(rows)),
+            json.encode(list(strings.keys())),
+        ] + rows) + "\n",
+    )
+
 def _encode_manifest_entry(ctx, dest, df, use_short_path, pretty_print = False):
+    data = _manifest_entry_data(ctx, dest, df, use_short_path)
+    if pretty_print:
+        return json.encode_indent(data)
+    else:
+        return json.encode(data)
+
+def _manifest_entry_data(ctx, dest, df, use_short_path):
     entry_type = df.entry_type if hasattr(df, "entry_type") else ENTRY_IS_FILE
     repository = None
     if df.src:
@@ -686,7 +736,7 @@ def _encode_manifest_entry(ctx, dest, df, use_short_path, pretty_print = False):
     if not origin_str.startswith("@"):
         origin_str = "@" + origin_str
 
-    data = {
+    return {
         "type": entry_type,
         "src": src,
         "dest": dest.strip("/"),
@@ -698,8 +748,3 @@ def _encode_manifest_entry(ctx, dest, df, use_short_path, pretty_print = False):
         "origin": origin_str,
         "repository": repository,
     }
-
-    if pretty_print:
-        return json.encode_indent(data)
-    else:
-        return json.encode(data)
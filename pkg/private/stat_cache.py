@@ -0,0 +1,101 @@
+# Copyright 2026 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Caches the stat of input files for the length of one packaging run.
+
+build_tar and build_zip share one cache per run between their tree walks
+and the files they add. The installer does not use it: it copies tree
+artifacts with shutil.copytree() and walks them again only to set the mode
+of directories, so no stat would be served from the cache.
+"""
+
+import os
+import stat
+
+
+class StatCache(object):
+  """Remembers os.stat() of the files a package builder reads.
+
+  The inputs of an action do not change while it runs, and on network or
+  FUSE file systems every stat is a round trip. Builders therefore stat
+  each input once, through one StatCache per run. Do not keep a cache
+  across runs, e.g. in a persistent worker, as inputs change between them.
+
+  Paths are cached as given, not made absolute, so a path is only found
+  again when it is spelled the same way, e.g. os.path.join(root, name) for
+  the files found by walk().
+  """
+
+  def __init__(self):
+    self._stats = {}
+
+  def stat(self, path):
+    """Returns os.stat(path), following symlinks."""
+    st = self._stats.get(path)
+    if st is None:
+      st = os.stat(path)
+      self._stats[path] = st
+    return st
+
+  def is_executable(self, path):
+    """Returns os.access(path, os.X_OK).
+
+    A file without any x bit in its cached stat is not executable, whatever
+    its ACLs, which saves the access check for most files. The others are
+    checked with os.access(), which knows about ACLs, noexec mounts and the
+    real user and groups.
+    """
+    if (os.name != 'nt' and not self.stat(path).st_mode &
+        (stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)):
+      return False
+    # Windows decides from the extension, not from the stat.
+    return os.access(path, os.X_OK)
+
+  def walk(self, top, topdown=True):
+    """Like os.walk(top, topdown), keeping the stat of the files found.
+
+    The stat of the files comes from os.scandir(), which gets it for free
+    on Windows and saves a separate lookup of each path elsewhere.
+    """
+    dirs = []
+    files = []
+    links = set()
+    try:
+      it = os.scandir(top)
+    except OSError:
+      return
+    with it:
+      for entry in it:
+        try:
+          is_dir = entry.is_dir()
+        except OSError:
+          is_dir = False
+        if is_dir:
+          dirs.append(entry.name)
+          if entry.is_symlink():
+            links.add(entry.name)
+          continue
+        files.append(entry.name)
+        try:
+          self._stats[entry.path] = entry.stat()
+        except OSError:
+          # e.g. a dangling symlink. Let the user of the path report it.
+          pass
+    if topdown:
+      yield top, dirs, files
+    for name in dirs:
+      # As os.walk, do not follow symlinks to directories.
+      if name not in links:
+        yield from self.walk(os.path.join(top, name), topdown)
+    if not topdown:
+      yield top, dirs, files
@@ -14,7 +14,11 @@
 """This tool build tar files from a list of inputs."""
 
 import argparse
+import fnmatch
+import hashlib
+import json
 import os
+import re
 import stat
 import tarfile
 import tempfile
@@ -23,8 +27,15 @@ from pkg.private import archive
 from pkg.private import helpers
 from pkg.private import build_info
 from pkg.private import manifest
+from pkg.private import persistent_worker
+from pkg.private import stat_cache
 from pkg.private.tar import tar_writer
 
+# Environment variable naming the incremental rebuild directory, when
+# --incremental_dir is not given. See pkg_tar in tar.bzl.
+INCREMENTAL_DIR_ENV = 'RULES_PKG_TAR_INCREMENTAL_DIR'
+DEFAULT_INCREMENTAL_MAX_MB = 1024
+
 
 def normpath(path):
   r"""Normalize a path to the format we need it.
@@ -37,6 +48,105 @@ def normpath(path):
   return os.path.normpath(path).replace(os.path.sep, '/')
 
 
+# Parsers of the values of the attributes in attribute rules files.
+_ATTRIBUTE_PARSERS = {
+    'mode': lambda value: int(value, 8),
+    'owner': lambda value: tuple(int(i) for i in value.split('.', 1)),
+    'owner_name': lambda value: tuple(value.split('.', 1)),
+}
+
+_MISSING = object()
+
+
+class _AttributeMatcher(object):
+  """The rules of one attribute, compiled for lookups by path."""
+
+  def __init__(self):
+    self.paths = {}
+    self.prefixes = {}
+    self.globs = []
+
+  def update(self, rules, parse):
+    for path, value in rules.get('paths', {}).items():
+      self.paths[path.strip('/')] = parse(value)
+    for prefix, value in rules.get('prefixes', {}).items():
+      self.prefixes[prefix.strip('/')] = parse(value)
+    for pattern, value in rules.get('globs', []):
+      self.globs.append(
+          (re.compile(fnmatch.translate(pattern.strip('/'))).match,
+           parse(value)))
+
+  def get(self, path, default):
+    value = self.paths.get(path, _MISSING)
+    if value is not _MISSING:
+      return value
+    if self.prefixes:
+      parent = path
+      while True:
+        value = self.prefixes.get(parent, _MISSING)
+        if value is not _MISSING:
+          return value
+        if not parent:
+          break
+        parent = parent.rpartition('/')[0]
+    for match, value in self.globs:
+      if match(path):
+        return value
+    return default
+
+
+class AttributeRules(object):
+  """Mode and owner overrides of the files of a tar, by path.
+
+  Rules are loaded from JSON files mapping each attribute, "mode" (octal),
+  "owner" ("uid.gid") or "owner_name" ("user.group"), to its rules:
+    "paths": {path: value} for exact paths.
+    "prefixes": {directory: value} for a directory and all below it.
+    "globs": [[pattern, value], ...] fnmatch patterns, where "*" also
+        matches "/". The first matching pattern applies.
+  An exact path wins over the deepest prefix, which wins over the patterns.
+  Later files override the paths and prefixes of earlier ones, and their
+  patterns are tried after those of earlier ones.
+  """
+
+  def __init__(self, default_mode, default_ids, default_names):
+    self.defaults = {
+        'mode': default_mode,
+        'owner': default_ids,
+        'owner_name': default_names,
+    }
+    self.matchers = {k: _AttributeMatcher() for k in _ATTRIBUTE_PARSERS}
+    # Files with the same attributes share their attributes dict.
+    self._attributes = {}
+
+  def load(self, path):
+    with open(path, 'r', encoding='utf-8') as f:
+      rules = json.load(f)
+    for attribute, attribute_rules in rules.items():
+      self.add(attribute, attribute_rules)
+
+  def add(self, attribute, rules):
+    if attribute not in self.matchers:
+      raise ValueError('Unknown attribute in attribute rules: ' + attribute)
+    self.matchers[attribute].update(rules, _ATTRIBUTE_PARSERS[attribute])
+
+  def file_attributes(self, filename):
+    """Returns the mode, ids and names to give to a file.
+
+    The returned dict is shared, it must not be modified.
+    """
+    filename = filename.lstrip('/')
+    key = (self.matchers['mode'].get(filename, self.defaults['mode']),
+           self.matchers['owner'].get(filename, self.defaults['owner']),
+           self.matchers['owner_name'].get(filename,
+                                           self.defaults['owner_name']))
+    attributes = self._attributes.get(key)
+    if attributes is None:
+      attributes = {'mode': key[0], 'ids': key[1], 'names': key[2]}
+      self._attributes[key] = attributes
+    return attributes
+
+
 class TarFile(object):
   """A class to generates a TAR file."""
 
@@ -45,7 +155,9 @@ class TarFile(object):
 
   def __init__(self, output, directory, compression, compressor, create_parents,
                allow_dups_from_deps, default_mtime, compression_level, preserve_mode,
-               preserve_mtime):
+               preserve_mtime, compression_threads=1, zstd_path=None,
+               incremental_dir=None, outfile=None, member_digests=None,
+               incremental_max_mb=DEFAULT_INCREMENTAL_MAX_MB):
     # Directory prefix on all output paths
     d = directory.strip('/')
     self.directory = (d + '/') if d else None
@@ -58,8 +170,41 @@ class TarFile(object):
     self.compression_level = compression_level
     self.preserve_mode = preserve_mode
     self.preserve_mtime = preserve_mtime
+    self.compression_threads = compression_threads
+    self.zstd_path = zstd_path
+    self.outfile = outfile
+    self.member_digests = member_digests
+    self.stat_cache = stat_cache.StatCache()
+    self.incremental_dir = None
+    if (incremental_dir and not compression and not compressor and
+        not outfile and not member_digests):
+      self.incremental_dir = incremental_dir
+    self.incremental_max_bytes = incremental_max_mb * 1024 * 1024
+
+  def _incremental_paths(self):
+    """Returns the paths of the previous tar and index for this output."""
+    key = hashlib.sha256(self.output.encode('utf-8')).hexdigest()
+    base = os.path.join(self.incremental_dir, key)
+    return base + '.tar', base + '.index'
 
   def __enter__(self):
+    incremental_args = {}
+    if self.incremental_dir:
+      os.makedirs(self.incremental_dir, exist_ok=True)
+      previous, previous_index = self._incremental_paths()
+      if (os.path.exists(self.output) and os.path.exists(previous) and
+          os.path.samefile(self.output, previous)):
+        # The previous tar is a hard link to the output, which must not be
+        # overwritten in place while members are copied from it.
+        os.remove(self.output)
+      fd, self.new_index = tempfile.mkstemp(dir=self.incremental_dir,
+                                            suffix='.tmp')
+      os.close(fd)
+      incremental_args = {
+          'index': self.new_index,
+          'previous': previous if os.path.exists(previous) else None,
+          'previous_index': previous_index,
+      }
     self.tarfile = tar_writer.TarFileWriter(
         self.output,
         self.compression,
@@ -67,11 +212,90 @@ class TarFile(object):
         self.create_parents,
         self.allow_dups_from_deps,
         default_mtime=self.default_mtime,
-        compression_level=self.compression_level)
+        compression_level=self.compression_level,
+        compression_threads=self.compression_threads,
+        zstd_path=self.zstd_path,
+        keep_tarinfo=False,
+        outfile=self.outfile,
+        member_digests=self.member_digests,
+        stat_cache=self.stat_cache,
+        **incremental_args)
     return self
 
   def __exit__(self, t, v, traceback):
-    self.tarfile.close()
+    try:
+      self.tarfile.close()
+    finally:
+      if self.incremental_dir:
+        self._save_incremental_state(success=t is None)
+
+  def _save_incremental_state(self, success):
+    """Keeps the output and its index for the next build.
+
+    The output is kept as a hard link, or else as a reflink, so that it
+    takes no extra space. Only where neither works is it copied.
+    """
+    if not success:
+      os.remove(self.new_index)
+      return
+    previous, previous_index = self._incremental_paths()
+    fd, new_tar = tempfile.mkstemp(dir=self.incremental_dir, suffix='.tmp')
+    os.close(fd)
+    try:
+      os.remove(new_tar)
+      try:
+        os.link(self.output, new_tar)
+      except OSError:
+        # e.g. across file systems.
+        if not tar_writer.clone_file(self.output, new_tar):
+          with open(new_tar, 'wb') as dst, open(self.output, 'rb') as src:
+            tar_writer.copy_file_range(
+                src, dst, 0, os.fstat(src.fileno()).st_size)
+      # Drop the old index first, so that it never describes the new tar.
+      if os.path.exists(previous_index):
+        os.remove(previous_index)
+      os.replace(new_tar, previous)
+      os.replace(self.new_index, previous_index)
+      self._evict_incremental_state()
+    except OSError:
+      # Incremental state is only an optimization.
+      for path in (new_tar, self.new_index):
+        if os.path.exists(path):
+          os.remove(path)
+
+  def _evict_incremental_state(self):
+    """Drops the least recently built outputs above incremental_max_mb.
+
+    A tar which is still a hard link to an output takes no extra space, so
+    only those with no other link count.
+    """
+    builds = {}
+    with os.scandir(self.incremental_dir) as it:
+      for dir_entry in it:
+        base, ext = os.path.splitext(dir_entry.path)
+        if ext not in ('.tar', '.index'):
+          continue
+        st = dir_entry.stat(follow_symlinks=False)
+        mtime, size = builds.get(base, (0, 0))
+        if ext == '.index':
+          mtime = st.st_mtime
+        if ext == '.index' or st.st_nlink == 1:
+          size += st.st_size
+        builds[base] = (mtime, size)
+    total = sum(size for _, size in builds.values())
+    if total <= self.incremental_max_bytes:
+      return
+    target = self.incremental_max_bytes * 9 // 10
+    for mtime, size, base in sorted(
+        (mtime, size, base) for base, (mtime, size) in builds.items()):
+      if total <= target:
+        break
+      for path in (base + '.index', base + '.tar'):
+        try:
+          os.remove(path)
+        except OSError:
+          pass
+      total -= size
 
   def normalize_path(self, path: str) -> str:
     dest = normpath(path)
@@ -109,11 +333,11 @@ class TarFile(object):
     # from the file's mode attribute. Note: the mode argument is ignored.
     # Otherwise; if mode is unspecified, derive the mode from the file's mode.
     if self.preserve_mode is True:
-      mode = stat.S_IMODE(os.stat(f).st_mode)
+      mode = stat.S_IMODE(self.stat_cache.stat(f).st_mode)
     elif mode is None:
-        mode = 0o755 if os.access(f, os.X_OK) else 0o644
+        mode = 0o755 if self.stat_cache.is_executable(f) else 0o644
     if self.preserve_mtime is True:
-      mtime = os.stat(f).st_mtime
+      mtime = self.stat_cache.stat(f).st_mtime
     if ids is None:
       ids = (0, 0)
     if names is None:
@@ -176,7 +400,7 @@ class TarFile(object):
     self.add_empty_file(
         destpath, mode=mode, ids=ids, names=names, kind=tarfile.DIRTYPE)
 
-  def add_tar(self, tar):
+  def add_tar(self, tar, fileobj=None):
     """Merge a tar file into the destination tar file.
 
     All files presents in that tar will be added to the output file
@@ -185,8 +409,10 @@ class TarFile(object):
 
     Args:
       tar: the tar file to add
+      fileobj: if set, the tar is read from this file object instead.
     """
-    self.tarfile.add_tar(tar, numeric=True, prefix=self.directory)
+    self.tarfile.add_tar(tar, numeric=True, prefix=self.directory,
+                         fileobj=fileobj)
 
   def add_link(self, symlink, destination, mode=None, ids=None, names=None):
     """Add a symbolic link pointing to `destination`.
@@ -228,16 +454,16 @@ class TarFile(object):
       DebError: if the format of the deb archive is incorrect.
     """
     with archive.SimpleArReader(deb) as arfile:
-      current = next(arfile)
-      while current and not current.filename.startswith('data.'):
-        current = next(arfile)
+      current = None
+      for member in arfile.members():
+        if member.filename.startswith('data.'):
+          current = member
+          break
       if not current:
         raise self.DebError(deb + ' does not contains a data file!')
-      tmpfile = tempfile.mkstemp(suffix=os.path.splitext(current.filename)[-1])
-      with open(tmpfile[1], 'wb') as f:
-        f.write(current.data)
-      self.add_tar(tmpfile[1])
-      os.remove(tmpfile[1])
+      # Stream the data tarball out of the deb rather than extracting it.
+      with current.open() as data:
+        self.add_tar(deb, fileobj=data)
 
   def add_tree(self, tree_top, destpath, mode=None, ids=None, names=None):
     """Add a tree artifact to the tar file.
@@ -269,7 +495,7 @@ class TarFile(object):
       names = ('', '')
 
     to_write = {}
-    for root, dirs, files in os.walk(tree_top):
+    for root, dirs, files in self.stat_cache.walk(tree_top):
       # While `tree_top` uses '/' as a path separator, results returned by
       # `os.walk` and `os.path.join` on Windows may not.
       root = normpath(root)
@@ -308,7 +534,7 @@ class TarFile(object):
       else:
         # If mode is unspecified, derive the mode from the file's mode.
         if mode is None:
-          f_mode = 0o755 if os.access(content_path, os.X_OK) else 0o644
+          f_mode = 0o755 if self.stat_cache.is_executable(content_path) else 0o644
         else:
           f_mode = mode
         self.tarfile.add_file(
@@ -328,6 +554,9 @@ class TarFile(object):
     else:
       attrs = {}
     # But any attributes from the manifest have higher precedence
+    if entry.mode or entry.user or entry.uid is not None:
+      # file_attributes may return the same dict for many files.
+      attrs = dict(attrs)
     if entry.mode is not None and entry.mode != '':
       attrs['mode'] = int(entry.mode, 8)
     if entry.user:
@@ -355,7 +584,7 @@ class TarFile(object):
       self.add_file(entry.src, entry.dest, **attrs)
 
 
-def main():
+def main(argv=None):
   parser = argparse.ArgumentParser(
       description='Helper for building tar packages',
       fromfile_prefix_chars='@')
@@ -380,7 +609,7 @@ def main():
 
   compression = parser.add_mutually_exclusive_group()
   compression.add_argument('--compression',
-                           help='Compression (`gz` or `bz2`), default is none.')
+                           help='Compression (`gz`, `bz2`, `xz` or `zst`), default is none.')
   compression.add_argument('--compressor',
                            help='Compressor program and arguments, '
                                 'e.g. `pigz -p 4`')
@@ -404,6 +633,11 @@ def main():
       '--owner_names', action='append',
       help='Specify the owner names of individual files, e.g. '
            'path/to/file=root.root.')
+  parser.add_argument(
+      '--attribute_rules', action='append',
+      help='JSON file of mode and owner rules for individual files, by exact'
+           ' path, directory prefix or glob. See AttributeRules. Rules of'
+           ' --modes, --owners and --owner_names are applied last.')
   parser.add_argument('--stamp_from', default='',
                       help='File to find BUILD_STAMP in')
   parser.add_argument('--create_parents',
@@ -424,7 +658,27 @@ def main():
   parser.add_argument(
       '--compression_level', default=-1,
       help='Specify the numeric compress level in gzip mode; may be 0-9 or -1 (default to 6).')
-  options = parser.parse_args()
+  parser.add_argument(
+      '--compression_threads', default=1, type=int,
+      help='Number of threads to compress gzip, xz or zstd output with. Any'
+           ' value above 1 switches to block-parallel compression.')
+  parser.add_argument(
+      '--zstd',
+      help='Path to the zstd tool to use for `zst` compression, instead of'
+           ' the zstandard Python module.')
+  parser.add_argument(
+      '--incremental_dir', default=os.environ.get(INCREMENTAL_DIR_ENV),
+      help='Directory of the incremental rebuild state. Defaults to $%s.'
+           % INCREMENTAL_DIR_ENV)
+  parser.add_argument(
+      '--incremental_max_mb', type=int, default=DEFAULT_INCREMENTAL_MAX_MB,
+      help='Size above which the incremental state of the least recently'
+           ' built outputs is evicted.')
+  parser.add_argument(
+      '--member_digests',
+      help='File to write the MD5 and SHA-256 of each file in the archive to,'
+           ' one "<md5> <sha256> <name>" line per file.')
+  options = parser.parse_args(argv)
 
   # Parse modes arguments
   default_mode = None
@@ -432,36 +686,23 @@ def main():
     # Convert from octal
     default_mode = int(options.mode, 8)
 
-  mode_map = {}
-  if options.modes:
-    for filemode in options.modes:
-      (f, mode) = helpers.SplitNameValuePairAtSeparator(filemode, '=')
-      if f[0] == '/':
-        f = f[1:]
-      mode_map[f] = int(mode, 8)
-
   default_ownername = ('', '')
   if options.owner_name:
-    default_ownername = options.owner_name.split('.', 1)
-  names_map = {}
-  if options.owner_names:
-    for file_owner in options.owner_names:
-      (f, owner) = helpers.SplitNameValuePairAtSeparator(file_owner, '=')
-      (user, group) = owner.split('.', 1)
-      if f[0] == '/':
-        f = f[1:]
-      names_map[f] = (user, group)
+    default_ownername = tuple(options.owner_name.split('.', 1))
 
   default_ids = options.owner.split('.', 1)
   default_ids = (int(default_ids[0]), int(default_ids[1]))
-  ids_map = {}
-  if options.owners:
-    for file_owner in options.owners:
-      (f, owner) = helpers.SplitNameValuePairAtSeparator(file_owner, '=')
-      (user, group) = owner.split('.', 1)
-      if f[0] == '/':
-        f = f[1:]
-      ids_map[f] = (int(user), int(group))
+
+  attribute_rules = AttributeRules(default_mode, default_ids, default_ownername)
+  for path in options.attribute_rules or []:
+    attribute_rules.load(path)
+  for attribute, values in (('mode', options.modes),
+                            ('owner', options.owners),
+                            ('owner_name', options.owner_names)):
+    if values:
+      attribute_rules.add(attribute, {'paths': dict(
+          helpers.SplitNameValuePairAtSeparator(value, '=')
+          for value in values)})
 
   default_mtime = options.mtime
   if options.stamp_from:
@@ -482,20 +723,16 @@ def main():
       allow_dups_from_deps=options.allow_dups_from_deps,
       compression_level = compression_level,
       preserve_mode = options.preserve_mode,
-      preserve_mtime = options.preserve_mtime) as output:
-
-    def file_attributes(filename):
-      if filename.startswith('/'):
-        filename = filename[1:]
-      return {
-          'mode': mode_map.get(filename, default_mode),
-          'ids': ids_map.get(filename, default_ids),
-          'names': names_map.get(filename, default_ownername),
-      }
+      preserve_mtime = options.preserve_mtime,
+      compression_threads = options.compression_threads,
+      zstd_path = options.zstd,
+      incremental_dir = options.incremental_dir,
+      incremental_max_mb = options.incremental_max_mb,
+      member_digests = options.member_digests) as output:
 
     if options.manifest:
-      for entry in manifest.read_entries_from(options.manifest):
-        output.add_manifest_entry(entry, file_attributes)
+      for entry in manifest.iter_entries_from(options.manifest):
+        output.add_manifest_entry(entry, attribute_rules.file_attributes)
 
     for tar in options.tar or []:
       output.add_tar(tar)
@@ -504,4 +741,4 @@ def main():
 
 
 if __name__ == '__main__':
-  main()
+  persistent_worker.main_or_worker(main)
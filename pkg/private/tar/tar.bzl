@@ -13,6 +13,7 @@
 # limitations under the License.
 """Rules for making .tar files."""
 
+load("@bazel_skylib//rules:common_settings.bzl", "BuildSettingInfo")
 load("//pkg:providers.bzl", "PackageVariablesInfo")
 load(
     "//pkg/private:pkg_files.bzl",
@@ -37,6 +38,11 @@ tar_filetype = (
 SUPPORTED_TAR_COMPRESSIONS = (
     ["", "gz", "bz2", "xz"] if HAS_XZ_SUPPORT else ["", "gz", "bz2"]
 )
+
+# Compressions which pkg_tar can write, but not read back through deps.
+_WRITE_ONLY_TAR_COMPRESSIONS = ["zst"]
+_ZSTD_TOOLCHAIN_TYPE = "@rules_pkg//toolchains/zstd:zstd_toolchain_type"
+
 _DEFAULT_MTIME = -1
 
 def _remap(remap_paths, path):
@@ -46,15 +52,12 @@ def _remap(remap_paths, path):
             return replacement + path[len(prefix):]
     return path
 
-def _quote(filename, protect = "="):
-    """Quote the filename, by escaping = by \\= and \\ by \\\\"""
-    return filename.replace("\\", "\\\\").replace(protect, "\\" + protect)
-
 def _pkg_tar_impl(ctx):
     """Implementation of the pkg_tar rule."""
 
     # Files needed by rule implementation at runtime
     files = []
+    tools = [ctx.executable.compressor] if ctx.executable.compressor else []
     outputs, output_file, _ = setup_output_files(ctx)
 
     # Start building the arguments.
@@ -89,11 +92,22 @@ def _pkg_tar_impl(ctx):
                 compression = "gz"
             if compression == "txz":
                 compression = "xz"
+            if compression == "tzst":
+                compression = "zst"
             if compression:
-                if compression in SUPPORTED_TAR_COMPRESSIONS:
+                if compression in SUPPORTED_TAR_COMPRESSIONS + _WRITE_ONLY_TAR_COMPRESSIONS:
                     args.add("--compression", compression)
                 else:
                     fail("Unsupported compression: '%s'" % compression)
+            if compression == "zst":
+                zstd_toolchain = ctx.toolchains[_ZSTD_TOOLCHAIN_TYPE]
+                if zstd_toolchain and zstd_toolchain.zstd.valid:
+                    if zstd_toolchain.zstd.path:
+                        args.add("--zstd", zstd_toolchain.zstd.path)
+                    else:
+                        zstd_binary = zstd_toolchain.zstd.label[DefaultInfo].files_to_run
+                        args.add("--zstd", zstd_binary.executable.path)
+                        tools.append(zstd_binary)
 
     if ctx.attr.mtime != _DEFAULT_MTIME:
         if ctx.attr.portable_mtime:
@@ -101,20 +115,28 @@ def _pkg_tar_impl(ctx):
         args.add("--mtime", "%d" % ctx.attr.mtime)
     if ctx.attr.portable_mtime:
         args.add("--mtime", "portable")
+    if ctx.file.attribute_rules:
+        args.add("--attribute_rules", ctx.file.attribute_rules.path)
+        files.append(ctx.file.attribute_rules)
+
+    # The per file attributes go in one file rather than one flag per file,
+    # which is much faster to parse when there are many.
+    attribute_rules = {}
     if ctx.attr.modes:
-        for key in ctx.attr.modes:
-            args.add("--modes", "%s=%s" % (_quote(key), ctx.attr.modes[key]))
+        attribute_rules["mode"] = {"paths": ctx.attr.modes}
     if ctx.attr.owners:
-        for key in ctx.attr.owners:
-            args.add("--owners", "%s=%s" % (_quote(key), ctx.attr.owners[key]))
+        attribute_rules["owner"] = {"paths": ctx.attr.owners}
     if ctx.attr.ownernames:
-        for key in ctx.attr.ownernames:
-            args.add(
-                "--owner_names",
-                "%s=%s" % (_quote(key), ctx.attr.ownernames[key]),
-            )
+        attribute_rules["owner_name"] = {"paths": ctx.attr.ownernames}
+    if attribute_rules:
+        attribute_rules_file = ctx.actions.declare_file(ctx.label.name + ".attributes.json")
+        ctx.actions.write(attribute_rules_file, json.encode(attribute_rules))
+        args.add("--attribute_rules", attribute_rules_file.path)
+        files.append(attribute_rules_file)
     if ctx.attr.compression_level >= 0:
         args.add("--compression_level", str(ctx.attr.compression_level))
+    if ctx.attr.compression_threads > 1:
+        args.add("--compression_threads", str(ctx.attr.compression_threads))
 
     # Now we begin processing the files.
     path_mapper = None
@@ -172,7 +194,10 @@ def _pkg_tar_impl(ctx):
     args.add("--manifest", manifest_file.path)
 
     args.set_param_file_format("flag_per_line")
-    args.use_param_file("@%s", use_always = False)
+
+    # Persistent workers receive their arguments through a params file, so
+    # always write one.
+    args.use_param_file("@%s", use_always = True)
 
     if ctx.attr.create_parents:
         args.add("--create_parents")
@@ -191,20 +216,33 @@ def _pkg_tar_impl(ctx):
         transitive = mapping_context.file_deps_transitive,
     )
 
+    action_outputs = [output_file]
+    output_groups = {"manifest": [manifest_file]}
+    if ctx.attr.member_digests:
+        digests_file = ctx.actions.declare_file(ctx.label.name + ".digests")
+        args.add("--member_digests", digests_file.path)
+        action_outputs.append(digests_file)
+        output_groups["member_digests"] = [digests_file]
+
     ctx.actions.run(
         mnemonic = "PackageTar",
         progress_message = "Writing: %s" % output_file.path,
         inputs = inputs,
-        tools = [ctx.executable.compressor] if ctx.executable.compressor else [],
+        tools = tools,
         executable = ctx.executable._build_tar,
         arguments = [args],
-        outputs = [output_file],
+        outputs = action_outputs,
         env = {
             "LANG": "en_US.UTF-8",
             "LC_CTYPE": "UTF-8",
             "PYTHONIOENCODING": "UTF-8",
             "PYTHONUTF8": "1",
         },
+        execution_requirements = {
+            "requires-worker-protocol": "json",
+            "supports-multiplex-workers": "1",
+            "supports-workers": "1",
+        },
         use_default_shell_env = True,
     )
     return [
@@ -216,9 +254,7 @@ def _pkg_tar_impl(ctx):
         # The format of this file is subject to change without notice,
         # or this OutputGroup might be totally removed.
         # Depend on it at your own risk!
-        OutputGroupInfo(
-            manifest = [manifest_file],
-        ),
+        OutputGroupInfo(**output_groups),
     ]
 
 # A rule for creating a tar file, see README.md
@@ -251,6 +287,23 @@ pkg_tar_impl = rule(
         ),
         "mode": attr.string(default = "0555"),
         "modes": attr.string_dict(),
+        "attribute_rules": attr.label(
+            doc = """JSON file of mode and owner rules for files in the tar.
+
+The file maps each attribute, `"mode"` (octal), `"owner"` (`"uid.gid"`) or
+`"owner_name"` (`"user.group"`), to rules of three kinds:
+
+- `"paths"`: `{path: value}` for exact paths.
+- `"prefixes"`: `{directory: value}` for a directory and everything below it.
+- `"globs"`: `[[pattern, value], ...]` fnmatch patterns, where `*` also matches `/`.
+  The first matching pattern applies.
+
+An exact path wins over the deepest matching prefix, which wins over the
+patterns. `modes`, `owners` and `ownernames` take precedence over this file,
+and attributes set through `pkg_attributes` over both.
+""",
+            allow_single_file = [".json"],
+        ),
         "mtime": attr.int(default = _DEFAULT_MTIME),
         "portable_mtime": attr.bool(default = True),
         "owner": attr.string(
@@ -262,9 +315,12 @@ pkg_tar_impl = rule(
         "ownernames": attr.string_dict(),
         "extension": attr.string(
             default = "tar",
-            doc = """The extension of the generated file. If `"gz"`, `"bz2"`, or `"xz"`, the
+            doc = """The extension of the generated file. If `"gz"`, `"bz2"`, `"xz"` or `"zst"`, the
 tarball will also be compressed using that tool, and is mutually exclusive with `compressor`.
 Note that `xz` may not be supported based on the Python toolchain.
+`zst` uses the zstd binary from the optional `@rules_pkg//toolchains/zstd:zstd_toolchain_type`
+toolchain if one is registered, and otherwise the Python zstandard module. The build fails if
+neither is available.
 """,
         ),
         "symlinks": attr.string_dict(),
@@ -283,12 +339,28 @@ Note that `xz` may not be supported based on the Python toolchain.
         "compressor_args": attr.string(
             doc = """Arg list for `compressor`.""",
         ),
+        "member_digests": attr.bool(
+            doc = """Record the MD5 and SHA-256 of every file in the archive while
+            writing it, in the `member_digests` output group. pkg_deb uses them
+            as the `md5sums` of the package when this tar is its `data`.""",
+            default = False,
+        ),
         "create_parents": attr.bool(default = True),
         "allow_duplicates_from_deps": attr.bool(default = False),
         "compression_level": attr.int(
-            doc = """Specify the numeric compression level in gzip mode; may be 0-9 or -1 (default to 6).""",
+            doc = """Specify the numeric compression level in gzip mode; may be 0-9 or -1 (default to 6).
+            In zst mode it may be 1-19 or -1 (default to 3).""",
             default = -1,
         ),
+        "compression_threads": attr.int(
+            doc = """Number of threads used to compress the archive in gzip, xz or zst mode.
+
+            With more than one thread the archive is compressed in independent
+            blocks, like pigz, xz -T or zstd -T do. The output is the same for any
+            value above 1, but differs from the output with a single thread.
+            """,
+            default = 1,
+        ),
 
         # Common attributes
         "out": attr.output(mandatory = True),
@@ -327,6 +399,10 @@ builds were accidentally doing it. Never explicitly set this to true for new cod
         "private_stamp_detect": attr.bool(default = False),
 
         # Implicit dependencies.
+        "_manifest_format": attr.label(
+            default = Label("//pkg:manifest_format"),
+            providers = [BuildSettingInfo],
+        ),
         "_build_tar": attr.label(
             default = Label("//pkg/private/tar:build_tar"),
             cfg = "exec",
@@ -334,12 +410,22 @@ builds were accidentally doing it. Never explicitly set this to true for new cod
             allow_files = True,
         ),
     },
+    toolchains = [
+        config_common.toolchain_type(_ZSTD_TOOLCHAIN_TYPE, mandatory = False),
+    ],
 )
 
 # buildifier: disable=function-docstring-args
 def pkg_tar(name, **kwargs):
     """Creates a .tar file. See pkg_tar_impl.
 
+    Uncompressed tars can be rebuilt incrementally, copying the members
+    which did not change from the previous output: set the
+    `RULES_PKG_TAR_INCREMENTAL_DIR` environment variable of the action,
+    e.g. with `--action_env=RULES_PKG_TAR_INCREMENTAL_DIR=/var/cache/pkg_tar`,
+    to a directory outside of the sandbox which the action can write to.
+    The output is the same as that of a full rebuild.
+
     @wraps(pkg_tar_impl)
     """
 
@@ -13,11 +13,21 @@
 # limitations under the License.
 """Tar writing helper."""
 
+import abc
+import array
+import collections
+import concurrent.futures
+import copy
 import gzip
+import hashlib
 import io
+import json
 import os
+import struct
 import subprocess
+import sys
 import tarfile
+import zlib
 
 try:
   import lzma  # pylint: disable=g-import-not-at-top, unused-import
@@ -25,16 +35,57 @@ try:
 except ImportError:
   HAS_LZMA = False
 
+try:
+  import fcntl  # pylint: disable=g-import-not-at-top
+except ImportError:
+  fcntl = None
+
+try:
+  import zstandard  # pylint: disable=g-import-not-at-top
+  HAS_ZSTD = True
+except ImportError:
+  HAS_ZSTD = False
+
 # This is slightly a lie. We do support xz fallback through the xz tool, but
 # that is fragile. Users should stick to the expectations provided here.
 COMPRESSIONS = ('', 'gz', 'bz2', 'xz') if HAS_LZMA else ('', 'gz', 'bz2')
 
+# Compressions we can write but not read back, so they can not be used for
+# archives merged with add_tar(). zst falls back to the zstd tool if the
+# zstandard module is missing.
+WRITE_ONLY_COMPRESSIONS = ('zst',)
+
 # Use a deterministic mtime that doesn't confuse other programs.
 # See: https://github.com/bazelbuild/bazel/issues/1299
 PORTABLE_MTIME = 946684800  # 2000-01-01 00:00:00.000 UTC
 
 _DEBUG_VERBOSITY = 0
 
+# Block size for parallel gzip compression. This is the pigz default.
+_GZIP_BLOCK_SIZE = 128 * 1024
+# Size of the deflate window, which bounds the useful preset dictionary.
+_DEFLATE_WINDOW_SIZE = 32 * 1024
+# Uncompressed bytes queued for parallel compression beyond the blocks the
+# threads are working on.
+_MAX_QUEUED_BYTES = 16 * 1024 * 1024
+
+# Default zstd level, the same as the zstd tool, and the highest level that
+# does not require --ultra.
+_ZSTD_DEFAULT_LEVEL = 3
+_ZSTD_MAX_LEVEL = 19
+# Window for long distance matching. This is the zstd --long default, and
+# the largest window decoders accept without extra flags.
+_ZSTD_LONG_WINDOW_LOG = 27
+
+# Read size used when hashing or copying member contents.
+_COPY_CHUNK_SIZE = 1024 * 1024
+
+# ioctl to share a range of blocks between two files, from linux/fs.h.
+_FICLONERANGE = 0x4020940d
+
+# Version of the incremental rebuild index format.
+_INDEX_VERSION = 1
+
 TARFILE_MEMBER_TYPE_TO_STR = {
     b"0": "REGTYPE",
     b"\0": "AREGTYPE",
@@ -48,6 +99,594 @@ TARFILE_MEMBER_TYPE_TO_STR = {
 }
 
 
+class _ParallelCompressedFile(abc.ABC):
+  """Base class for write-only streams compressed in blocks on a thread pool.
+
+  The uncompressed stream is cut into fixed size blocks which are compressed
+  concurrently by _compress_block(), then written in order by _write_block().
+  Subclasses provide the container format around the blocks. Compression
+  libraries release the GIL, so the blocks really are compressed in parallel.
+
+  One block per thread is in flight, plus queued blocks up to twice the
+  number of threads and _MAX_QUEUED_BYTES in total, but at least one. At
+  peak, memory use is therefore about that many blocks, uncompressed and
+  compressed, plus the previous block, plus the state of one encoder per
+  thread. For xz at preset 6, with 24 MiB blocks and encoders of about
+  94 MiB, that is 2 * (threads + 1) * 24 MiB + threads * 94 MiB, e.g. about
+  1.2 GiB for 8 threads, much like xz -T8. For gzip, with 128 KiB blocks and
+  small encoders, it stays below 2 * (2 * threads + 1) * 128 KiB.
+  """
+
+  def __init__(self, filename, threads, block_size, fileobj=None):
+    self.name = filename
+    self.block_size = block_size
+    threads = threads or os.cpu_count() or 1
+    self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+    # Bound the blocks in flight, by count and by size, to keep memory use
+    # constant.
+    self._max_pending = threads + min(
+        threads, max(1, _MAX_QUEUED_BYTES // block_size))
+    self._pending = collections.deque()
+    self._buffer = bytearray()
+    self._previous_block = b''
+    self._size = 0
+    # A file object passed in is written from its current position and left
+    # open.
+    self._close_fileobj = fileobj is None
+    self.fileobj = fileobj or open(filename, 'wb')
+
+  @abc.abstractmethod
+  def _compress_block(self, block, previous_block, last):
+    """Compresses one block. Runs on the thread pool."""
+
+  def _write_block(self, compressed):
+    self.fileobj.write(compressed)
+
+  def _write_trailer(self):
+    pass
+
+  def _submit(self, block, last=False):
+    self._pending.append(self._executor.submit(
+        self._compress_block, block, self._previous_block, last))
+    self._previous_block = block
+    while len(self._pending) > self._max_pending:
+      self._write_block(self._pending.popleft().result())
+
+  def write(self, data):
+    self._size += len(data)
+    self._buffer += data
+    while len(self._buffer) >= self.block_size:
+      block = bytes(self._buffer[:self.block_size])
+      del self._buffer[:self.block_size]
+      self._submit(block)
+    return len(data)
+
+  def tell(self):
+    return self._size
+
+  def close(self):
+    if self.fileobj is None:
+      return
+    try:
+      self._submit(bytes(self._buffer), last=True)
+      self._buffer = None
+      while self._pending:
+        self._write_block(self._pending.popleft().result())
+      self._write_trailer()
+    finally:
+      self._executor.shutdown(wait=True)
+      if self._close_fileobj:
+        self.fileobj.close()
+      self.fileobj = None
+
+
+class ParallelGzipFile(_ParallelCompressedFile):
+  """A write-only gzip stream which deflates blocks on a thread pool.
+
+  Each block is deflated independently, primed with the last 32 KiB of the
+  previous block as preset dictionary, and ended with a sync flush so that
+  the compressed blocks can be concatenated into a single deflate stream.
+
+  The output only depends on the input, the compression level and the block
+  size, not on the number of threads or on scheduling, so it is reproducible.
+  """
+
+  def __init__(self, filename, compresslevel=6, mtime=0, threads=None,
+               block_size=_GZIP_BLOCK_SIZE, fileobj=None):
+    """Open filename for writing.
+
+    Args:
+      filename: the output file name.
+      compresslevel: zlib compression level, 0-9.
+      mtime: modification time to put in the gzip header.
+      threads: number of compression threads, default to the number of CPUs.
+      block_size: size of the uncompressed blocks.
+      fileobj: file object to write to instead of creating filename.
+    """
+    super(ParallelGzipFile, self).__init__(filename, threads, block_size,
+                                           fileobj)
+    self.compresslevel = compresslevel
+    self._crc = 0
+    self._write_header(filename, compresslevel, mtime)
+
+  def _write_header(self, filename, compresslevel, mtime):
+    # Same header as gzip.GzipFile, so tools see no difference.
+    fname = os.path.basename(filename).encode('latin-1')
+    if fname.endswith(b'.gz'):
+      fname = fname[:-3]
+    flags = gzip.FNAME if fname else 0
+    if compresslevel == 9:
+      xfl = 2
+    elif compresslevel == 1:
+      xfl = 4
+    else:
+      xfl = 0
+    self.fileobj.write(b'\037\213\010' + bytes([flags]))
+    self.fileobj.write(struct.pack('<L', int(mtime)))
+    self.fileobj.write(bytes([xfl]) + b'\377')
+    if fname:
+      self.fileobj.write(fname + b'\000')
+
+  def _compress_block(self, block, previous_block, last):
+    dictionary = previous_block[-_DEFLATE_WINDOW_SIZE:]
+    if dictionary:
+      compressor = zlib.compressobj(
+          self.compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS,
+          zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, dictionary)
+    else:
+      compressor = zlib.compressobj(
+          self.compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(
+        zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+  def write(self, data):
+    self._crc = zlib.crc32(data, self._crc)
+    return super(ParallelGzipFile, self).write(data)
+
+  def _write_trailer(self):
+    self.fileobj.write(struct.pack('<LL', self._crc, self._size & 0xffffffff))
+
+
+def _xz_multibyte(value):
+  """Encodes an integer in the .xz variable length format."""
+  encoded = bytearray()
+  while value >= 0x80:
+    encoded.append((value & 0x7f) | 0x80)
+    value >>= 7
+  encoded.append(value)
+  return bytes(encoded)
+
+
+def _xz_padding(size):
+  return b'\0' * (-size % 4)
+
+
+class ParallelXzFile(_ParallelCompressedFile):
+  """A write-only .xz stream which compresses blocks on a thread pool.
+
+  Each block is LZMA2 compressed independently and written as one block of a
+  single .xz stream, followed by the index of all blocks. Block headers
+  record the compressed and uncompressed sizes, so readers can seek to a
+  block and decompress blocks in parallel, like with the output of xz -T.
+
+  The output only depends on the input, the preset and the block size, not on
+  the number of threads or on scheduling, so it is reproducible.
+  See https://tukaani.org/xz/xz-file-format.txt for the format.
+  """
+
+  _MAGIC = b'\xfd7zXZ\0'
+  _FOOTER_MAGIC = b'YZ'
+  _STREAM_FLAGS = b'\0\x01'  # CRC32 check
+  _LZMA2_FILTER_ID = 0x21
+  # Dictionary sizes of the xz presets 0-9.
+  _PRESET_DICT_SIZES = (
+      1 << 18, 1 << 20, 1 << 21, 1 << 22, 1 << 22,
+      1 << 23, 1 << 23, 1 << 24, 1 << 25, 1 << 26)
+
+  def __init__(self, filename, preset=6, threads=None, block_size=None,
+               fileobj=None):
+    """Open filename for writing.
+
+    Args:
+      filename: the output file name.
+      preset: xz compression preset, 0-9.
+      threads: number of compression threads, default to the number of CPUs.
+      block_size: size of the uncompressed blocks. The default, three times
+          the dictionary size, is the same as for xz -T.
+      fileobj: file object to write to instead of creating filename.
+    """
+    dict_size = self._PRESET_DICT_SIZES[preset]
+    super(ParallelXzFile, self).__init__(
+        filename, threads, block_size or 3 * dict_size, fileobj)
+    self._filters = [{'id': lzma.FILTER_LZMA2, 'preset': preset,
+                      'dict_size': dict_size}]
+    self._dict_size_property = self._encode_dict_size(dict_size)
+    self._records = []
+    self.fileobj.write(self._MAGIC + self._STREAM_FLAGS +
+                       struct.pack('<L', zlib.crc32(self._STREAM_FLAGS)))
+
+  @staticmethod
+  def _encode_dict_size(dict_size):
+    # LZMA2 encodes the dictionary size as 2^n or 3 * 2^(n-1).
+    for bits in range(40):
+      if ((2 | (bits & 1)) << (bits // 2 + 11)) >= dict_size:
+        return bits
+    return 40
+
+  def _compress_block(self, block, previous_block, last):
+    if not block:
+      return None
+    compressed = lzma.compress(
+        block, format=lzma.FORMAT_RAW, filters=self._filters)
+    header = bytearray()
+    header.append(0)  # Header size, filled in below.
+    header.append(0x40 | 0x80)  # One filter, both sizes present.
+    header += _xz_multibyte(len(compressed))
+    header += _xz_multibyte(len(block))
+    header += _xz_multibyte(self._LZMA2_FILTER_ID)
+    header += _xz_multibyte(1)
+    header.append(self._dict_size_property)
+    header += _xz_padding(len(header) + 4)
+    header[0] = (len(header) + 4) // 4 - 1
+    header += struct.pack('<L', zlib.crc32(header))
+    check = struct.pack('<L', zlib.crc32(block))
+    unpadded_size = len(header) + len(compressed) + len(check)
+    return (bytes(header) + compressed + _xz_padding(len(compressed)) + check,
+            unpadded_size, len(block))
+
+  def _write_block(self, compressed):
+    if compressed is None:
+      return
+    data, unpadded_size, uncompressed_size = compressed
+    self.fileobj.write(data)
+    self._records.append((unpadded_size, uncompressed_size))
+
+  def _write_trailer(self):
+    index = bytearray(b'\0')
+    index += _xz_multibyte(len(self._records))
+    for unpadded_size, uncompressed_size in self._records:
+      index += _xz_multibyte(unpadded_size)
+      index += _xz_multibyte(uncompressed_size)
+    index += _xz_padding(len(index))
+    index += struct.pack('<L', zlib.crc32(index))
+    self.fileobj.write(index)
+    backward_size = struct.pack('<L', len(index) // 4 - 1)
+    self.fileobj.write(
+        struct.pack('<L', zlib.crc32(backward_size + self._STREAM_FLAGS)) +
+        backward_size + self._STREAM_FLAGS + self._FOOTER_MAGIC)
+
+
+def _clone_range(src_fd, dst_fd, offset, size):
+  """Appends a range of src_fd to dst_fd by sharing its blocks (reflink).
+
+  Returns:
+    True if the range was cloned. This needs a file system that supports
+    FICLONERANGE, like btrfs or XFS, and block aligned offsets.
+  """
+  if fcntl is None or not sys.platform.startswith('linux'):
+    return False
+  dst_offset = os.lseek(dst_fd, 0, os.SEEK_CUR)
+  block_size = os.fstat(dst_fd).st_blksize
+  if offset % block_size or dst_offset % block_size:
+    return False
+  # Only stat the source, which may be remote, when the alignment allows.
+  if size % block_size and offset + size != os.fstat(src_fd).st_size:
+    return False
+  try:
+    fcntl.ioctl(dst_fd, _FICLONERANGE,
+                struct.pack('qQQQ', src_fd, offset, size, dst_offset))
+  except OSError:
+    return False
+  os.lseek(dst_fd, dst_offset + size, os.SEEK_SET)
+  return True
+
+
+def copy_file_range(src, dst, offset, size):
+  """Appends size bytes of src, starting at offset, to dst.
+
+  Tries, in order, to clone the range with FICLONERANGE, to copy it with
+  os.copy_file_range() or os.sendfile(), so that the data does not go
+  through user space, and falls back to a plain copy.
+
+  Args:
+    src: file object to copy from. Its position is not used.
+    dst: buffered file object to append to. It is left positioned at the end
+        of the copied data.
+  """
+  dst.flush()
+  src_fd = src.fileno()
+  dst_fd = dst.fileno()
+  end = offset + size
+  if size and _clone_range(src_fd, dst_fd, offset, size):
+    offset = end
+  for fast_copy in (getattr(os, 'copy_file_range', None),
+                    getattr(os, 'sendfile', None)):
+    if fast_copy is None or offset == end:
+      continue
+    try:
+      while offset < end:
+        if fast_copy is os.sendfile:
+          copied = fast_copy(dst_fd, src_fd, offset, end - offset)
+        else:
+          copied = fast_copy(src_fd, dst_fd, end - offset, offset)
+        if copied == 0:
+          break
+        offset += copied
+    except OSError:
+      # Not supported between these files, e.g. across file systems on
+      # older kernels. Try the next method from where we stopped.
+      continue
+  # Resynchronize the buffered writer with the descriptor we wrote to.
+  dst.seek(0, os.SEEK_END)
+  if offset < end:
+    src.seek(offset)
+    tarfile.copyfileobj(src, dst, end - offset, bufsize=_COPY_CHUNK_SIZE)
+
+
+def _has_fileno(fileobj):
+  """Returns whether fileobj is backed by a file descriptor."""
+  try:
+    fileobj.fileno()
+  except (AttributeError, io.UnsupportedOperation):
+    return False
+  return True
+
+
+def _copy_stream(src, dst):
+  """Copies src to dst until the end of src, then closes src.
+
+  src is closed on errors too, so that a process writing to it fails
+  instead of waiting for a reader.
+  """
+  with src:
+    for chunk in iter(lambda: src.read(_COPY_CHUNK_SIZE), b''):
+      dst.write(chunk)
+
+
+def clone_file(src_path, dst_path):
+  """Creates dst_path sharing all the blocks of src_path (reflink).
+
+  Returns:
+    True if the file was cloned. Otherwise, dst_path is not created.
+  """
+  with open(src_path, 'rb') as src:
+    size = os.fstat(src.fileno()).st_size
+    with open(dst_path, 'wb') as dst:
+      cloned = _clone_range(src.fileno(), dst.fileno(), 0, size)
+  if not cloned:
+    os.remove(dst_path)
+  return cloned
+
+
+def _file_digest(path):
+  """Returns the sha256 hex digest of the file at path."""
+  sha = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(_COPY_CHUNK_SIZE), b''):
+      sha.update(chunk)
+  return sha.hexdigest()
+
+
+class _DigestingReader(object):
+  """Reads a file object, computing the MD5 and SHA-256 of what was read."""
+
+  def __init__(self, fileobj):
+    self._fileobj = fileobj
+    self.md5 = hashlib.md5()
+    self.sha256 = hashlib.sha256()
+
+  def read(self, size=-1):
+    data = self._fileobj.read(size)
+    self.md5.update(data)
+    self.sha256.update(data)
+    return data
+
+
+class _DiscardingList(list):
+  """A list that ignores appends, to stop tarfile from caching members."""
+
+  def append(self, item):
+    pass
+
+
+# Member types as stored in _MemberIndex, by their byte value.
+_MEMBER_TYPES = tuple(bytes((i,)) for i in range(256))
+# Number of members _MemberIndex keeps in a plain dict, about 8 MiB worth,
+# before it packs them.
+_MEMBER_INDEX_DICT_SIZE = 1 << 16
+
+
+class _MemberIndex(object):
+  """Types of the members written so far, keyed by path.
+
+  This behaves like a dict from member name (without trailing slashes) to
+  tarfile member type. Up to _MEMBER_INDEX_DICT_SIZE members, it is one.
+  Past that, the members are packed so that no Python object is held per
+  member, and the index stays small for archives with millions of members:
+    - the parent directories of the members, which are few, are interned
+      and numbered through the dict _dir_ids. They are kept with their
+      trailing '/', so that 'a' and '/a' differ,
+    - member n has the number of its parent directory, the low 32 bits of
+      the hash of its key and its type at index n of _member_dirs, _hashes and _types. Its last
+      path component is stored UTF-8 encoded in _name_data, and spans
+      _name_offsets[n]:_name_offsets[n + 1],
+    - members are found through an open addressing table of member numbers,
+      _slots, hashed on (parent directory, last component). Lookups compare
+      the stored component, so they are exact.
+  Parent directory checks do not touch the arrays: the directories known to
+  be members are kept in the set _dirs, and the parent of the last path
+  whose parents all exist is remembered, as files are mostly added next to
+  each other.
+  """
+
+  def __init__(self):
+    # The members while there are few, None once they are packed.
+    self._small = {}
+    self._dir_ids = {}
+    self._dir_paths = []
+    self._member_dirs = array.array('I')
+    self._hashes = array.array('I')
+    self._types = array.array('B')
+    self._name_data = bytearray()
+    self._name_offsets = array.array('Q', [0])
+    # Member number + 1, or 0 for an empty slot.
+    self._slot_bits = 10
+    self._slots = array.array('I', [0]) * (1 << self._slot_bits)
+    self._dirs = set()
+    # Parent directory of the last path whose parents all exist.
+    self._last_complete_parent = None
+
+  def _find(self, dir_id, name, key_hash):
+    """Returns the slot holding a member, or the empty slot where it goes."""
+    slots = self._slots
+    hashes = self._hashes
+    offsets = self._name_offsets
+    mask = len(slots) - 1
+    i = key_hash & mask
+    while True:
+      slot = slots[i]
+      if not slot:
+        return i
+      if (hashes[slot - 1] == key_hash and
+          self._member_dirs[slot - 1] == dir_id and
+          self._name_data[offsets[slot - 1]:offsets[slot]] == name):
+        return i
+      i = (i + 1) & mask
+
+  def _grow(self):
+    self._slot_bits += 1
+    self._slots = array.array('I', [0]) * (1 << self._slot_bits)
+    mask = len(self._slots) - 1
+    for member, key_hash in enumerate(self._hashes):
+      i = key_hash & mask
+      while self._slots[i]:
+        i = (i + 1) & mask
+      self._slots[i] = member + 1
+
+  def get(self, path, default=None):
+    if self._small is not None:
+      return self._small.get(path, default)
+    cut = path.rfind('/') + 1
+    dir_id = self._dir_ids.get(path[:cut])
+    if dir_id is None:
+      return default
+    name = path[cut:].encode('utf-8', 'surrogateescape')
+    slot = self._slots[self._find(dir_id, name,
+                                  hash((dir_id, name)) & 0xffffffff)]
+    if not slot:
+      return default
+    return _MEMBER_TYPES[self._types[slot - 1]]
+
+  def __contains__(self, path):
+    return self.get(path) is not None
+
+  def __getitem__(self, path):
+    member_type = self.get(path)
+    if member_type is None:
+      raise KeyError(path)
+    return member_type
+
+  def __setitem__(self, path, member_type):
+    if member_type == tarfile.DIRTYPE:
+      self._dirs.add(sys.intern(path))
+    if self._small is not None:
+      self._small[path] = member_type
+      if len(self._small) > _MEMBER_INDEX_DICT_SIZE:
+        self._pack()
+      return
+    self._add(path, member_type)
+
+  def _pack(self):
+    """Moves the members from the dict to the packed arrays."""
+    small = self._small
+    self._small = None
+    while len(small) * 3 > (1 << self._slot_bits) * 2:
+      self._slot_bits += 1
+    self._slots = array.array('I', [0]) * (1 << self._slot_bits)
+    for path, member_type in small.items():
+      self._add(path, member_type)
+
+  def _add(self, path, member_type):
+    # Parent directories (with their trailing '/') key the members.
+    cut = path.rfind('/') + 1
+    parent = path[:cut]
+    dir_id = self._dir_ids.get(parent)
+    if dir_id is None:
+      dir_id = len(self._dir_paths)
+      parent = sys.intern(parent)
+      self._dir_ids[parent] = dir_id
+      self._dir_paths.append(parent)
+    name = path[cut:].encode('utf-8', 'surrogateescape')
+    key_hash = hash((dir_id, name)) & 0xffffffff
+    slots = self._slots
+    i = key_hash & (len(slots) - 1)
+    if slots[i]:
+      i = self._find(dir_id, name, key_hash)
+      if slots[i]:
+        self._types[slots[i] - 1] = ord(member_type)
+        return
+    types = self._types
+    types.append(ord(member_type))
+    self._member_dirs.append(dir_id)
+    self._hashes.append(key_hash)
+    self._name_data += name
+    self._name_offsets.append(len(self._name_data))
+    slots[i] = len(types)
+    if len(types) * 3 > len(slots) * 2:
+      self._grow()
+
+  def __len__(self):
+    if self._small is not None:
+      return len(self._small)
+    return len(self._types)
+
+  def keys(self):
+    """Yields the member paths, in the order they were first seen."""
+    if self._small is not None:
+      yield from self._small
+      return
+    for member, dir_id in enumerate(self._member_dirs):
+      name = self._name_data[self._name_offsets[member]:
+                             self._name_offsets[member + 1]].decode(
+                                 'utf-8', 'surrogateescape')
+      yield self._dir_paths[dir_id] + name
+
+  __iter__ = keys
+
+  def missing_parents(self, path):
+    """Returns the parent directories of path that are not members yet.
+
+    The parents are returned top down, with a trailing '/'. Like
+    TarFileWriter._existing_member_type(), this treats '/' and './' as
+    existing, and strips trailing slashes from each prefix before looking
+    it up.
+    """
+    parent = path.rpartition('/')[0]
+    if parent == self._last_complete_parent:
+      # The common case of siblings: nothing to do.
+      return []
+    missing = []
+    parent_path = ''
+    for component in path.split('/')[:-1]:
+      parent_path += component + '/'
+      if parent_path == '/' or parent_path == './':
+        continue
+      key = parent_path.rstrip('/')
+      if key in self._dirs:
+        continue
+      if self.get(key) is not None:
+        # Some other type of member, e.g. a symlink.
+        self._dirs.add(sys.intern(key))
+        continue
+      if not missing or missing[-1].rstrip('/') != key:
+        missing.append(parent_path)
+    return missing
+
+  def parents_complete(self, path):
+    """Records that all the parent directories of path are members."""
+    self._last_complete_parent = path.rpartition('/')[0]
+
+
 class TarFileWriter(object):
   """A wrapper to write tar files."""
 
@@ -62,18 +701,51 @@ class TarFileWriter(object):
                allow_dups_from_deps=True,
                default_mtime=None,
                preserve_tar_mtimes=True,
-               compression_level=-1):
+               compression_level=-1,
+               compression_threads=1,
+               zstd_path=None,
+               index=None,
+               previous=None,
+               previous_index=None,
+               keep_tarinfo=True,
+               outfile=None,
+               member_digests=None,
+               stat_cache=None):
     """TarFileWriter wraps tarfile.open().
 
     Args:
       name: the tar file name.
-      compression: compression type: bzip2, bz2, gz, tgz, xz, lzma.
+      compression: compression type: bzip2, bz2, gz, tgz, xz, lzma, zst.
       compressor: custom command to do the compression.
       default_mtime: default mtime to use for elements in the archive.
           May be an integer or the value 'portable' to use the date
           2000-01-01, which is compatible with non *nix OSes'.
       preserve_tar_mtimes: if true, keep file mtimes from input tar file.
+      compression_threads: number of threads to compress with. With more
+          than one thread, gz, xz and zst output is compressed in independent
+          blocks. The output is the same for any number of threads above one.
+      zstd_path: zstd tool to use for zst compression. Without it, the
+          zstandard module is used. zst compression fails if neither is
+          available, rather than depend on a zstd found on the host.
+      index: path to write an index of the file members to, for a later
+          incremental rebuild. Uncompressed output only.
+      previous: previously built version of this tar. Members whose header
+          and content are unchanged are copied from it as raw byte ranges.
+          Uncompressed output only.
+      previous_index: the index written along with `previous`.
+      keep_tarinfo: keep the TarInfo of every member written in
+          self.tar.members, as tarfile does. Turn it off for archives with
+          millions of members.
+      outfile: binary file object, open for writing, to write the tar to
+          instead of creating `name`. The tar starts at the current position
+          of outfile, which is left open, positioned at the end of the tar.
+      member_digests: path to write the digests of the regular file members
+          to, one "<md5> <sha256> <name>" line each, computed while their
+          content is written. Not available with incremental rebuilds.
+      stat_cache: a stat_cache.StatCache to take the size of added files
+          from, instead of a stat of each.
     """
+    self.stat_cache = stat_cache
     self.preserve_mtime = preserve_tar_mtimes
     if default_mtime is None:
       self.default_mtime = 0
@@ -92,42 +764,214 @@ class TarFileWriter(object):
     # Support xz compression through xz... until we can use Py3
     elif compression in ['xz', 'lzma']:
       compression_level = min(compression_level, 9) if compression_level >= 0 else 6
-      if HAS_LZMA:
+      if HAS_LZMA and compression_threads > 1:
+        mode = 'w:'
+        self.fileobj = ParallelXzFile(
+            name, preset=compression_level, threads=compression_threads,
+            fileobj=outfile)
+      elif HAS_LZMA:
         mode = 'w:xz'
         extra_tar_args['preset'] = compression_level
       else:
         self.compressor_cmd = 'xz -F {} -{} -'.format(compression, compression_level)
     elif compression in ['bzip2', 'bz2']:
       mode = 'w:bz2'
+    elif compression in ['zst', 'zstd']:
+      compression_level = (min(compression_level, _ZSTD_MAX_LEVEL)
+                           if compression_level >= 0 else _ZSTD_DEFAULT_LEVEL)
+      if HAS_ZSTD and not zstd_path:
+        mode = 'w:'
+        # As with the zstd tool, any number of worker threads gives the same
+        # output, which differs from the single threaded one. The parameters
+        # are those the tool sets, down to its frame checksum, so both write
+        # the same bytes when they are built on the same zstd version.
+        params = zstandard.ZstdCompressionParameters(
+            compression_level=compression_level,
+            threads=compression_threads if compression_threads > 1 else 0,
+            enable_ldm=True,
+            window_log=_ZSTD_LONG_WINDOW_LOG,
+            write_checksum=True)
+        self.fileobj = zstandard.ZstdCompressor(
+            compression_params=params).stream_writer(
+                outfile or open(name, 'wb'), closefd=outfile is None)
+      elif zstd_path:
+        # -T1 still runs one worker thread, which compresses differently
+        # from the single threaded mode used by the zstandard module.
+        self.compressor_cmd = '{} -{} {} --long={} -q -c -'.format(
+            zstd_path, compression_level,
+            ('-T%d' % compression_threads if compression_threads > 1
+             else '--single-thread'),
+            _ZSTD_LONG_WINDOW_LOG)
+      else:
+        raise self.Error('zst compression needs the zstandard Python module'
+                         ' or a zstd tool, e.g. from the zstd toolchain')
     else:
       mode = 'w:'
       if compression in ['tgz', 'gz']:
         compression_level = min(compression_level, 9) if compression_level >= 0 else 6
-        # The Tarfile class doesn't allow us to specify gzip's mtime attribute.
-        # Instead, we manually reimplement gzopen from tarfile.py and set mtime.
-        self.fileobj = gzip.GzipFile(
-            filename=name, mode='w', compresslevel=compression_level, mtime=self.default_mtime)
+        if compression_threads > 1:
+          self.fileobj = ParallelGzipFile(
+              name, compresslevel=compression_level, mtime=self.default_mtime,
+              threads=compression_threads, fileobj=outfile)
+        else:
+          # The Tarfile class doesn't allow us to specify gzip's mtime
+          # attribute. Instead, we manually reimplement gzopen from tarfile.py
+          # and set mtime.
+          self.fileobj = gzip.GzipFile(
+              filename=name, mode='w', compresslevel=compression_level,
+              fileobj=outfile, mtime=self.default_mtime)
     self.compressor_proc = None
+    self._compressor_copy = None
     if self.compressor_cmd:
       mode = 'w|'
+      if outfile and _has_fileno(outfile):
+        # The compressor appends to outfile through its own descriptor.
+        outfile.flush()
+        compressor_out = outfile
+      elif outfile:
+        # e.g. a file object that digests what is written to it. Copy the
+        # output of the compressor to it from here.
+        compressor_out = subprocess.PIPE
+      else:
+        compressor_out = open(name, 'wb')
       self.compressor_proc = subprocess.Popen(self.compressor_cmd.split(),
                                               stdin=subprocess.PIPE,
-                                              stdout=open(name, 'wb'))
+                                              stdout=compressor_out)
       self.fileobj = self.compressor_proc.stdin
+      if compressor_out is subprocess.PIPE:
+        self._compressor_copy = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1)
+        self._compressor_copied = self._compressor_copy.submit(
+            _copy_stream, self.compressor_proc.stdout, outfile)
     self.name = name
+    self.outfile = outfile
+    if outfile and mode == 'w:' and not self.fileobj:
+      # tarfile pads the archive to a whole record counting from the start of
+      # its file object, which a stream counts from the start of the tar.
+      mode = 'w|'
 
-    self.tar = tarfile.open(name=name, mode=mode, fileobj=self.fileobj,
+    self.tar = tarfile.open(name=name, mode=mode,
+                            fileobj=self.fileobj or outfile,
                             format=tarfile.GNU_FORMAT, **extra_tar_args)
-    self.existing_members = {}
+    if not keep_tarinfo:
+      self.tar.members = _DiscardingList()
+    self.existing_members = _MemberIndex()
     self.create_parents = create_parents
     self.allow_dups_from_deps = allow_dups_from_deps
 
+    # Whether file contents can be appended to the output file as is.
+    self.raw_output = mode == 'w:' and not self.fileobj and not outfile
+    self.passthrough_members = 0
+    self.index_path = index
+    self.index = None
+    self.previous = None
+    self.previous_members = {}
+    self.reused_members = 0
+    if index or previous:
+      if not self.raw_output:
+        raise self.Error('Incremental rebuilds need an uncompressed tar')
+      if member_digests:
+        raise self.Error('Member digests are not recorded in incremental'
+                         ' rebuilds')
+      self.index = {}
+    self.member_digests = None
+    if member_digests:
+      self.member_digests = open(member_digests, 'w', encoding='utf-8')
+    if previous and previous_index:
+      self.previous_members = self._read_index(previous, previous_index)
+      if self.previous_members:
+        self.previous = open(previous, 'rb')
+
   def __enter__(self):
     return self
 
   def __exit__(self, t, v, traceback):
     self.close()
 
+  @staticmethod
+  def _read_index(previous, previous_index):
+    """Returns the members of the previous tar, or {} if it can't be reused."""
+    try:
+      with open(previous_index, 'r') as f:
+        index = json.load(f)
+      tar_size = os.stat(previous).st_size
+    except (OSError, ValueError):
+      return {}
+    if (not isinstance(index, dict) or index.get('version') != _INDEX_VERSION
+        or index.get('size') != tar_size):
+      return {}
+    return index.get('members', {})
+
+  def _write_index(self):
+    index = {
+        'version': _INDEX_VERSION,
+        'size': os.stat(self.name).st_size,
+        'members': self.index,
+    }
+    with open(self.index_path, 'w') as f:
+      json.dump(index, f, sort_keys=True)
+
+  def _addfile_incremental(self, info, fileobj, digest):
+    """Adds a member, reusing its bytes from the previous tar if unchanged."""
+    header = copy.copy(info).tobuf(self.tar.format, self.tar.encoding,
+                                   self.tar.errors)
+    header_hash = hashlib.sha256(header).hexdigest()
+    blocks, remainder = divmod(info.size, tarfile.BLOCKSIZE)
+    if remainder:
+      blocks += 1
+    size = len(header) + blocks * tarfile.BLOCKSIZE
+    offset = self.tar.offset
+    previous = self.previous_members.get(info.name)
+    if previous and previous == [previous[0], size, digest, header_hash]:
+      copy_file_range(self.previous, self.tar.fileobj, previous[0], size)
+      self.tar.offset += size
+      self.tar.members.append(info)
+      self.reused_members += 1
+    else:
+      self._write_member(info, fileobj)
+    self.index[info.name] = [offset, size, digest, header_hash]
+
+  def _write_member(self, info, fileobj, raw=None):
+    """Writes a member, moving file content kernel side when possible.
+
+    This is tarfile.addfile(), except that for an uncompressed tar the
+    content of a real file is appended with copy_file_range().
+
+    Args:
+      info: TarInfo of the member.
+      fileobj: file object to read the member content from.
+      raw: optional (file, offset, size) range of an uncompressed input tar
+          holding the exact header and data blocks of the member, which are
+          then copied verbatim.
+    """
+    if raw is not None:
+      src, offset, size = raw
+      copy_file_range(src, self.tar.fileobj, offset, size)
+      self.tar.offset += size
+      self.tar.members.append(info)
+      self.passthrough_members += 1
+      return
+    if not self.raw_output or fileobj is None or not info.size:
+      self.tar.addfile(info, fileobj)
+      return
+    try:
+      fileobj.fileno()
+    except (AttributeError, OSError):
+      # In-memory content, or a member of another tar.
+      self.tar.addfile(info, fileobj)
+      return
+    info = copy.copy(info)
+    header = info.tobuf(self.tar.format, self.tar.encoding, self.tar.errors)
+    self.tar.fileobj.write(header)
+    self.tar.offset += len(header)
+    copy_file_range(fileobj, self.tar.fileobj, fileobj.tell(), info.size)
+    blocks, remainder = divmod(info.size, tarfile.BLOCKSIZE)
+    if remainder:
+      self.tar.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+      blocks += 1
+    self.tar.offset += blocks * tarfile.BLOCKSIZE
+    self.tar.members.append(info)
+
   def _existing_member_type(self, path):
     """Retrieve an existing tar file member's type if we have added it previously,
     return None otherwise."""
@@ -140,8 +984,17 @@ class TarFileWriter(object):
     normalized_path = path.rstrip("/")
     return self.existing_members.get(normalized_path, None)
 
-  def _addfile(self, info, fileobj=None):
-    """Add a file in the tar file if there is no conflict."""
+  def _addfile(self, info, fileobj=None, digest=None, raw=None):
+    """Add a file in the tar file if there is no conflict.
+
+    Args:
+      info: TarInfo of the member.
+      fileobj: file object to read the member content from.
+      digest: sha256 of the member content, for incremental rebuilds. Members
+          without one are always written afresh.
+      raw: optional range of an input tar to copy verbatim, see
+          _write_member().
+    """
     if info.type == tarfile.DIRTYPE:
       # Enforce the ending / for directories.
       if not info.name.endswith('/'):
@@ -161,7 +1014,17 @@ class TarFileWriter(object):
 
       return
 
-    self.tar.addfile(info, fileobj)
+    if self.member_digests is not None and info.isreg():
+      # The content has to go through here to be digested.
+      fileobj = _DigestingReader(fileobj or io.BytesIO())
+      raw = None
+    if self.index is not None and digest is not None:
+      self._addfile_incremental(info, fileobj, digest)
+    else:
+      self._write_member(info, fileobj, raw)
+    if isinstance(fileobj, _DigestingReader):
+      self.member_digests.write('%s %s %s\n' % (
+          fileobj.md5.hexdigest(), fileobj.sha256.hexdigest(), info.name))
     # Strip the trailing slash from the path so that we can detect when, for example, we are
     # trying to overwrite a symbolic link with a directory.
     self.existing_members[info.name.rstrip("/")] = info.type
@@ -201,21 +1064,18 @@ class TarFileWriter(object):
     self._addfile(tarinfo)
 
   def conditionally_add_parents(self, path, uid=0, gid=0, uname='', gname='', mtime=0, mode=0o755):
-    dirs = path.split('/')
-    parent_path = ''
-    for next_level in dirs[0:-1]:
-      parent_path = parent_path + next_level + '/'
-
-      if self.create_parents and self._existing_member_type(
-          parent_path) is None:
-        self.add_directory_path(
-          parent_path,
-          uid=uid,
-          gid=gid,
-          uname=uname,
-          gname=gname,
-          mtime=mtime,
-          mode=0o755)
+    if not self.create_parents:
+      return
+    for parent_path in self.existing_members.missing_parents(path):
+      self.add_directory_path(
+        parent_path,
+        uid=uid,
+        gid=gid,
+        uname=uname,
+        gname=gname,
+        mtime=mtime,
+        mode=0o755)
+    self.existing_members.parents_complete(path)
 
   def add_file(self,
                name,
@@ -275,21 +1135,54 @@ class TarFileWriter(object):
     if content:
       content_bytes = content.encode('utf-8')
       tarinfo.size = len(content_bytes)
-      self._addfile(tarinfo, io.BytesIO(content_bytes))
+      digest = None
+      if self.index is not None:
+        digest = hashlib.sha256(content_bytes).hexdigest()
+      self._addfile(tarinfo, io.BytesIO(content_bytes), digest=digest)
     elif file_content:
+      digest = None
+      if self.index is not None:
+        digest = _file_digest(file_content)
       with open(file_content, 'rb') as f:
-        tarinfo.size = os.fstat(f.fileno()).st_size
-        self._addfile(tarinfo, f)
+        if self.stat_cache:
+          tarinfo.size = self.stat_cache.stat(file_content).st_size
+        else:
+          tarinfo.size = os.fstat(f.fileno()).st_size
+        self._addfile(tarinfo, f, digest=digest)
     else:
       self._addfile(tarinfo)
 
+  def _passthrough_range(self, intar, tarinfo):
+    """Returns the range of intar to copy for an unchanged member, or None.
+
+    A member is unchanged when no rename, owner remapping or mtime reset
+    applies to it, which is exactly when encoding its TarInfo again gives
+    back the header blocks it was read from.
+    """
+    if tarinfo.issparse():
+      return None
+    header = copy.copy(tarinfo).tobuf(self.tar.format, self.tar.encoding,
+                                      self.tar.errors)
+    if len(header) != tarinfo.offset_data - tarinfo.offset:
+      return None
+    position = intar.fileobj.tell()
+    intar.fileobj.seek(tarinfo.offset)
+    original = intar.fileobj.read(len(header))
+    intar.fileobj.seek(position)
+    if original != header:
+      return None
+    blocks = -(-tarinfo.size // tarfile.BLOCKSIZE)
+    return (intar.fileobj, tarinfo.offset,
+            len(header) + blocks * tarfile.BLOCKSIZE)
+
   def add_tar(self,
               tar,
               rootuid=None,
               rootgid=None,
               numeric=False,
               name_filter=None,
-              prefix=None):
+              prefix=None,
+              fileobj=None):
     """Merge a tar content into the current tar, stripping timestamp.
 
     Args:
@@ -302,6 +1195,8 @@ class TarFileWriter(object):
           called for each file to add, given the name and should return true if
           the file is to be added to the final tar and false otherwise.
       prefix: prefix to add to all file paths.
+      fileobj: if set, read the tar from this seekable file object rather
+          than from the file named `tar`.
 
     Raises:
       TarFileWriter.Error: if an error happens when uncompressing the tar file.
@@ -310,8 +1205,15 @@ class TarFileWriter(object):
       prefix = prefix.strip('/') + '/'
     if _DEBUG_VERBOSITY > 1:
       print('==========================  prefix is', prefix)
-    intar = tarfile.open(name=tar, mode='r:*')
-    for tarinfo in intar:
+    intar = tarfile.open(name=tar, fileobj=fileobj, mode='r:*')
+    # Iterating over a TarFile keeps every TarInfo read. Merged archives can
+    # be huge, so read them one at a time instead.
+    intar.members = _DiscardingList()
+    # Members of an uncompressed input that come out unchanged can be copied
+    # verbatim instead of being decoded and re-encoded.
+    passthrough = (self.raw_output and
+                   type(intar.fileobj) is io.BufferedReader)  # pylint: disable=unidiomatic-typecheck
+    for tarinfo in iter(intar.next, None):
       if name_filter is None or name_filter(tarinfo.name):
         if not self.preserve_mtime:
           tarinfo.mtime = self.default_mtime
@@ -351,9 +1253,12 @@ class TarFileWriter(object):
           del tarinfo.pax_headers['path']
 
         if tarinfo.isfile():
+          raw = None
+          if passthrough:
+            raw = self._passthrough_range(intar, tarinfo)
           # use extractfile(tarinfo) instead of tarinfo.name to preserve
           # seek position in intar
-          self._addfile(tarinfo, intar.extractfile(tarinfo))
+          self._addfile(tarinfo, intar.extractfile(tarinfo), raw=raw)
         else:
           self._addfile(tarinfo)
     intar.close()
@@ -367,9 +1272,22 @@ class TarFileWriter(object):
       TarFileWriter.Error: if an error happens when compressing the output file.
     """
     self.tar.close()
+    if self.previous:
+      self.previous.close()
+    if self.member_digests:
+      self.member_digests.close()
+    if self.index_path:
+      self._write_index()
     # Close the file object if necessary.
     if self.fileobj:
       self.fileobj.close()
+    if self._compressor_copy:
+      try:
+        self._compressor_copied.result()
+      finally:
+        self._compressor_copy.shutdown(wait=True)
     if self.compressor_proc and self.compressor_proc.wait() != 0:
       raise self.Error('Custom compression command '
                        '"{}" failed'.format(self.compressor_cmd))
+    if self.compressor_proc and self.outfile and not self._compressor_copy:
+      self.outfile.seek(0, os.SEEK_END)
@@ -14,14 +14,24 @@
 """This tool builds zip files from a list of inputs."""
 
 import argparse
+import collections
+import concurrent.futures
 import datetime
+import functools
+import hashlib
 import logging
 import os
+import shutil
+import struct
 import sys
+import tempfile
+import time
 import zipfile
 
 from pkg.private import build_info
 from pkg.private import manifest
+from pkg.private import persistent_worker
+from pkg.private import stat_cache
 
 ZIP_EPOCH = 315532800
 
@@ -31,6 +41,30 @@ UNIX_SYMLINK_BIT = 0o120000
 UNIX_DIR_BIT  =    0o040000
 MSDOS_DIR_BIT = 0x10
 
+# Environment variable naming the compression cache directory, when
+# --cache_dir is not given. See pkg_zip in zip.bzl.
+CACHE_DIR_ENV = 'RULES_PKG_ZIP_CACHE_DIR'
+DEFAULT_CACHE_MAX_MB = 1024
+
+# Read size used when streaming file contents into the zip.
+_COPY_CHUNK_SIZE = 1024 * 1024
+
+# Compressed files up to this size are kept in memory while they wait for
+# their turn to be written. Larger ones are spooled to a temporary file.
+_SPOOL_MAX_SIZE = 1024 * 1024
+
+# Age after which a temporary cache file is taken to be left over from a
+# build that died, and removed.
+_STALE_TMP_SECONDS = 24 * 60 * 60
+
+# ZipFile has no public way to add a member that is already compressed, which
+# the compression cache and --jobs rely on. _zip_compressor() and
+# _splice_member() use its internals, which are the same from Python 3.7 on.
+# Where they are missing, ZipWriter compresses through ZipFile.open() instead.
+_CAN_SPLICE = (sys.version_info >= (3, 7) and
+               hasattr(zipfile, '_get_compressor') and
+               hasattr(zipfile.ZipFile, '_writecheck'))
+
 def _create_argument_parser():
   """Creates the command line arg parser."""
   parser = argparse.ArgumentParser(description='create a zip file',
@@ -58,6 +92,17 @@ def _create_argument_parser():
   parser.add_argument('--manifest',
                       help='manifest of contents to add to the layer.',
                       required=True)
+  parser.add_argument(
+      '--jobs', type=int, default=1,
+      help='Number of files to compress concurrently. The output does not'
+           ' depend on it.')
+  parser.add_argument(
+      '--cache_dir', default=os.environ.get(CACHE_DIR_ENV),
+      help='Directory of the compressed file cache. Defaults to $%s.'
+           % CACHE_DIR_ENV)
+  parser.add_argument(
+      '--cache_max_mb', type=int, default=DEFAULT_CACHE_MAX_MB,
+      help='Size above which the least recently used cache entries are evicted.')
   parser.add_argument(
       'files', type=str, nargs='*',
       help='Files to be added to the zip, in the form of {srcpath}={dstpath}.')
@@ -78,9 +123,179 @@ def parse_date(ts):
   return (ts.year, ts.month, ts.day, ts.hour, ts.minute, ts.second)
 
 
+def _zip_compressor(compress_type: int, compression_level: int):
+  """Returns the compressor ZipFile uses, or None for stored members."""
+  return zipfile._get_compressor(  # pylint: disable=protected-access
+      compress_type, compression_level)
+
+
+def _splice_member(zip_file, entry_info, compressed):
+  """Appends a member whose compressed stream is read from `compressed`.
+
+  This mirrors what ZipFile.open(mode='w') does when writing a member, so
+  the output is the same as if the content had been compressed by ZipFile.
+  The sizes, CRC and flags of entry_info must already be set.
+  """
+  zip64 = entry_info.file_size * 1.05 > zipfile.ZIP64_LIMIT
+  zip_file.fp.seek(zip_file.start_dir)
+  entry_info.header_offset = zip_file.fp.tell()
+  zip_file._writecheck(entry_info)  # pylint: disable=protected-access
+  zip_file._didModify = True  # pylint: disable=protected-access
+  zip_file.fp.write(entry_info.FileHeader(zip64))
+  shutil.copyfileobj(compressed, zip_file.fp, _COPY_CHUNK_SIZE)
+  zip_file.start_dir = zip_file.fp.tell()
+  zip_file.filelist.append(entry_info)
+  zip_file.NameToInfo[entry_info.filename] = entry_info
+
+
+class CompressionCache(object):
+  """An on-disk cache of compressed file contents.
+
+  Entries are keyed by the digest of the uncompressed content, the
+  compression type and the compression level, and hold the compressed
+  stream along with its CRC and uncompressed size, so that a hit can be
+  spliced into a zip without running the compressor again.
+
+  Entries are renamed into place once written, so several builds may share
+  a directory and a build never sees a partial entry. An entry whose size
+  does not match its header is taken as a miss. Reading an entry refreshes
+  its mtime, and close() evicts the least recently used entries once the
+  cache grows above max_bytes.
+  """
+
+  _MAGIC = b'PKGZC3'
+  # magic, CRC, uncompressed size, compressed size.
+  _HEADER = struct.Struct('<6sLQQ')
+
+  def __init__(self, cache_dir: str, max_bytes: int):
+    self.cache_dir = cache_dir
+    self.max_bytes = max_bytes
+    os.makedirs(cache_dir, exist_ok=True)
+
+  def _path(self, digest: str, compress_type: int, compression_level: int):
+    key = '%s-%d-%d' % (digest, compress_type, compression_level)
+    return os.path.join(self.cache_dir, key)
+
+  def get(self, digest: str, compress_type: int, compression_level: int):
+    """Looks up an entry.
+
+    Returns:
+      (file, crc, file_size, compress_size), or None on a miss or when the
+      entry is damaged. The file is positioned at the start of the
+      compressed stream and must be closed by the caller.
+    """
+    path = self._path(digest, compress_type, compression_level)
+    try:
+      f = open(path, 'rb')
+    except OSError:
+      return None
+    try:
+      header = f.read(self._HEADER.size)
+      if len(header) != self._HEADER.size:
+        raise ValueError('truncated header')
+      magic, crc, file_size, compress_size = self._HEADER.unpack(header)
+      if magic != self._MAGIC:
+        raise ValueError('bad magic')
+      if os.fstat(f.fileno()).st_size != self._HEADER.size + compress_size:
+        raise ValueError('bad size')
+    except (OSError, ValueError):
+      f.close()
+      return None
+    try:
+      os.utime(path)
+    except OSError:
+      pass
+    return f, crc, file_size, compress_size
+
+  def put(self, digest: str, compress_type: int, compression_level: int,
+          write_fn):
+    """Adds an entry.
+
+    Args:
+      digest: digest of the uncompressed content
+      compress_type: zipfile compression constant
+      compression_level: compression level
+      write_fn: callable that writes the compressed stream to the file object
+          it is given and returns (crc, file_size).
+
+    Returns:
+      The new entry as get() would return it, without reading it back, or
+      None if it could not be written.
+    """
+    path = self._path(digest, compress_type, compression_level)
+    try:
+      fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+    except OSError:
+      # The cache is only an optimization.
+      return None
+    f = os.fdopen(fd, 'w+b')
+    try:
+      f.write(self._HEADER.pack(self._MAGIC, 0, 0, 0))
+      crc, file_size = write_fn(f)
+      compress_size = f.tell() - self._HEADER.size
+      f.seek(0)
+      f.write(self._HEADER.pack(self._MAGIC, crc, file_size, compress_size))
+      f.flush()
+      if os.name == 'nt':
+        # Windows does not rename open files.
+        f.close()
+        os.replace(tmp_path, path)
+        f = open(path, 'rb')
+      else:
+        os.replace(tmp_path, path)
+      f.seek(self._HEADER.size)
+    except OSError:
+      f.close()
+      return None
+    except BaseException:
+      f.close()
+      raise
+    finally:
+      if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    return f, crc, file_size, compress_size
+
+  def close(self):
+    """Evicts least recently used entries down to 90% of max_bytes.
+
+    Temporary files left behind by builds that died are removed as well.
+    """
+    entries = []
+    total = 0
+    stale_before = time.time() - _STALE_TMP_SECONDS
+    with os.scandir(self.cache_dir) as it:
+      for dir_entry in it:
+        if not dir_entry.is_file():
+          continue
+        st = dir_entry.stat()
+        if dir_entry.name.endswith('.tmp'):
+          # Other builds may be writing the recent ones.
+          if st.st_mtime < stale_before:
+            try:
+              os.remove(dir_entry.path)
+            except OSError:
+              pass
+          continue
+        entries.append((st.st_mtime, st.st_size, dir_entry.path))
+        total += st.st_size
+    if total <= self.max_bytes:
+      return
+    entries.sort()
+    target = self.max_bytes * 9 // 10
+    for _, size, path in entries:
+      if total <= target:
+        break
+      try:
+        os.remove(path)
+        total -= size
+      except OSError:
+        pass
+
+
 class ZipWriter(object):
 
-  def __init__(self, output_path: str, time_stamp: int, default_mode: int, compression_type: str, compression_level: int):
+  def __init__(self, output_path: str, time_stamp: int, default_mode: int, compression_type: str, compression_level: int,
+               cache: CompressionCache = None, jobs: int = 1):
     """Create a writer.
 
     You must close() after use or use in a 'with' statement.
@@ -89,10 +304,19 @@ class ZipWriter(object):
       output_path: path to write to
       time_stamp: time stamp to add to files
       default_mode: file mode to use if not specified in the entry.
+      cache: optional cache of compressed file contents.
+      jobs: number of files to compress concurrently.
     """
+    if not _CAN_SPLICE and (cache or jobs > 1):
+      logging.warning('The compression cache and parallel compression are'
+                      ' not supported with this version of Python.')
+      cache = None
+      jobs = 1
     self.output_path = output_path
     self.time_stamp = time_stamp
     self.default_mode = default_mode
+    self.cache = cache
+    self.stat_cache = stat_cache.StatCache()
     compressions = {
       "deflated": zipfile.ZIP_DEFLATED,
       "lzma": zipfile.ZIP_LZMA,
@@ -102,6 +326,11 @@ class ZipWriter(object):
     self.compression_type = compressions[compression_type]
     self.compression_level = compression_level
     self.zip_file = zipfile.ZipFile(self.output_path, mode='w', compression=self.compression_type)
+    self.jobs = jobs
+    self._executor = None
+    self._pending = collections.deque()
+    if jobs > 1:
+      self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
 
   def __enter__(self):
     return self
@@ -110,17 +339,165 @@ class ZipWriter(object):
     self.close()
 
   def close(self):
-    self.zip_file.close()
-    self.zip_file = None
+    try:
+      if self._executor is not None:
+        try:
+          while self._pending:
+            write_fn, _ = self._pending.popleft()
+            write_fn()
+        except BaseException:
+          self._discard_pending()
+          raise
+        finally:
+          self._executor.shutdown(wait=True)
+          self._executor = None
+    finally:
+      # Even if a queued write failed, finish the zip and keep the cache
+      # within its size.
+      try:
+        self.zip_file.close()
+        self.zip_file = None
+      finally:
+        if self.cache:
+          self.cache.close()
+
+  def _discard_pending(self):
+    """Drops the queued writes, closing the files their jobs prepared."""
+    while self._pending:
+      _, future = self._pending.popleft()
+      if future is None or future.cancel():
+        continue
+      try:
+        prepared = future.result()
+      except Exception:  # pylint: disable=broad-except
+        # Only the first error is reported.
+        continue
+      prepared[0].close()
+
+  def _read_chunks(self, src):
+    return iter(lambda: src.read(_COPY_CHUNK_SIZE), b'')
+
+  def _compress_to(self, entry_info, src, out):
+    """Compresses src to out the same way ZipFile would.
+
+    Returns:
+      (crc, file_size) of the uncompressed content.
+    """
+    compressor = _zip_compressor(entry_info.compress_type,
+                                 self.compression_level)
+    crc = 0
+    file_size = 0
+    for chunk in self._read_chunks(src):
+      crc = zipfile.crc32(chunk, crc)
+      file_size += len(chunk)
+      out.write(compressor.compress(chunk) if compressor else chunk)
+    if compressor:
+      out.write(compressor.flush())
+    return crc, file_size
+
+  def _write_compressed(self, entry_info, compressed, crc: int,
+                        file_size: int, compress_size: int):
+    """Splices an already compressed member into the zip.
 
-  def writestr(self, entry_info, content: str, compresslevel: int):
+    Args:
+      entry_info: ZipInfo of the member
+      compressed: file object holding the compressed stream
+      crc: CRC-32 of the uncompressed content
+      file_size: size of the uncompressed content
+      compress_size: size of the compressed stream
+    """
+    entry_info.file_size = file_size
+    entry_info.compress_size = compress_size
+    entry_info.CRC = crc
+    entry_info.flag_bits = 0x00
+    if entry_info.compress_type == zipfile.ZIP_LZMA:
+      # Compressed data includes an end-of-stream (EOS) marker
+      entry_info.flag_bits |= 0x02
+    _splice_member(self.zip_file, entry_info, compressed)
+
+  def _copy_to_zip(self, entry_info, src):
+    """Streams the content of src into the zip."""
     if sys.version_info >= (3, 7):
-      self.zip_file.writestr(entry_info, content, compresslevel=compresslevel)
+      entry_info._compresslevel = self.compression_level  # pylint: disable=protected-access
+    elif self.compression_level != 6:
+      logging.warn("Custom compresslevel is not supported with python < 3.7")
+    # ZipFile decides up front whether the member needs zip64 extensions
+    # from the size we announce, so tell it the real one.
+    entry_info.file_size = os.fstat(src.fileno()).st_size
+    with self.zip_file.open(entry_info, mode='w') as dest:
+      shutil.copyfileobj(src, dest, _COPY_CHUNK_SIZE)
+
+  def _prepare(self, entry_info, src_path):
+    """Compresses the file at src_path, possibly on a worker thread.
+
+    Returns:
+      (file, crc, file_size, compress_size), where the file holds the
+      compressed stream and must be closed by the caller.
+    """
+    with open(src_path, 'rb') as src:
+      if self.cache:
+        sha = hashlib.sha256()
+        for chunk in self._read_chunks(src):
+          sha.update(chunk)
+        src.seek(0)
+        key = (sha.hexdigest(), entry_info.compress_type, self.compression_level)
+        hit = self.cache.get(*key)
+        if hit is None:
+          hit = self.cache.put(
+              *key, lambda out: self._compress_to(entry_info, src, out))
+        if hit is not None:
+          return hit
+        # The cache directory is not writable.
+        src.seek(0)
+      spool = tempfile.SpooledTemporaryFile(max_size=_SPOOL_MAX_SIZE)
+      crc, file_size = self._compress_to(entry_info, src, spool)
+      compress_size = spool.tell()
+      spool.seek(0)
+      return spool, crc, file_size, compress_size
+
+  def _splice(self, entry_info, prepared):
+    compressed, crc, file_size, compress_size = prepared
+    with compressed:
+      self._write_compressed(entry_info, compressed, crc, file_size, compress_size)
+
+  def _emit(self, write_fn, future=None):
+    """Runs write_fn once all the writes queued before it are done.
+
+    Without a thread pool, writes run immediately. With one, they are queued
+    and run in order on this thread, so the output does not depend on the
+    order in which the compression jobs finish. At most 2 * jobs writes are
+    kept waiting, which bounds the number of compressed files held aside.
+
+    Args:
+      write_fn: callable doing the write.
+      future: the compression job write_fn waits for, if any, whose file
+          is closed if the write is dropped.
+    """
+    if self._executor is None:
+      write_fn()
+      return
+    self._pending.append((write_fn, future))
+    while len(self._pending) > 2 * self.jobs:
+      write_fn, _ = self._pending.popleft()
+      write_fn()
+
+  def write_file(self, entry_info, src_path):
+    """Adds the content of the file at src_path to the zip.
+
+    The content is streamed, so memory use does not depend on the file size.
+    """
+    if self._executor is not None:
+      future = self._executor.submit(self._prepare, entry_info, src_path)
+      self._emit(lambda: self._splice(entry_info, future.result()), future)
+    elif self.cache:
+      self._splice(entry_info, self._prepare(entry_info, src_path))
     else:
-      # Python 3.6 and lower don't support compresslevel
-      self.zip_file.writestr(entry_info, content)
-      if compresslevel != 6:
-        logging.warn("Custom compresslevel is not supported with python < 3.7")
+      with open(src_path, 'rb') as src:
+        self._copy_to_zip(entry_info, src)
+
+  def write_data(self, entry_info, data):
+    """Adds an entry with the given in-memory content to the zip."""
+    self._emit(functools.partial(self.zip_file.writestr, entry_info, data))
 
   def make_zipinfo(self, path: str, mode: str):
     """Create a Zipinfo.
@@ -170,28 +547,27 @@ class ZipWriter(object):
       entry_info.compress_type = self.compression_type
       # Using utf-8 for the file names is for python <3.7 compatibility.
       entry_info.external_attr |= UNIX_FILE_BIT << 16
-      with open(src.encode('utf-8'), 'rb') as src_content:
-        self.writestr(entry_info, src_content.read(), compresslevel=self.compression_level)
+      self.write_file(entry_info, src.encode('utf-8'))
     elif entry_type == manifest.ENTRY_IS_DIR:
       entry_info.compress_type = zipfile.ZIP_STORED
       # Set directory bits
       entry_info.external_attr |= (UNIX_DIR_BIT << 16) | MSDOS_DIR_BIT
-      self.zip_file.writestr(entry_info, '')
+      self.write_data(entry_info, '')
     elif entry_type == manifest.ENTRY_IS_LINK:
       entry_info.compress_type = zipfile.ZIP_STORED
       # Set directory bits
       entry_info.external_attr |= (UNIX_SYMLINK_BIT << 16)
-      self.zip_file.writestr(entry_info, src.encode('utf-8'))
+      self.write_data(entry_info, src.encode('utf-8'))
     elif entry_type == manifest.ENTRY_IS_RAW_LINK:
       entry_info.compress_type = zipfile.ZIP_STORED
       # Set directory bits
       entry_info.external_attr |= (UNIX_SYMLINK_BIT << 16)
-      self.zip_file.writestr(entry_info, os.readlink(src).encode('utf-8'))
+      self.write_data(entry_info, os.readlink(src).encode('utf-8'))
     elif entry_type == manifest.ENTRY_IS_TREE:
       self.add_tree(src, dst_path, mode)
     elif entry_type == manifest.ENTRY_IS_EMPTY_FILE:
       entry_info.compress_type = zipfile.ZIP_STORED
-      self.zip_file.writestr(entry_info, '')
+      self.write_data(entry_info, '')
     else:
       raise Exception('Unknown type for manifest entry:', entry)
 
@@ -214,7 +590,7 @@ class ZipWriter(object):
     dest = '' if dest == '.' else dest + '/'
 
     to_write = {}
-    for root, dirs, files in os.walk(tree_top):
+    for root, dirs, files in self.stat_cache.walk(tree_top):
       # While `tree_top` uses '/' as a path separator, results returned by
       # `os.walk` and `os.path.join` on Windows may not.
       root = os.path.normpath(root).replace(os.path.sep, '/')
@@ -241,13 +617,12 @@ class ZipWriter(object):
       if content_path:
         # If mode is unspecified, derive the mode from the file's mode.
         if mode is None:
-          f_mode = "0o755" if os.access(content_path, os.X_OK) else self.default_mode
+          f_mode = "0o755" if self.stat_cache.is_executable(content_path) else self.default_mode
         else:
           f_mode = mode
         entry_info = self.make_zipinfo(path=path, mode=f_mode)
         entry_info.compress_type = self.compression_type
-        with open(content_path, 'rb') as src:
-          self.writestr(entry_info, src.read(), compresslevel=self.compression_level)
+        self.write_file(entry_info, content_path)
       else:
         # Implicitly created directory
         dir_path = path
@@ -257,12 +632,12 @@ class ZipWriter(object):
         entry_info.compress_type = zipfile.ZIP_STORED
         # Set directory bits
         entry_info.external_attr |= (UNIX_DIR_BIT << 16) | MSDOS_DIR_BIT
-        self.zip_file.writestr(entry_info, '')
+        self.write_data(entry_info, '')
 
 def _load_manifest(prefix, manifest_path):
   manifest_map = {}
 
-  for entry in manifest.read_entries_from(manifest_path):
+  for entry in manifest.iter_entries_from(manifest_path):
     entry.dest = _combine_paths(prefix, entry.dest)
     manifest_map[entry.dest] = entry
 
@@ -299,14 +674,21 @@ def main(args):
   if args.mode:
     default_mode = int(args.mode, 8)
   compression_level = int(args.compression_level)
+  cache = None
+  if args.cache_dir:
+    cache = CompressionCache(args.cache_dir, args.cache_max_mb * 1024 * 1024)
 
   manifest = _load_manifest(args.directory, args.manifest)
   with ZipWriter(
-      args.output, time_stamp=ts, default_mode=default_mode, compression_type=args.compression_type, compression_level=compression_level) as zip_out:
+      args.output, time_stamp=ts, default_mode=default_mode, compression_type=args.compression_type, compression_level=compression_level,
+      cache=cache, jobs=args.jobs) as zip_out:
     for entry in manifest:
       zip_out.add_manifest_entry(entry)
 
 
+def _main_from_argv(argv):
+  return main(_create_argument_parser().parse_args(argv))
+
+
 if __name__ == '__main__':
-  arg_parser = _create_argument_parser()
-  main(arg_parser.parse_args())
+  persistent_worker.main_or_worker(_main_from_argv)
@@ -13,6 +13,7 @@
 # limitations under the License.
 """Zip archive creation rule and associated logic."""
 
+load("@bazel_skylib//rules:common_settings.bzl", "BuildSettingInfo")
 load(
     "//pkg:providers.bzl",
     "PackageVariablesInfo",
@@ -40,6 +41,8 @@ def _pkg_zip_impl(ctx):
     args.add("-m", ctx.attr.mode)
     args.add("-c", str(ctx.attr.compression_type))
     args.add("-l", ctx.attr.compression_level)
+    if ctx.attr.compression_threads > 1:
+        args.add("--jobs", str(ctx.attr.compression_threads))
     inputs = []
     if ctx.attr.stamp == 1 or (ctx.attr.stamp == -1 and
                                ctx.attr.private_stamp_detect):
@@ -60,7 +63,7 @@ def _pkg_zip_impl(ctx):
     write_manifest(ctx, manifest_file, mapping_context.content_map)
     args.add("--manifest", manifest_file.path)
     args.set_param_file_format("multiline")
-    args.use_param_file("@%s")
+    args.use_param_file("@%s", use_always = True)
 
     all_inputs = depset(
         direct = mapping_context.file_deps_direct + inputs,
@@ -79,6 +82,11 @@ def _pkg_zip_impl(ctx):
             "PYTHONIOENCODING": "UTF-8",
             "PYTHONUTF8": "1",
         },
+        execution_requirements = {
+            "requires-worker-protocol": "json",
+            "supports-multiplex-workers": "1",
+            "supports-workers": "1",
+        },
         use_default_shell_env = True,
     )
     return [
@@ -129,6 +137,14 @@ limited to a granularity of 2 seconds.""",
 The list of compressions is the same as Python's ZipFile: https://docs.python.org/3/library/zipfile.html#zipfile.ZIP_STORED""",
             values = ["deflated", "lzma", "bzip2", "stored"],
         ),
+        "compression_threads": attr.int(
+            doc = """Number of files to compress concurrently.
+
+            Files are still written in the same order, so the output does not
+            depend on this value.
+            """,
+            default = 1,
+        ),
 
         # Common attributes
         "out": attr.output(
@@ -161,6 +177,10 @@ builds were accidentally doing it. Never explicitly set this to true for new cod
         "private_stamp_detect": attr.bool(default = False),
 
         # Implicit dependencies.
+        "_manifest_format": attr.label(
+            default = Label("//pkg:manifest_format"),
+            providers = [BuildSettingInfo],
+        ),
         "_build_zip": attr.label(
             default = Label("//pkg/private/zip:build_zip"),
             cfg = "exec",
@@ -173,6 +193,12 @@ builds were accidentally doing it. Never explicitly set this to true for new cod
 def pkg_zip(name, out = None, **kwargs):
     """Creates a .zip file.
 
+    Compressed file contents can be cached across builds: set the
+    `RULES_PKG_ZIP_CACHE_DIR` environment variable of the action, e.g. with
+    `--action_env=RULES_PKG_ZIP_CACHE_DIR=/var/cache/rules_pkg_zip`, to a
+    directory outside of the sandbox which the action can write to. The
+    output is the same with and without the cache.
+
     @wraps(pkg_zip_impl)
 
     Args:
@@ -27,7 +27,8 @@ def print_notes(org, repo, version, tarball_path, mirror_host=None,
                 deps_method=None, release_name=None, setup_file=None,
 		toolchains_method=None, changelog=''):
   file_name = os.path.basename(tarball_path)
-  sha256 = release_tools.get_package_sha256(tarball_path)
+  sha256 = release_tools.get_package_digests(tarball_path)['sha256']
+  integrity = release_tools.integrity('sha256', sha256)
 
   url = 'https://github.com/%s/%s/releases/download/%s/%s' % (
       org, repo, release_name, file_name)
@@ -35,7 +36,8 @@ def print_notes(org, repo, version, tarball_path, mirror_host=None,
       mirror_host, org, repo, version, file_name) if mirror_host else None
   workspace_stanza = release_tools.workspace_content(
       url, repo, sha256, mirror_url=mirror_url, setup_file=setup_file,
-      deps_method=deps_method, toolchains_method=toolchains_method)
+      deps_method=deps_method, toolchains_method=toolchains_method,
+      integrity=integrity)
   relnotes_template = string.Template(textwrap.dedent(
       """
       **New Features**
@@ -51,6 +53,16 @@ def print_notes(org, repo, version, tarball_path, mirror_host=None,
       bazel_dep(name = "${repo}", version = "${version}")
       ```
 
+      Until the release is in the Bazel Central Registry:
+
+      ```
+      archive_override(
+          module_name = "${repo}",
+          urls = ["${url}"],
+          integrity = "${integrity}",
+      )
+      ```
+
       **WORKSPACE setup**
 
       ```
@@ -63,8 +75,10 @@ def print_notes(org, repo, version, tarball_path, mirror_host=None,
       """).strip())
   print(relnotes_template.substitute({
       'changelog': changelog,
+      'integrity': integrity,
       'org': org,
       'repo': repo,
+      'url': url,
       'version': version,
       'workspace_stanza': workspace_stanza,
   }))
@@ -13,11 +13,14 @@
 # limitations under the License.
 """Utilities to help create a rule set release."""
 
+import base64
 import hashlib
 import string
 import sys
 import textwrap
 
+from pkg.private import digests
+
 
 WORKSPACE_STANZA_TEMPLATE = string.Template(textwrap.dedent(
     """
@@ -27,7 +30,7 @@ WORKSPACE_STANZA_TEMPLATE = string.Template(textwrap.dedent(
         urls = [
             ${urls},
         ],
-        sha256 = "${sha256}",
+        ${checksum},
     )
     """).strip())
 
@@ -42,10 +45,35 @@ def package_basename(repo, version):
   return '%s-%s.tar.gz' % (repo, version)
 
 
+def get_package_digests(tarball_path, algorithms=('sha256',), use_mmap=True):
+  """Computes several digests of a release artifact in one pass.
+
+  Args:
+    tarball_path: path to the artifact.
+    algorithms: hashlib algorithm names.
+    use_mmap: hash the artifact through a memory map rather than reads.
+
+  Returns:
+    Mapping of algorithm names to hexdigest strings.
+  """
+  return digests.file_digests(
+      tarball_path,
+      {alg: lambda alg=alg: hashlib.new(alg) for alg in algorithms},
+      use_mmap=use_mmap)
+
+
+def integrity(algorithm, hexdigest):
+  """Returns the Subresource Integrity string for a digest.
+
+  This is the form taken by the integrity attribute of http_archive and of
+  the MODULE.bazel overrides, e.g. 'sha256-<base64 of the digest>'.
+  """
+  return '%s-%s' % (
+      algorithm, base64.b64encode(bytes.fromhex(hexdigest)).decode('ascii'))
+
+
 def get_package_sha256(tarball_path):
-  with open(tarball_path, 'rb') as pkg_content:
-    tar_sha256 = hashlib.sha256(pkg_content.read()).hexdigest()
-  return tar_sha256
+  return get_package_digests(tarball_path, ('sha256',))['sha256']
 
 
 def workspace_content(
@@ -56,7 +84,8 @@ def workspace_content(
     mirror_url=None,
     rename_repo=None,
     setup_file=None,
-    toolchains_method=None):
+    toolchains_method=None,
+    integrity=None):
   # Create the WORKSPACE stanza needed for this rule set.
   if setup_file and not (deps_method or toolchains_method):
     print(
@@ -86,7 +115,8 @@ def workspace_content(
     urls = '"%s"' % url
   ret = WORKSPACE_STANZA_TEMPLATE.substitute({
       'urls': urls,
-      'sha256': sha256,
+      'checksum': ('integrity = "%s"' % integrity if integrity
+                   else 'sha256 = "%s"' % sha256),
       'repo': repo,
   })
   if methods:
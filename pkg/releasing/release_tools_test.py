@@ -12,6 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+import os
 import unittest
 
 from pkg.releasing import release_tools
@@ -77,6 +79,31 @@ class ReleaseToolsTest(unittest.TestCase):
     self.assertGreater(mirror_pos, 0)
     self.assertLess(mirror_pos, url_pos)
 
+  def test_workspace_content_integrity(self):
+    content = release_tools.workspace_content(
+        url='http://github.com',
+        repo='foo-bar',
+        sha256='@computed@',
+        integrity='sha256-@computed@')
+    self.assertGreater(content.find(' integrity = "sha256-@computed@",'), 0,
+                       content)
+    self.assertLess(content.find('sha256 = '), 0, content)
+
+  def test_get_package_digests(self):
+    path = os.path.join(os.environ['TEST_TMPDIR'], 'release.tar.gz')
+    with open(path, 'wb') as f:
+      f.write(b'release')
+    for use_mmap in (False, True):
+      digests = release_tools.get_package_digests(
+          path, ('sha256', 'sha384'), use_mmap=use_mmap)
+      self.assertEqual(hashlib.sha256(b'release').hexdigest(),
+                       digests['sha256'])
+      self.assertEqual(hashlib.sha384(b'release').hexdigest(),
+                       digests['sha384'])
+    self.assertEqual(
+        'sha256-47DEQpj8HBSa+/TImW+5JCeuQeRkm5NMpJWZG3hSuFU=',
+        release_tools.integrity('sha256', hashlib.sha256(b'').hexdigest()))
+
 
 if __name__ == '__main__':
   unittest.main()
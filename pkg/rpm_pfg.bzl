@@ -901,11 +901,17 @@ def _pkg_rpm_impl(ctx):
 
     #### Call the generator script.
 
+    # Persistent workers receive their arguments through a params file.
+    args = ctx.actions.args()
+    args.add_all(rpm_ctx.make_rpm_args)
+    args.set_param_file_format("multiline")
+    args.use_param_file("@%s", use_always = True)
+
     ctx.actions.run(
         mnemonic = "MakeRpm",
         executable = ctx.executable._make_rpm,
         use_default_shell_env = True,
-        arguments = rpm_ctx.make_rpm_args,
+        arguments = [args],
         inputs = files + (ctx.files.data or []) + toolchain_data,
         outputs = rpm_ctx.output_rpm_files,
         env = {
@@ -914,6 +920,11 @@ def _pkg_rpm_impl(ctx):
             "PYTHONIOENCODING": "UTF-8",
             "PYTHONUTF8": "1",
         },
+        # make_rpm changes its working directory, so it can not be multiplexed.
+        execution_requirements = {
+            "requires-worker-protocol": "json",
+            "supports-workers": "1",
+        },
         tools = tools,
     )
 
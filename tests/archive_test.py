@@ -93,6 +93,39 @@ class SimpleArReaderTest(unittest.TestCase):
   def testA_B_ABFile(self):
     self.assertSimpleFileContent(["a", "b", "ab"])
 
+  def testOpenMember(self):
+    datafile = self.data_files.Rlocation("rules_pkg/tests/testdata/a_b_ab.ar")
+    with archive.SimpleArReader(datafile) as f:
+      members = [f.next(), f.next(), f.next()]
+      views = [member.open() for member in members]
+      # Views share the archive file but keep their own position.
+      self.assertEqual(b"a", views[2].read(1))
+      self.assertEqual(b"a", views[0].read())
+      self.assertEqual(b"b", views[2].read())
+      self.assertEqual(b"", views[2].read())
+      views[2].seek(-1, 2)
+      self.assertEqual(b"b", views[2].read())
+      self.assertEqual(b"b", views[1].read(10))
+      self.assertIsNone(f.next())
+
+  def testMemberIndex(self):
+    datafile = self.data_files.Rlocation("rules_pkg/tests/testdata/a_b_ab.ar")
+    with archive.SimpleArReader(datafile) as f:
+      self.assertEqual(b"a", f.next().data)
+      self.assertEqual(["a", "b", "ab"],
+                       [member.filename for member in f.members()])
+      self.assertEqual(b"ab", f.read("ab"))
+      self.assertEqual(b"a", f.read("a"))
+      with f.open("b") as member:
+        self.assertEqual(b"b", member.read())
+      with self.assertRaises(archive.SimpleArReader.ArError):
+        f.read("c")
+      # Iteration is not affected by lookups.
+      self.assertEqual(b"b", f.next().data)
+    empty = self.data_files.Rlocation("rules_pkg/tests/testdata/empty.ar")
+    with archive.SimpleArReader(empty) as f:
+      self.assertEqual([], f.members())
+
 
 if __name__ == "__main__":
   unittest.main()
@@ -0,0 +1,218 @@
+# Copyright 2026 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Testing for make_deb."""
+
+import hashlib
+import io
+import json
+import os
+import shutil
+import subprocess
+import tarfile
+import unittest
+from unittest import mock
+
+from pkg.private import archive
+from pkg.private.deb import make_deb
+from pkg.private.tar import build_tar
+from pkg.private.tar import tar_writer
+
+
+class MakeDebTest(unittest.TestCase):
+
+  def setUp(self):
+    super(MakeDebTest, self).setUp()
+    self.tmpdir = os.path.join(os.environ["TEST_TMPDIR"], self.id())
+    os.makedirs(self.tmpdir, exist_ok=True)
+    content = os.path.join(self.tmpdir, "content.bin")
+    with open(content, "wb") as f:
+      f.write(os.urandom(10001))
+    self.manifest = os.path.join(self.tmpdir, "manifest.json")
+    with open(self.manifest, "w") as f:
+      json.dump([
+          {"type": "file", "dest": "usr/bin/tool", "src": content,
+           "mode": None, "user": None, "group": None},
+          {"type": "dir", "dest": "var/lib/tool", "src": None,
+           "mode": "0755", "user": None, "group": None},
+      ], f)
+
+  def testArFileEntryFromWriter(self):
+    for content in (b"", b"odd", b"even"):
+      expected = io.BytesIO()
+      make_deb.AddArFileEntry(expected, "member", content)
+      actual = io.BytesIO()
+      make_deb.AddArFileEntryFromWriter(
+          actual, "member", lambda out, content=content: out.write(content))
+      self.assertEqual(expected.getvalue(), actual.getvalue())
+
+  def testDataFromManifest(self):
+    for compression in sorted(make_deb.DATA_COMPRESSIONS):
+      data = os.path.join(
+          self.tmpdir, "data." + make_deb.DATA_COMPRESSIONS[compression])
+      with open(data, "wb") as f:
+        make_deb.WriteDataTar(f, self.manifest, compression=compression,
+                              default_mode=0o555, default_mtime="portable")
+      debs = []
+      md5sums = make_deb.Md5sumsFromManifest(self.manifest)
+      for kwargs in ({"data": data, "md5sums": md5sums},
+                     {"data": None, "data_manifest": self.manifest,
+                      "data_compression": compression, "data_mode": 0o555,
+                      "data_mtime": "portable"}):
+        out = os.path.join(self.tmpdir, "out.deb")
+        make_deb.CreateDeb(out, package="tool", version="1",
+                           description="A tool", maintainer="someone",
+                           **kwargs)
+        with open(out, "rb") as f:
+          debs.append(f.read())
+      self.assertEqual(debs[0], debs[1], compression)
+      with archive.SimpleArReader(out) as ar:
+        with open(data, "rb") as f:
+          self.assertEqual(
+              f.read(),
+              ar.read("data." + make_deb.DATA_COMPRESSIONS[compression]))
+
+  @unittest.skipUnless(shutil.which("zstd"), "zstd is not on the PATH")
+  def testDataFromManifestWithCompressorTool(self):
+    out = os.path.join(self.tmpdir, "out.deb")
+    # The data member goes through the tool rather than the module.
+    with mock.patch.object(tar_writer, "HAS_ZSTD", False):
+      checksums = make_deb.CreateDeb(
+          out, None, data_manifest=self.manifest, data_compression="zst",
+          data_zstd_path=shutil.which("zstd"), package="tool", version="1",
+          description="A tool", maintainer="someone")
+    self.assertEqual(
+        make_deb.GetChecksumsFromFile(out, make_deb._CHANGES_HASH_FNS),
+        checksums)
+    with archive.SimpleArReader(out) as ar:
+      data = ar.read("data.tar.zst")
+    tar = subprocess.run(["zstd", "-d", "-q", "-c", "-"], input=data,
+                         stdout=subprocess.PIPE, check=True).stdout
+    with tarfile.open(fileobj=io.BytesIO(tar)) as f:
+      with open(os.path.join(self.tmpdir, "content.bin"), "rb") as content:
+        self.assertEqual(content.read(),
+                         f.extractfile("usr/bin/tool").read())
+
+  def testDataTarMatchesPkgTar(self):
+    for compression in sorted(make_deb.DATA_COMPRESSIONS):
+      name = "data." + make_deb.DATA_COMPRESSIONS[compression]
+      expected = os.path.join(self.tmpdir, "pkg_tar", name)
+      os.makedirs(os.path.dirname(expected), exist_ok=True)
+      # The flags pkg_tar passes by default.
+      build_tar.main(["--output", expected, "--manifest", self.manifest,
+                      "--directory", "/", "--mode", "0555",
+                      "--owner", "0.0", "--owner_name", ".",
+                      "--mtime", "portable", "--create_parents"] +
+                     (["--compression", compression] if compression else []))
+      actual = os.path.join(self.tmpdir, name)
+      with open(actual, "wb") as f:
+        make_deb.WriteDataTar(f, self.manifest, compression=compression,
+                              default_mode=0o555, default_mtime="portable")
+      with open(expected, "rb") as f_expected, open(actual, "rb") as f_actual:
+        self.assertEqual(f_expected.read(), f_actual.read(), compression)
+
+  def testChecksumsWhileWriting(self):
+    data = os.path.join(self.tmpdir, "data.tar")
+    with open(data, "wb") as f:
+      make_deb.WriteDataTar(f, self.manifest, compression="")
+    out = os.path.join(self.tmpdir, "out.deb")
+    checksums = make_deb.CreateDeb(out, data, package="tool", version="1",
+                                   description="A tool", maintainer="someone")
+    self.assertEqual(
+        make_deb.GetChecksumsFromFile(out, make_deb._CHANGES_HASH_FNS),
+        checksums)
+    # The data member size is patched after the fact.
+    checksums = make_deb.CreateDeb(
+        out, None, data_manifest=self.manifest, package="tool", version="1",
+        description="A tool", maintainer="someone")
+    self.assertEqual(
+        make_deb.GetChecksumsFromFile(out, make_deb._CHANGES_HASH_FNS),
+        checksums)
+
+  def testDigestsNeedACheckpointOnceNotSequential(self):
+    for checkpoint in (False, True):
+      out = io.BytesIO()
+      f = make_deb.HashingWriter(out, {"md5": hashlib.md5})
+      f.write(b"header")
+      if checkpoint:
+        f.checkpoint()
+      f.write(b"size=0\ncontent")
+      f.seek(11)
+      f.write(b"7")
+      f.seek(0, os.SEEK_END)
+      if checkpoint:
+        self.assertEqual(
+            {"md5": hashlib.md5(b"headersize=7\ncontent").hexdigest()},
+            f.digests())
+      else:
+        self.assertIsNone(f.digests())
+
+  def testMd5sumsFromMemberDigests(self):
+    data = os.path.join(self.tmpdir, "data.tar.gz")
+    member_digests = os.path.join(self.tmpdir, "data.digests")
+    build_tar.main(["--output", data, "--manifest", self.manifest,
+                    "--directory", "", "--compression", "gz",
+                    "--member_digests", member_digests])
+    out = os.path.join(self.tmpdir, "out.deb")
+    make_deb.CreateDeb(out, data, member_digests=member_digests,
+                       package="tool", version="1", description="A tool",
+                       maintainer="someone")
+    with archive.SimpleArReader(out) as ar:
+      control = ar.read("control.tar.gz")
+    with tarfile.open(fileobj=io.BytesIO(control)) as f:
+      md5sums = f.extractfile("./md5sums").read().decode("utf-8")
+    with open(os.path.join(self.tmpdir, "content.bin"), "rb") as f:
+      self.assertEqual(
+          "%s  usr/bin/tool\n" % hashlib.md5(f.read()).hexdigest(), md5sums)
+
+
+  def testMd5sumsFromManifest(self):
+    out = os.path.join(self.tmpdir, "out.deb")
+    make_deb.CreateDeb(out, None, data_manifest=self.manifest,
+                       package="tool", version="1", description="A tool",
+                       maintainer="someone")
+    with archive.SimpleArReader(out) as ar:
+      control = ar.read("control.tar.gz")
+    with tarfile.open(fileobj=io.BytesIO(control)) as f:
+      md5sums = f.extractfile("./md5sums").read().decode("utf-8")
+    with open(os.path.join(self.tmpdir, "content.bin"), "rb") as f:
+      self.assertEqual(
+          "%s  usr/bin/tool\n" % hashlib.md5(f.read()).hexdigest(), md5sums)
+
+  def testMd5sumsFromManifestMatchMemberDigests(self):
+    tree = os.path.join(self.tmpdir, "tree")
+    os.makedirs(os.path.join(tree, "b", "c"), exist_ok=True)
+    for name in ("a", "b/c/d", "b/e"):
+      with open(os.path.join(tree, name), "w") as f:
+        f.write(name)
+    with open(self.manifest) as f:
+      entries = json.load(f)
+    entries += [
+        {"type": "empty-file", "dest": "etc/tool.conf", "src": None,
+         "mode": None, "user": None, "group": None},
+        {"type": "tree", "dest": "usr/share/tool", "src": tree,
+         "mode": None, "user": None, "group": None},
+    ]
+    with open(self.manifest, "w") as f:
+      json.dump(entries, f)
+    data = os.path.join(self.tmpdir, "data.tar")
+    member_digests = os.path.join(self.tmpdir, "data.digests")
+    build_tar.main(["--output", data, "--manifest", self.manifest,
+                    "--directory", "", "--member_digests", member_digests])
+    self.assertEqual(
+        sorted(make_deb.Md5sumsFromMemberDigests(member_digests).splitlines()),
+        sorted(make_deb.Md5sumsFromManifest(self.manifest).splitlines()))
+
+
+if __name__ == "__main__":
+  unittest.main()
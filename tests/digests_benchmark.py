@@ -0,0 +1,86 @@
+# Copyright 2026 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Throughput benchmark for the parallel digests.
+
+Hashes a BENCHMARK_SIZE_MB (default 1 GiB) file with md5, sha1 and sha256,
+as for a .changes file, one after another on each buffer as make_deb used
+to, then with digests.file_digests(), for each buffer size in
+BENCHMARK_BUFFER_KB (default 64,1024,8192). Prints the throughput and the
+throughput per busy core.
+
+  bazel test //tests:digests_benchmark --test_output=streamed
+"""
+
+import hashlib
+import os
+import resource
+import time
+import unittest
+
+from pkg.private import digests
+
+_HASH_FNS = {
+    "md5": hashlib.md5,
+    "sha1": hashlib.sha1,
+    "sha256": hashlib.sha256,
+}
+
+
+def serial_digests(filename, hash_fns, buffer_size):
+  """The previous implementation."""
+  checksums = {k: fn() for (k, fn) in hash_fns.items()}
+  with open(filename, "rb") as f:
+    while True:
+      buf = f.read(buffer_size)
+      if not buf:
+        break
+      for hashfn in checksums.values():
+        hashfn.update(buf)
+  return {k: fn.hexdigest() for (k, fn) in checksums.items()}
+
+
+def cpu_time():
+  usage = resource.getrusage(resource.RUSAGE_SELF)
+  return usage.ru_utime + usage.ru_stime
+
+
+class DigestsBenchmark(unittest.TestCase):
+
+  def testThroughput(self):
+    size_mb = int(os.environ.get("BENCHMARK_SIZE_MB", 1024))
+    buffers_kb = [int(kb) for kb in os.environ.get(
+        "BENCHMARK_BUFFER_KB", "64,1024,8192").split(",")]
+    path = os.path.join(os.environ["TEST_TMPDIR"], "digests.bin")
+    chunk = os.urandom(1 << 20)
+    with open(path, "wb") as f:
+      for _ in range(size_mb):
+        f.write(chunk)
+
+    for buffer_kb in buffers_kb:
+      results = []
+      for name, fn in (("serial", serial_digests),
+                       ("parallel", digests.file_digests)):
+        start, start_cpu = time.time(), cpu_time()
+        results.append(fn(path, _HASH_FNS, buffer_size=buffer_kb * 1024))
+        elapsed = time.time() - start
+        cores = (cpu_time() - start_cpu) / elapsed
+        print("%-8s %5d KiB buffers: %7.1f MiB/s, %.2f busy cores,"
+              " %7.1f MiB/s per core" % (
+                  name, buffer_kb, size_mb / elapsed, cores,
+                  size_mb / elapsed / cores))
+      self.assertEqual(results[0], results[1])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,53 @@
+# Copyright 2026 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Testing for the parallel digests."""
+
+import hashlib
+import os
+import unittest
+
+from pkg.private import digests
+
+_HASH_FNS = {
+    "md5": hashlib.md5,
+    "sha1": hashlib.sha1,
+    "sha256": hashlib.sha256,
+}
+
+
+class DigestsTest(unittest.TestCase):
+
+  def testFileDigests(self):
+    path = os.path.join(os.environ["TEST_TMPDIR"], "digests.bin")
+    content = os.urandom(100000)
+    with open(path, "wb") as f:
+      f.write(content)
+    expected = {k: fn(content).hexdigest() for (k, fn) in _HASH_FNS.items()}
+    for buffer_size in (1, 4096, 99999, 1 << 20):
+      for threads in (None, 1):
+        for use_mmap in (False, True):
+          self.assertEqual(
+              expected,
+              digests.file_digests(path, _HASH_FNS, buffer_size=buffer_size,
+                                   threads=threads, use_mmap=use_mmap))
+
+  def testEmpty(self):
+    with digests.ParallelDigester(_HASH_FNS) as digester:
+      self.assertEqual(
+          {k: fn().hexdigest() for (k, fn) in _HASH_FNS.items()},
+          digester.hexdigests())
+
+
+if __name__ == "__main__":
+  unittest.main()
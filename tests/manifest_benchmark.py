@@ -0,0 +1,115 @@
+# Copyright 2026 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmarks for large manifests.
+
+testEntriesMemory decodes BENCHMARK_ENTRIES (default 1M) synthetic manifest
+lines, as manifest.iter_entries_from() does, keeping the entries in a list
+as build_zip._load_manifest does. Prints the memory held by the list with
+the previous ManifestEntry class and with the current one.
+
+testLoadTime writes the same entries as a JSON and as a compact manifest and
+prints the time manifest.read_entries_from() takes for each.
+
+  bazel test //tests:manifest_benchmark --test_output=streamed
+"""
+
+import gc
+import json
+import os
+import time
+import tracemalloc
+import unittest
+
+from pkg.private import manifest
+from tests import manifest_test_lib
+
+
+class DictManifestEntry(object):
+  """The previous implementation, with a __dict__ and no interning."""
+
+  def __init__(self, type, dest, src, mode, user, group, uid=None, gid=None,
+               origin=None, repository=None):
+    self.type = type
+    self.dest = dest
+    self.src = src
+    self.mode = mode
+    self.user = user
+    self.group = group
+    self.uid = uid
+    self.gid = gid
+    self.origin = origin
+    self.repository = repository
+
+
+def synthetic_lines(count):
+  for i in range(count):
+    yield json.dumps({
+        "type": "file",
+        "src": "bazel-out/k8-fastbuild/bin/pkg%d/file%d" % (i % 1000, i),
+        "dest": "usr/share/pkg%d/file%d" % (i % 1000, i),
+        "mode": "0644",
+        "user": "root",
+        "group": "root",
+        "uid": None,
+        "gid": None,
+        "origin": "@@//pkg%d:files" % (i % 1000),
+        "repository": "_main",
+    })
+
+
+def entries_count():
+  return int(os.environ.get("BENCHMARK_ENTRIES", 1000000))
+
+
+class ManifestBenchmark(unittest.TestCase):
+
+  def testEntriesMemory(self):
+    count = entries_count()
+    results = {}
+    for name, cls in (("dict", DictManifestEntry),
+                      ("slots", manifest.ManifestEntry)):
+      gc.collect()
+      tracemalloc.start()
+      start = time.time()
+      entries = [cls(**json.loads(line)) for line in synthetic_lines(count)]
+      elapsed = time.time() - start
+      results[name] = tracemalloc.get_traced_memory()[0]
+      tracemalloc.stop()
+      print("%-6s %d entries: %7.1f MiB held, %.1f bytes per entry, %.1fs" % (
+          name, len(entries), results[name] / (1 << 20),
+          results[name] / count, elapsed))
+      del entries
+    self.assertLess(results["slots"], results["dict"])
+
+  def testLoadTime(self):
+    entries = [json.loads(line) for line in synthetic_lines(entries_count())]
+    results = {}
+    for name, writer in (("json", manifest_test_lib.json_manifest),
+                         ("compact", manifest_test_lib.compact_manifest)):
+      path = os.path.join(os.environ["TEST_TMPDIR"], "manifest." + name)
+      with open(path, "w") as f:
+        f.write(writer(entries))
+      gc.collect()
+      start = time.time()
+      loaded = manifest.read_entries_from(path)
+      results[name] = time.time() - start
+      print("%-7s %d entries: %7.1f MiB, loaded in %.2fs" % (
+          name, len(loaded), os.path.getsize(path) / (1 << 20),
+          results[name]))
+      del loaded
+    self.assertLess(results["compact"], results["json"])
+
+
+if __name__ == "__main__":
+  unittest.main()
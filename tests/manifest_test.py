@@ -0,0 +1,114 @@
+# Copyright 2026 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Testing for the manifest readers."""
+
+import json
+import os
+import unittest
+
+from pkg.private import manifest
+from tests import manifest_test_lib
+
+_ENTRIES = [
+    {"type": "file", "dest": "usr/bin/tool", "src": "bazel-out/tool",
+     "mode": "0755", "user": None, "group": None, "uid": None, "gid": None,
+     "origin": "@//:tool", "repository": "_main"},
+    {"type": "dir", "dest": "var/lib/tööl", "src": None,
+     "mode": "", "user": "root", "group": "root", "uid": 0, "gid": 0,
+     "origin": "@//:dir", "repository": None},
+]
+
+def _fields(entry):
+  return {k: getattr(entry, k) for k in entry.__slots__}
+
+
+class ManifestTest(unittest.TestCase):
+
+  def write(self, name, content, encoding="utf-8"):
+    path = os.path.join(os.environ["TEST_TMPDIR"], name)
+    with open(path, "w", encoding=encoding, newline="") as f:
+      f.write(content)
+    return path
+
+  def assertEntries(self, entries, path):
+    actual = manifest.iter_entries_from(path)
+    self.assertNotIsInstance(actual, list)
+    self.assertEqual(entries, [_fields(e) for e in actual])
+    self.assertEqual(entries,
+                     [_fields(e) for e in manifest.read_entries_from(path)])
+
+  def testLineLayout(self):
+    # As written by pkg_files.bzl:write_manifest.
+    content = manifest_test_lib.json_manifest(_ENTRIES)
+    self.assertEntries(_ENTRIES, self.write("lines.json", content))
+    self.assertEntries(
+        _ENTRIES, self.write("lines_crlf.json", content.replace("\n", "\r\n")))
+    self.assertEntries(
+        _ENTRIES,
+        self.write("lines_utf16.json", json.dumps(_ENTRIES, ensure_ascii=False)
+                   .replace("}, {", "},\n{").replace("[{", "[\n{")
+                   .replace("}]", "}\n]\n"),
+                   encoding="utf-16-le"))
+
+  def testOtherLayouts(self):
+    self.assertEntries(_ENTRIES,
+                       self.write("compact.json", json.dumps(_ENTRIES)))
+    self.assertEntries(
+        _ENTRIES, self.write("pretty.json", json.dumps(_ENTRIES, indent=2)))
+    self.assertEntries(
+        _ENTRIES,
+        self.write("pretty_utf16.json",
+                   json.dumps(_ENTRIES, indent=2, ensure_ascii=False),
+                   encoding="utf-16-le"))
+    self.assertEntries([], self.write("empty.json", "[\n\n]\n"))
+
+  def testCompactLayout(self):
+    compact = manifest_test_lib.compact_manifest
+    content = compact(_ENTRIES + _ENTRIES[:1])
+    # Every distinct string is written once.
+    self.assertEqual(1, content.count('"root"'))
+    self.assertEqual(1, content.count('"usr/bin/tool"'))
+    self.assertEntries(_ENTRIES + _ENTRIES[:1],
+                       self.write("compact.manifest", content))
+    self.assertEntries(
+        _ENTRIES, self.write("compact_utf16.manifest",
+                             compact(_ENTRIES), encoding="utf-16-le"))
+    self.assertEntries([], self.write("compact_empty.manifest",
+                                      compact([])))
+    with self.assertRaises(ValueError):
+      list(manifest.iter_entries_from(self.write(
+          "compact_v2.manifest", "#rules_pkg-manifest 2 0\n[]\n")))
+    with self.assertRaises(ValueError):
+      list(manifest.iter_entries_from(self.write(
+          "compact_short.manifest",
+          compact(_ENTRIES).replace(" 2\n", " 3\n", 1))))
+
+  def testUnterminated(self):
+    path = self.write("unterminated.json",
+                      "[\n" + json.dumps(_ENTRIES[0]) + ",\n")
+    with self.assertRaises(ValueError):
+      list(manifest.iter_entries_from(path))
+
+  def testInterned(self):
+    path = self.write("interned.json", json.dumps(_ENTRIES + _ENTRIES))
+    entries = manifest.read_entries_from(path)
+    self.assertIs(entries[0].origin, entries[2].origin)
+    self.assertIs(entries[1].user, entries[3].group)
+    with self.assertRaises(AttributeError):
+      entries[0].extra = None
+    self.assertIn("'dest': 'usr/bin/tool'", repr(entries[0]))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,43 @@
+# Copyright 2026 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Writes manifests the way pkg_files.bzl:write_manifest does."""
+
+import json
+
+FIELDS = ["type", "dest", "src", "mode", "user", "group", "uid", "gid",
+          "origin", "repository"]
+
+
+def compact_manifest(entries):
+  """Mirrors _write_compact_manifest() in pkg_files.bzl."""
+  strings = {}
+  rows = []
+  for entry in entries:
+    row = []
+    for field in FIELDS:
+      value = entry[field]
+      if field in ("uid", "gid"):
+        row.append(value)
+      elif value is None:
+        row.append(-1)
+      else:
+        row.append(strings.setdefault(value, len(strings)))
+    rows.append(json.dumps(row))
+  return "\n".join(["#rules_pkg-manifest 1 %d" % len(rows),
+                    json.dumps(list(strings))] + rows) + "\n"
+
+
+def json_manifest(entries):
+  """Mirrors the default, JSON, layout of write_manifest()."""
+  return "[\n" + ",\n".join(json.dumps(e) for e in entries) + "\n]\n"
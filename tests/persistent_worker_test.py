@@ -0,0 +1,128 @@
+# Copyright 2026 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the persistent worker harness."""
+
+import argparse
+import io
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from pkg.private import persistent_worker
+
+
+def _echo_main(argv):
+  parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
+  parser.add_argument('--message', required=True)
+  parser.add_argument('--exit_code', type=int, default=0)
+  options = parser.parse_args(argv)
+  print(options.message)
+  if options.message == 'raise':
+    raise ValueError('boom')
+  return options.exit_code
+
+
+def _cwd_main(argv):
+  # Reports the working directory seen before and after a short pause.
+  before = os.getcwd()
+  time.sleep(0.01)
+  print(before == os.getcwd() and os.path.basename(before))
+  return 0
+
+
+class PersistentWorkerTest(unittest.TestCase):
+
+  def run_worker(self, requests, main_fn=_echo_main, **kwargs):
+    stdin = io.StringIO(''.join(json.dumps(r) + '\n' for r in requests))
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    worker = persistent_worker.PersistentWorker(
+        main_fn, stdin=stdin, stdout=stdout, stderr=stderr, **kwargs)
+    self.assertEqual(0, worker.run())
+    responses = [json.loads(l) for l in stdout.getvalue().splitlines()]
+    return {r['requestId']: r for r in responses}
+
+  def testSingleplex(self):
+    responses = self.run_worker([
+        {'arguments': ['--message', 'hello']},
+    ])
+    self.assertEqual(0, responses[0]['exitCode'])
+    self.assertEqual('hello\n', responses[0]['output'])
+
+  def testMultiplexCapturesOutputPerRequest(self):
+    responses = self.run_worker([
+        {'arguments': ['--message', 'req%d' % i], 'requestId': i}
+        for i in range(1, 20)
+    ])
+    self.assertEqual(19, len(responses))
+    for i in range(1, 20):
+      self.assertEqual('req%d\n' % i, responses[i]['output'])
+
+  def testErrorsAreReported(self):
+    responses = self.run_worker([
+        {'arguments': ['--message', 'raise'], 'requestId': 1},
+        {'arguments': ['--message', 'x', '--exit_code', '3'], 'requestId': 2},
+        {'arguments': ['--bogus'], 'requestId': 3},
+    ])
+    self.assertEqual(1, responses[1]['exitCode'])
+    self.assertIn('ValueError: boom', responses[1]['output'])
+    self.assertEqual(3, responses[2]['exitCode'])
+    self.assertEqual(2, responses[3]['exitCode'])
+    self.assertIn('usage:', responses[3]['output'])
+
+  def testSandboxDir(self):
+    with tempfile.TemporaryDirectory() as sandbox:
+      with open(os.path.join(sandbox, 'params'), 'w') as f:
+        f.write('--message\nfrom_params\n')
+      cwd = os.getcwd()
+      responses = self.run_worker([
+          {'arguments': ['@params'], 'requestId': 1, 'sandboxDir': sandbox},
+      ])
+      self.assertEqual(cwd, os.getcwd())
+    self.assertEqual('from_params\n', responses[1]['output'])
+
+  def testSandboxDirDoesNotLeakIntoOtherRequests(self):
+    with tempfile.TemporaryDirectory() as sandbox:
+      requests = []
+      for i in range(1, 41):
+        request = {'arguments': [], 'requestId': i}
+        if i % 4 == 0:
+          request['sandboxDir'] = sandbox
+        requests.append(request)
+      responses = self.run_worker(requests, main_fn=_cwd_main, max_threads=8)
+    cwd_name = os.path.basename(os.getcwd())
+    for i in range(1, 41):
+      expected = os.path.basename(sandbox) if i % 4 == 0 else cwd_name
+      self.assertEqual(expected + '\n', responses[i]['output'], i)
+
+  def testUnknownCancelIsIgnored(self):
+    responses = self.run_worker([
+        {'arguments': ['--message', 'a'], 'requestId': 1},
+        {'requestId': 7, 'cancel': True},
+    ])
+    self.assertEqual([1], list(responses))
+
+  def testRetiresAboveMemoryLimit(self):
+    responses = self.run_worker([
+        {'arguments': ['--message', 'a']},
+        {'arguments': ['--message', 'b']},
+    ], max_rss_mb=1)
+    if persistent_worker.resource is not None:
+      self.assertEqual([0], list(responses))
+
+
+if __name__ == '__main__':
+  unittest.main()
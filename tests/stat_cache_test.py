@@ -0,0 +1,97 @@
+# Copyright 2026 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Testing for the stat cache."""
+
+import os
+import unittest
+from unittest import mock
+
+from pkg.private import stat_cache
+
+
+class StatCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    super(StatCacheTest, self).setUp()
+    self.top = os.path.join(os.environ["TEST_TMPDIR"], self.id())
+    os.makedirs(os.path.join(self.top, "a", "b"), exist_ok=True)
+    os.makedirs(os.path.join(self.top, "c"), exist_ok=True)
+    for path, mode in (("f", 0o644), ("a/x", 0o755), ("a/b/y", 0o600)):
+      path = os.path.join(self.top, path)
+      with open(path, "w") as f:
+        f.write(path)
+      os.chmod(path, mode)
+    if hasattr(os, "symlink"):
+      for target, name in (("a", "link_to_dir"), ("missing", "dangling")):
+        name = os.path.join(self.top, name)
+        if not os.path.lexists(name):
+          os.symlink(target, name)
+
+  def assertSameWalk(self, expected, actual):
+    self.assertEqual(
+        [(root, sorted(dirs), sorted(files)) for root, dirs, files in expected],
+        [(root, sorted(dirs), sorted(files)) for root, dirs, files in actual])
+
+  def testWalk(self):
+    cache = stat_cache.StatCache()
+    for topdown in (True, False):
+      self.assertSameWalk(sorted(os.walk(self.top, topdown=topdown)),
+                          sorted(cache.walk(self.top, topdown=topdown)))
+    if hasattr(os, "symlink"):
+      self.assertEqual(
+          [], list(cache.walk(os.path.join(self.top, "missing"))))
+
+  def testWalkPruned(self):
+    cache = stat_cache.StatCache()
+    roots = []
+    for root, dirs, _ in cache.walk(self.top):
+      roots.append(root)
+      if "a" in dirs:
+        dirs.remove("a")
+    self.assertNotIn(os.path.join(self.top, "a"), roots)
+    self.assertIn(os.path.join(self.top, "c"), roots)
+
+  def testStatIsCached(self):
+    cache = stat_cache.StatCache()
+    list(cache.walk(self.top))
+    path = os.path.join(self.top, "a", "b", "y")
+    expected = os.stat(path)
+    os.chmod(path, 0o700)
+    self.assertEqual(expected.st_mode, cache.stat(path).st_mode)
+    # Paths are not made absolute, which would depend on the cwd.
+    self.assertNotEqual(expected.st_mode,
+                        cache.stat(os.path.relpath(path)).st_mode)
+
+  def testIsExecutable(self):
+    cache = stat_cache.StatCache()
+    for path in ("f", "a/x", "a/b/y"):
+      path = os.path.join(self.top, path)
+      self.assertEqual(os.access(path, os.X_OK), cache.is_executable(path),
+                       path)
+
+  @unittest.skipIf(os.name == "nt", "Windows has no x bits")
+  def testIsExecutableChecksAccess(self):
+    cache = stat_cache.StatCache()
+    path = os.path.join(self.top, "a", "x")
+    with mock.patch.object(os, "access", return_value=False) as access:
+      # e.g. on a noexec mount.
+      self.assertFalse(cache.is_executable(path))
+      access.assert_called_once_with(path, os.X_OK)
+      # A file without x bits is not executable, whatever its ACLs.
+      self.assertFalse(cache.is_executable(os.path.join(self.top, "f")))
+      access.assert_called_once_with(path, os.X_OK)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,155 @@
+# Copyright 2026 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Testing for build_tar."""
+
+import json
+import os
+import tarfile
+import unittest
+
+from pkg.private.tar import build_tar
+
+
+class AttributeRulesTest(unittest.TestCase):
+
+  def setUp(self):
+    super(AttributeRulesTest, self).setUp()
+    self.rules = build_tar.AttributeRules(0o555, (0, 0), ("", ""))
+    self.rules.add("mode", {
+        "paths": {"/usr/bin/tool": "0700"},
+        "prefixes": {"usr/bin": "0755", "usr/bin/sub": "0711"},
+        "globs": [["*.sh", "0775"], ["usr/*", "0666"]],
+    })
+    self.rules.add("owner", {"prefixes": {"home/user": "1000.100"}})
+    self.rules.add("owner_name", {"globs": [["home/*", "user.users"]]})
+
+  def mode(self, path):
+    return self.rules.file_attributes(path)["mode"]
+
+  def testPrecedence(self):
+    self.assertEqual(0o700, self.mode("usr/bin/tool"))
+    self.assertEqual(0o755, self.mode("/usr/bin/other.sh"))
+    self.assertEqual(0o711, self.mode("usr/bin/sub/x"))
+    self.assertEqual(0o711, self.mode("usr/bin/sub"))
+    self.assertEqual(0o775, self.mode("usr/lib/x.sh"))
+    self.assertEqual(0o666, self.mode("usr/lib/x"))
+    self.assertEqual(0o555, self.mode("etc/x"))
+
+  def testRootPrefix(self):
+    self.rules.add("mode", {"prefixes": {"/": "0444"}})
+    self.assertEqual(0o444, self.mode("usr/lib/x.sh"))
+    self.assertEqual(0o755, self.mode("usr/bin/x"))
+
+  def testDefaults(self):
+    rules = build_tar.AttributeRules(0o555, (0, 0), ("", ""))
+    rules.add("mode", {"globs": [["*.sh", "0775"]]})
+    self.assertEqual(0o775, rules.file_attributes("a/b.sh")["mode"])
+    self.assertEqual({"mode": 0o555, "ids": (0, 0), "names": ("", "")},
+                     rules.file_attributes("a/b"))
+
+  def testAttributesAreIndependent(self):
+    self.assertEqual(
+        {"mode": 0o555, "ids": (1000, 100), "names": ("user", "users")},
+        self.rules.file_attributes("home/user/.profile"))
+    self.assertEqual(
+        {"mode": 0o555, "ids": (0, 0), "names": ("user", "users")},
+        self.rules.file_attributes("home/other"))
+
+  def testSharedAttributes(self):
+    self.assertIs(self.rules.file_attributes("home/user/a"),
+                  self.rules.file_attributes("home/user/b"))
+
+  def testLaterRulesOverride(self):
+    self.rules.add("mode", {"paths": {"usr/bin/tool": "0500"},
+                            "globs": [["*.sh", "0777"]]})
+    self.assertEqual(0o500, self.mode("usr/bin/tool"))
+    self.assertEqual(0o775, self.mode("x.sh"))
+
+  def testUnknownAttribute(self):
+    with self.assertRaises(ValueError):
+      self.rules.add("size", {})
+
+
+class BuildTarTest(unittest.TestCase):
+
+  def testAttributeRulesFile(self):
+    tmpdir = os.path.join(os.environ["TEST_TMPDIR"], self.id())
+    os.makedirs(tmpdir, exist_ok=True)
+    content = os.path.join(tmpdir, "content")
+    with open(content, "w") as f:
+      f.write("content")
+    manifest = os.path.join(tmpdir, "manifest.json")
+    with open(manifest, "w") as f:
+      json.dump([
+          {"type": "file", "dest": dest, "src": content, "mode": mode,
+           "user": None, "group": None}
+          for dest, mode in (("bin/a", ""), ("bin/b", ""), ("etc/c", ""),
+                             ("etc/d", "0600"))], f)
+    rules = os.path.join(tmpdir, "rules.json")
+    with open(rules, "w") as f:
+      json.dump({"mode": {"prefixes": {"bin": "0755"}},
+                 "owner": {"globs": [["etc/*", "1.2"]]}}, f)
+    output = os.path.join(tmpdir, "out.tar")
+    build_tar.main(["--output", output, "--manifest", manifest,
+                    "--directory", "", "--mode", "0644",
+                    "--attribute_rules", rules,
+                    "--modes", "bin/b=0700"])
+    with tarfile.open(output) as tar:
+      got = {m.name: (m.mode, m.uid, m.gid) for m in tar.getmembers()}
+    self.assertEqual({
+        "bin/a": (0o755, 0, 0),
+        "bin/b": (0o700, 0, 0),
+        "etc/c": (0o644, 1, 2),
+        "etc/d": (0o600, 1, 2),
+    }, got)
+
+  def testIncrementalStateIsALink(self):
+    tmpdir = os.path.join(os.environ["TEST_TMPDIR"], self.id())
+    os.makedirs(tmpdir, exist_ok=True)
+    content = os.path.join(tmpdir, "content")
+    with open(content, "w") as f:
+      f.write("content" * 1000)
+    manifest = os.path.join(tmpdir, "manifest.json")
+    with open(manifest, "w") as f:
+      json.dump([{"type": "file", "dest": "a", "src": content, "mode": "",
+                  "user": None, "group": None}], f)
+    incremental_dir = os.path.join(tmpdir, "incremental")
+
+    def build(output, *args):
+      build_tar.main(["--output", output, "--manifest", manifest,
+                      "--directory", "", "--mode", "0644"] + list(args))
+      with open(output, "rb") as f:
+        return f.read()
+
+    expected = build(os.path.join(tmpdir, "plain.tar"))
+    output = os.path.join(tmpdir, "out.tar")
+    for _ in range(2):
+      # The second build overwrites an output which the state links to.
+      self.assertEqual(
+          expected, build(output, "--incremental_dir", incremental_dir))
+      saved = [os.path.join(incremental_dir, name)
+               for name in os.listdir(incremental_dir)
+               if name.endswith(".tar")]
+      self.assertEqual(1, len(saved))
+      self.assertTrue(os.path.samefile(output, saved[0]))
+
+    # The saved tar counts once the output is gone.
+    os.remove(output)
+    build(os.path.join(tmpdir, "other.tar"),
+          "--incremental_dir", incremental_dir, "--incremental_max_mb", "0")
+    self.assertEqual([], os.listdir(incremental_dir))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -310,6 +310,19 @@ class PkgTarTest(unittest.TestCase):
       file_size = os.stat(file_path).st_size
       self.assertEqual(file_size, expected_size, 'size error for ' + file_name)
 
+  def test_compact_manifest(self):
+    # The same package, built with --@rules_pkg//pkg:manifest_format=compact.
+    contents = []
+    for file_name in ('test-tar-manifest-format.tar',
+                      'test-tar-manifest-format-compact.tar'):
+      file_path = runfiles.Create().Rlocation('rules_pkg/tests/tar/' + file_name)
+      with open(file_path, 'rb') as f:
+        contents.append(f.read())
+    self.assertEqual(contents[0], contents[1])
+    self.assertTarFileContent('test-tar-manifest-format-compact.tar', [
+        {'name': 'a_tree', 'halt': None},
+    ])
+
   def test_preserve_mode(self):
     if os.name == 'nt':
       expected_mode = [
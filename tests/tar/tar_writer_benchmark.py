@@ -0,0 +1,125 @@
+# Copyright 2026 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmarks for the member bookkeeping of TarFileWriter.
+
+testParentDirectories adds BENCHMARK_ENTRIES (default 500k) files at
+BENCHMARK_DEPTH (default 20) to a writer with create_parents, without
+writing the tar itself, and prints how long the parent directory checks
+take compared to the previous dict based implementation.
+
+testMemberIndexPeakRss records BENCHMARK_MEMBERS (default 1M) paths in the
+member index and in a dict, each in a child process, and prints the peak
+RSS of both.
+
+  bazel test //tests/tar:tar_writer_benchmark --test_output=streamed
+"""
+
+import os
+import subprocess
+import sys
+import tarfile
+import time
+import unittest
+
+from pkg.private.tar import tar_writer
+
+
+def synthetic_tree(entries, depth):
+  """Yields sorted paths of a tree with 50 files per leaf directory."""
+  for i in range(entries):
+    leaf = i // 50
+    dirs = []
+    for _ in range(depth - 1):
+      dirs.append("d%d" % (leaf % 3))
+      leaf //= 3
+    yield "/".join(reversed(dirs)) + "/f%d" % i
+
+
+# Records the paths of a synthetic node_modules like tree in a dict, as
+# TarFileWriter used to, or in its member index, and prints the peak RSS.
+_PEAK_RSS_SCRIPT = """
+import resource, sys
+from pkg.private.tar import tar_writer
+from tests.tar import tar_writer_benchmark
+
+members = {} if sys.argv[1] == "dict" else tar_writer._MemberIndex()
+for path in tar_writer_benchmark.synthetic_tree(int(sys.argv[2]), 8):
+  members[path] = b"0"
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+class _BookkeepingOnlyWriter(tar_writer.TarFileWriter):
+  """Records members without writing them."""
+
+  def _addfile(self, info, fileobj=None, digest=None):
+    if info.type == tarfile.DIRTYPE and not info.name.endswith("/"):
+      info.name += "/"
+    self.existing_members[info.name.rstrip("/")] = info.type
+
+
+class _DictWriter(_BookkeepingOnlyWriter):
+  """The previous implementation, which rebuilds and probes every prefix."""
+
+  def __init__(self, *args, **kwargs):
+    super(_DictWriter, self).__init__(*args, **kwargs)
+    self.existing_members = {}
+
+  def conditionally_add_parents(self, path, uid=0, gid=0, uname="", gname="",
+                                mtime=0, mode=0o755):
+    dirs = path.split("/")
+    parent_path = ""
+    for next_level in dirs[0:-1]:
+      parent_path = parent_path + next_level + "/"
+      if self.create_parents and self._existing_member_type(
+          parent_path) is None:
+        self.add_directory_path(parent_path, uid=uid, gid=gid, uname=uname,
+                                gname=gname, mtime=mtime, mode=0o755)
+
+
+class TarWriterBenchmark(unittest.TestCase):
+
+  def testParentDirectories(self):
+    entries = int(os.environ.get("BENCHMARK_ENTRIES", 500000))
+    depth = int(os.environ.get("BENCHMARK_DEPTH", 20))
+    output = os.path.join(os.environ["TEST_TMPDIR"], "benchmark.tar")
+    paths = list(synthetic_tree(entries, depth))
+    members = []
+    for writer_class in (_DictWriter, _BookkeepingOnlyWriter):
+      with writer_class(output, create_parents=True) as writer:
+        start = time.time()
+        for path in paths:
+          writer.conditionally_add_parents(path)
+          writer.existing_members[path] = tarfile.REGTYPE
+        elapsed = time.time() - start
+      print("%s: %d entries at depth %d, %.2fs" % (
+          writer_class.__name__, entries, depth, elapsed))
+      members.append(sorted(writer.existing_members.keys()))
+    self.assertEqual(members[0], members[1])
+
+  def testMemberIndexPeakRss(self):
+    members = int(os.environ.get("BENCHMARK_MEMBERS", 1000000))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    peaks = {}
+    for kind in ("dict", "index"):
+      peak = subprocess.check_output(
+          [sys.executable, "-c", _PEAK_RSS_SCRIPT, kind, str(members)],
+          env=env)
+      peaks[kind] = int(peak) / 1024
+      print("%s: %d members, peak RSS %.1f MiB" % (kind, members, peaks[kind]))
+    self.assertLess(peaks["index"], peaks["dict"])
+
+
+if __name__ == "__main__":
+  unittest.main()
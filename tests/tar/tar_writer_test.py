@@ -13,9 +13,17 @@
 # limitations under the License.
 """Testing for tar_writer."""
 
+import gzip
+import hashlib
+import io
 import os
+import random
+import re
+import shutil
+import subprocess
 import tarfile
 import unittest
+from unittest import mock
 
 from python.runfiles import runfiles
 from pkg.private.tar import tar_writer
@@ -261,6 +269,22 @@ class TarFileWriterTest(unittest.TestCase):
     self.assertTarFileContent(original, expected_content)
     self.assertTarFileContent(self.tempfile, expected_content)
 
+  @unittest.skipUnless(shutil.which("gzip"), "gzip is not on the PATH")
+  def testCompressorWritesToFileObjectWithoutDescriptor(self):
+    outfile = io.BytesIO()
+    outfile.write(b"header")
+    with tar_writer.TarFileWriter(self.tempfile, compressor="gzip -n",
+                                  outfile=outfile) as f:
+      f.add_file("./a", content="a" * 100000)
+    self.assertEqual(outfile.tell(), len(outfile.getvalue()))
+    data = outfile.getvalue()
+    self.assertEqual(data[:6], b"header")
+    with open(self.tempfile, "wb") as f:
+      f.write(gzip.decompress(data[6:]))
+    self.assertTarFileContent(self.tempfile, [
+        {"name": "./a", "data": b"a" * 100000},
+    ])
+
   def testAdditionOfDuplicatePath(self):
     expected_content = [
         {"name": "./" + x} for x in ["a", "b", "ab"]] + [
@@ -326,6 +350,268 @@ class TarFileWriterTest(unittest.TestCase):
     ]
     self.assertTarFileContent(self.tempfile, content)
 
+  def testParallelGzipCompression(self):
+    datafile = os.path.join(os.environ["TEST_TMPDIR"], "random.bin")
+    data = os.urandom(200000) + b"a" * 300000
+    with open(datafile, "wb") as f:
+      f.write(data)
+    content = [
+        {"name": "./a", "data": data},
+        {"name": "./b", "data": b"b"},
+    ]
+    outputs = []
+    for threads in (2, 5):
+      with tar_writer.TarFileWriter(
+          self.tempfile, "gz", compression_threads=threads) as f:
+        f.add_file("./a", file_content=datafile)
+        f.add_file("./b", content="b")
+      self.assertTarFileContent(self.tempfile, content)
+      with open(self.tempfile, "rb") as f:
+        outputs.append(f.read())
+    # Output does not depend on the number of threads.
+    self.assertEqual(outputs[0], outputs[1])
+
+  @unittest.skipUnless(tar_writer.HAS_LZMA, "lzma is not available")
+  def testParallelXzCompression(self):
+    datafile = os.path.join(os.environ["TEST_TMPDIR"], "random.bin")
+    data = os.urandom(1000000) + b"a" * 1000000
+    with open(datafile, "wb") as f:
+      f.write(data)
+    content = [
+        {"name": "./a", "data": data},
+        {"name": "./b", "data": b"b"},
+    ]
+    outputs = []
+    for threads in (2, 5):
+      # Preset 0 uses 768 KiB blocks, so this spans several blocks.
+      with tar_writer.TarFileWriter(
+          self.tempfile, "xz", compression_level=0,
+          compression_threads=threads) as f:
+        f.add_file("./a", file_content=datafile)
+        f.add_file("./b", content="b")
+      self.assertTarFileContent(self.tempfile, content)
+      with open(self.tempfile, "rb") as f:
+        outputs.append(f.read())
+    self.assertEqual(outputs[0], outputs[1])
+
+  @unittest.skipUnless(tar_writer.HAS_LZMA, "lzma is not available")
+  def testParallelCompressionBoundsPendingBlocks(self):
+    # Small gzip blocks queue up to one more block per thread, large xz
+    # blocks only one in total.
+    f = tar_writer.ParallelGzipFile(self.tempfile, threads=4)
+    self.assertEqual(8, f._max_pending)
+    f.close()
+    f = tar_writer.ParallelXzFile(self.tempfile, preset=6, threads=4)
+    self.assertEqual(5, f._max_pending)
+    f.close()
+
+  def testMemberIndexMatchesDict(self):
+    rng = random.Random(12)
+    components = ["a", "b", "\u00e9", "", ".", "node_modules"]
+    paths = ["/".join(rng.choice(components)
+                      for _ in range(rng.randint(1, 4)))
+             for _ in range(3000)]
+    types = [tarfile.REGTYPE, tarfile.DIRTYPE, tarfile.SYMTYPE]
+    for dict_size in (1 << 16, 100):
+      expected = {}
+      index = tar_writer._MemberIndex()
+      saved_dict_size = tar_writer._MEMBER_INDEX_DICT_SIZE
+      tar_writer._MEMBER_INDEX_DICT_SIZE = dict_size
+      try:
+        for path in paths:
+          member_type = rng.choice(types)
+          expected[path] = member_type
+          index[path] = member_type
+          probe = rng.choice(paths) + rng.choice(["", "x"])
+          self.assertEqual(expected.get(probe), index.get(probe), probe)
+      finally:
+        tar_writer._MEMBER_INDEX_DICT_SIZE = saved_dict_size
+      self.assertEqual(len(expected), len(index))
+      self.assertEqual(list(expected), list(index.keys()))
+
+  def testCreateParentsOfManyMembers(self):
+    paths = ["d%d/e%d/f%d" % (i // 100, i // 10, i) for i in range(2000)]
+    saved_dict_size = tar_writer._MEMBER_INDEX_DICT_SIZE
+    tar_writer._MEMBER_INDEX_DICT_SIZE = 500
+    try:
+      with tar_writer.TarFileWriter(self.tempfile, create_parents=True) as f:
+        for path in paths:
+          f.add_file(path, content="")
+        f.add_file("d0/e0/g", content="")
+        f.add_file("x/y/z", content="")
+    finally:
+      tar_writer._MEMBER_INDEX_DICT_SIZE = saved_dict_size
+    with tarfile.open(self.tempfile) as tar:
+      names = tar.getnames()
+    self.assertEqual(2000 + 20 + 200 + 1 + 3, len(names))
+    self.assertEqual(len(names), len(set(names)))
+    self.assertEqual(["d0", "d0/e0", "d0/e0/f0"], names[:3])
+
+  def testZeroCopyFileContent(self):
+    datafile = os.path.join(os.environ["TEST_TMPDIR"], "zero_copy.bin")
+    with open(datafile, "wb") as f:
+      f.write(os.urandom(3 * 4096 + 100))
+    outputs = []
+    for raw_output in (True, False):
+      with tar_writer.TarFileWriter(self.tempfile) as f:
+        self.assertTrue(f.raw_output)
+        f.raw_output = raw_output
+        f.add_file("./a", content="a")
+        f.add_file("./big", file_content=datafile)
+        f.add_file("./empty", file_content=os.devnull)
+      with open(self.tempfile, "rb") as f:
+        outputs.append(f.read())
+    self.assertEqual(outputs[0], outputs[1])
+    with open(datafile, "rb") as f:
+      self.assertTarFileContent(self.tempfile, [
+          {"name": "./a", "data": b"a"},
+          {"name": "./big", "data": f.read()},
+          {"name": "./empty", "size": 0},
+      ])
+
+  def testMergeTarPassthrough(self):
+    tmpdir = os.environ["TEST_TMPDIR"]
+    intar = os.path.join(tmpdir, "passthrough.tar")
+    datafile = os.path.join(tmpdir, "passthrough.bin")
+    with open(datafile, "wb") as f:
+      f.write(os.urandom(3 * 4096 + 100))
+    with tar_writer.TarFileWriter(intar, default_mtime=1234) as f:
+      f.add_file("./a", content="a", uid=1000, uname="user")
+      f.add_file("./big", file_content=datafile)
+      f.add_file("./" + "long/" * 30 + "name", content="long name")
+      f.add_file("./link", tarfile.SYMTYPE, link="big")
+
+    def merge(raw_output, **kwargs):
+      with tar_writer.TarFileWriter(self.tempfile) as f:
+        f.raw_output = raw_output
+        f.add_tar(intar, **kwargs)
+      with open(self.tempfile, "rb") as out:
+        return out.read(), f.passthrough_members
+
+    for kwargs, passthrough in (({}, 3),
+                                ({"rootuid": 1000}, 2),
+                                ({"numeric": True}, 2),
+                                ({"prefix": "foo"}, 0)):
+      expected, _ = merge(False, **kwargs)
+      actual, passthrough_members = merge(True, **kwargs)
+      self.assertEqual(expected, actual, kwargs)
+      self.assertEqual(passthrough, passthrough_members, kwargs)
+
+  def testMemberDigests(self):
+    tmpdir = os.environ["TEST_TMPDIR"]
+    datafile = os.path.join(tmpdir, "digested.bin")
+    content = os.urandom(3 * 4096 + 100)
+    with open(datafile, "wb") as f:
+      f.write(content)
+    intar = os.path.join(tmpdir, "digested.tar")
+    with tar_writer.TarFileWriter(intar) as f:
+      f.add_file("./merged", content="merged")
+    digests_file = os.path.join(tmpdir, "digests.txt")
+    with tar_writer.TarFileWriter(self.tempfile, "gz", create_parents=True,
+                                  member_digests=digests_file) as f:
+      f.add_file("dir/big", file_content=datafile)
+      f.add_file("empty")
+      f.add_file("link", tarfile.SYMTYPE, link="dir/big")
+      f.add_file("./with space", content="a")
+      f.add_tar(intar)
+
+    def line(data, name):
+      return "%s %s %s\n" % (hashlib.md5(data).hexdigest(),
+                             hashlib.sha256(data).hexdigest(), name)
+
+    with open(digests_file, "r") as f:
+      self.assertEqual(
+          line(content, "dir/big") + line(b"", "empty") +
+          line(b"a", "./with space") + line(b"merged", "./merged"),
+          f.read())
+    with self.assertRaises(tar_writer.TarFileWriter.Error):
+      tar_writer.TarFileWriter(self.tempfile, index=self.tempfile + ".index",
+                               member_digests=digests_file)
+
+  def testIncrementalRebuild(self):
+    tmpdir = os.environ["TEST_TMPDIR"]
+    datafiles = []
+    for i in range(3):
+      datafiles.append(os.path.join(tmpdir, "incremental%d.bin" % i))
+      with open(datafiles[-1], "wb") as f:
+        f.write(os.urandom(1000 * i))
+
+    def build(output, **kwargs):
+      with tar_writer.TarFileWriter(output, create_parents=True,
+                                    **kwargs) as f:
+        for i, datafile in enumerate(datafiles):
+          f.add_file("./dir/%d" % i, file_content=datafile)
+        f.add_file("./a" * 60, content="long name")
+        f.add_file("./link", tarfile.SYMTYPE, link="dir/0")
+      with open(output, "rb") as out:
+        return out.read(), f.reused_members
+
+    previous = self.tempfile + ".previous"
+    previous_index = previous + ".index"
+    build(previous, index=previous_index)
+    with open(datafiles[1], "wb") as f:
+      f.write(b"changed")
+
+    expected, _ = build(self.tempfile)
+    actual, reused = build(self.tempfile, index=self.tempfile + ".index",
+                           previous=previous, previous_index=previous_index)
+    self.assertEqual(expected, actual)
+    # dir/0, dir/2 and the long name are copied, dir/1 changed.
+    self.assertEqual(3, reused)
+
+    # A stale index is ignored.
+    with open(previous, "ab") as f:
+      f.write(b"\0" * 512)
+    actual, reused = build(self.tempfile, previous=previous,
+                           previous_index=previous_index)
+    self.assertEqual(expected, actual)
+    self.assertEqual(0, reused)
+
+  @unittest.skipUnless(tar_writer.HAS_ZSTD, "zstandard is not available")
+  def testZstdCompression(self):
+    zstd_file = self.tempfile + ".zst"
+    with tar_writer.TarFileWriter(zstd_file, "zst", compression_level=19) as f:
+      f.add_file("./a", content="a" * 1000)
+    with open(zstd_file, "rb") as f_in, open(self.tempfile, "wb") as f_out:
+      tar_writer.zstandard.ZstdDecompressor().copy_stream(f_in, f_out)
+    os.remove(zstd_file)
+    self.assertTarFileContent(self.tempfile, [
+        {"name": "./a", "data": b"a" * 1000},
+    ])
+
+  def testZstdNeedsTheModuleOrATool(self):
+    with mock.patch.object(tar_writer, "HAS_ZSTD", False):
+      with self.assertRaises(tar_writer.TarFileWriter.Error):
+        tar_writer.TarFileWriter(self.tempfile, "zst")
+    self.assertFalse(os.path.exists(self.tempfile))
+
+  @unittest.skipUnless(tar_writer.HAS_ZSTD, "zstandard is not available")
+  def testZstdModuleAndToolWriteTheSameBytes(self):
+    zstd_tool = shutil.which("zstd")
+    if not zstd_tool:
+      self.skipTest("zstd is not on the PATH")
+    version = re.search(r"v(\d+)\.(\d+)\.(\d+)", subprocess.run(
+        [zstd_tool, "-V"], stdout=subprocess.PIPE, text=True, check=True).stdout)
+    if tuple(int(v) for v in version.groups()) != (
+        tar_writer.zstandard.ZSTD_VERSION):
+      # Releases of zstd are free to change the compressed output.
+      self.skipTest("the zstd tool and module use different zstd versions")
+    content = "".join("line %d %s\n" % (i, "x" * (i % 50))
+                      for i in range(20000)) + os.urandom(5000).hex()
+    for level in (1, 19):
+      for threads in (1, 4):
+        outputs = []
+        for zstd_path in (None, zstd_tool):
+          output = "%s.%d.%d.zst" % (self.tempfile, level, threads)
+          with tar_writer.TarFileWriter(
+              output, "zst", compression_level=level,
+              compression_threads=threads, zstd_path=zstd_path) as f:
+            f.add_file("./a", content=content)
+          with open(output, "rb") as f:
+            outputs.append(f.read())
+          os.remove(output)
+        self.assertEqual(outputs[0], outputs[1], (level, threads))
+
 
 if __name__ == "__main__":
   unittest.main()
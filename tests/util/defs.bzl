@@ -186,6 +186,42 @@ def write_content_manifest(name, srcs, **kwargs):
         **kwargs
     )
 
+_MANIFEST_FORMAT = str(Label("//pkg:manifest_format"))
+
+def _manifest_format_transition_impl(_settings, attr):
+    return {_MANIFEST_FORMAT: attr.manifest_format}
+
+_manifest_format_transition = transition(
+    implementation = _manifest_format_transition_impl,
+    inputs = [],
+    outputs = [_MANIFEST_FORMAT],
+)
+
+def _with_manifest_format_impl(ctx):
+    ctx.actions.symlink(output = ctx.outputs.out, target_file = ctx.files.target[0])
+    return DefaultInfo(files = depset([ctx.outputs.out]))
+
+with_manifest_format = rule(
+    doc = """Helper rule to build a package with another manifest format.
+
+The package built by `target` with --@rules_pkg//pkg:manifest_format set to
+`manifest_format` is made available as `out`, so that it can be compared
+with the same package built with the default format.""",
+    implementation = _with_manifest_format_impl,
+    attrs = {
+        "target": attr.label(
+            doc = "Packaging rule whose single output to build.",
+            mandatory = True,
+            cfg = _manifest_format_transition,
+        ),
+        "manifest_format": attr.string(mandatory = True),
+        "out": attr.output(mandatory = True),
+        "_allowlist_function_transition": attr.label(
+            default = "@bazel_tools//tools/allowlists/function_transition_allowlist",
+        ),
+    },
+)
+
 ############################################################
 # Test boilerplate
 ############################################################
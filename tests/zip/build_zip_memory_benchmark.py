@@ -0,0 +1,74 @@
+# Copyright 2026 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Peak memory benchmark for build_zip on a multi-GB input.
+
+build_zip streams file contents, so its peak RSS must not grow with the size
+of the files it packages. This writes a sparse file of BENCHMARK_SIZE_MB
+(default 3 GiB), zips it in a child process and checks the child's peak RSS.
+
+  bazel test //tests/zip:build_zip_memory_benchmark --test_output=streamed
+"""
+
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import unittest
+
+# Generous bound for the interpreter, zlib and the copy buffers.
+_MAX_RSS_MB = 256
+
+
+class BuildZipMemoryBenchmark(unittest.TestCase):
+
+  def testPeakRssIsIndependentOfFileSize(self):
+    tmpdir = os.environ["TEST_TMPDIR"]
+    size_mb = int(os.environ.get("BENCHMARK_SIZE_MB", 3 * 1024))
+    big_file = os.path.join(tmpdir, "big.bin")
+    with open(big_file, "wb") as f:
+      f.truncate(size_mb * 1024 * 1024)
+    manifest_path = os.path.join(tmpdir, "manifest.json")
+    with open(manifest_path, "w") as f:
+      json.dump([{
+          "type": "file",
+          "dest": "big.bin",
+          "src": big_file,
+          "mode": "0o644",
+          "user": None,
+          "group": None,
+      }], f)
+
+    start = time.time()
+    subprocess.check_call([
+        sys.executable, "-c",
+        "import sys; from pkg.private.zip import build_zip;"
+        " sys.exit(build_zip._main_from_argv(sys.argv[1:]))",
+        "--output", os.path.join(tmpdir, "big.zip"),
+        "--manifest", manifest_path,
+        "--compression_type", "deflated",
+        "--compression_level", "6",
+    ], env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+    elapsed = time.time() - start
+
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    peak_mb = peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+    print("build_zip: %d MiB input, %.1fs, peak RSS %.1f MiB"
+          % (size_mb, elapsed, peak_mb))
+    self.assertLess(peak_mb, _MAX_RSS_MB)
+
+
+if __name__ == "__main__":
+  unittest.main()
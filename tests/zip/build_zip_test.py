@@ -0,0 +1,183 @@
+# Copyright 2026 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Testing for the ZipWriter in build_zip."""
+
+import gc
+import os
+import time
+import unittest
+import warnings
+import zipfile
+
+from pkg.private import manifest
+from pkg.private.zip import build_zip
+
+
+class ZipWriterTest(unittest.TestCase):
+  """Testing for the compressed content cache and parallel compression."""
+
+  def setUp(self):
+    super(ZipWriterTest, self).setUp()
+    self.tmpdir = os.environ["TEST_TMPDIR"]
+    self.cache_dir = os.path.join(self.tmpdir, self.id(), "cache")
+    self.files = []
+    for i in range(3):
+      path = os.path.join(self.tmpdir, "%s-%d.txt" % (self.id(), i))
+      with open(path, "wb") as f:
+        f.write(b"content %d " % i * (1000 * (i + 1)))
+      self.files.append(path)
+
+  def build_zip(self, name, compression_type, cache=None, jobs=1):
+    out = os.path.join(self.tmpdir, "%s-%s.zip" % (self.id(), name))
+    with build_zip.ZipWriter(
+        out, time_stamp=(1980, 1, 1, 0, 0, 0), default_mode=0o644,
+        compression_type=compression_type, compression_level=6,
+        cache=cache, jobs=jobs) as zip_out:
+      for i, path in enumerate(self.files):
+        zip_out.add_manifest_entry(manifest.ManifestEntry(
+            manifest.ENTRY_IS_FILE, "dir/file%d" % i, path, None, None, None))
+        zip_out.add_manifest_entry(manifest.ManifestEntry(
+            manifest.ENTRY_IS_DIR, "dir%d" % i, None, None, None, None))
+    with open(out, "rb") as f:
+      return f.read()
+
+  def testCachedOutputIsIdentical(self):
+    for compression_type in ("deflated", "bzip2", "lzma", "stored"):
+      expected = self.build_zip("plain", compression_type)
+      cache = build_zip.CompressionCache(self.cache_dir, 1 << 20)
+      cold = self.build_zip("cold", compression_type, cache=cache)
+      warm = self.build_zip("warm", compression_type, cache=cache)
+      self.assertEqual(expected, cold, compression_type)
+      self.assertEqual(expected, warm, compression_type)
+      out = os.path.join(self.tmpdir, "%s-warm.zip" % self.id())
+      with zipfile.ZipFile(out) as zf:
+        self.assertIsNone(zf.testzip())
+
+  def testCorruptEntryIsIgnored(self):
+    cache = build_zip.CompressionCache(self.cache_dir, 1 << 20)
+    expected = self.build_zip("cold", "deflated", cache=cache)
+    for name in os.listdir(self.cache_dir):
+      with open(os.path.join(self.cache_dir, name), "wb") as f:
+        f.write(b"garbage")
+    self.assertEqual(expected,
+                     self.build_zip("warm", "deflated", cache=cache))
+
+  def testDamagedEntryIsIgnored(self):
+    cache = build_zip.CompressionCache(self.cache_dir, 1 << 20)
+    expected = self.build_zip("cold", "deflated", cache=cache)
+    for name in os.listdir(self.cache_dir):
+      # Keep the header, truncate the compressed stream.
+      path = os.path.join(self.cache_dir, name)
+      os.truncate(path, os.path.getsize(path) - 1)
+    self.assertEqual(expected,
+                     self.build_zip("warm", "deflated", cache=cache))
+
+  def testPutReturnsTheEntry(self):
+    cache = build_zip.CompressionCache(self.cache_dir, 1 << 20)
+
+    def compress(out):
+      out.write(b"compressed")
+      return 1234, 5678
+
+    f, crc, file_size, compress_size = cache.put(
+        "digest", zipfile.ZIP_DEFLATED, 6, compress)
+    with f:
+      self.assertEqual(b"compressed", f.read())
+    self.assertEqual((1234, 5678, 10), (crc, file_size, compress_size))
+    f, crc, file_size, compress_size = cache.get(
+        "digest", zipfile.ZIP_DEFLATED, 6)
+    with f:
+      self.assertEqual(b"compressed", f.read())
+    self.assertEqual((1234, 5678, 10), (crc, file_size, compress_size))
+
+  def testFailedPutLeavesNoTemporaryFile(self):
+    cache = build_zip.CompressionCache(self.cache_dir, 1 << 20)
+
+    def fail(out):
+      out.write(b"partial")
+      raise ValueError("compression failed")
+
+    with self.assertRaises(ValueError):
+      cache.put("digest", zipfile.ZIP_DEFLATED, 6, fail)
+    self.assertEqual([], os.listdir(self.cache_dir))
+
+  def testStaleTemporaryFilesAreEvicted(self):
+    cache = build_zip.CompressionCache(self.cache_dir, 1 << 20)
+    stale = os.path.join(self.cache_dir, "stale.tmp")
+    recent = os.path.join(self.cache_dir, "recent.tmp")
+    for path in (stale, recent):
+      with open(path, "wb") as f:
+        f.write(b"partial")
+    old = time.time() - 2 * build_zip._STALE_TMP_SECONDS
+    os.utime(stale, (old, old))
+    cache.close()
+    self.assertEqual(["recent.tmp"], os.listdir(self.cache_dir))
+
+  def testOutputWithoutSplicing(self):
+    expected = self.build_zip("splice", "deflated", jobs=3,
+                              cache=build_zip.CompressionCache(
+                                  self.cache_dir, 1 << 20))
+    can_splice = build_zip._CAN_SPLICE
+    build_zip._CAN_SPLICE = False
+    try:
+      self.assertEqual(expected, self.build_zip(
+          "no_splice", "deflated", jobs=3,
+          cache=build_zip.CompressionCache(self.cache_dir, 1 << 20)))
+    finally:
+      build_zip._CAN_SPLICE = can_splice
+
+  def testParallelOutputIsIdentical(self):
+    for compression_type in ("deflated", "bzip2", "lzma", "stored"):
+      expected = self.build_zip("serial", compression_type)
+      for jobs in (2, 5):
+        self.assertEqual(
+            expected, self.build_zip("parallel", compression_type, jobs=jobs),
+            compression_type)
+      cache = build_zip.CompressionCache(self.cache_dir, 1 << 20)
+      for _ in range(2):
+        self.assertEqual(
+            expected,
+            self.build_zip("cached", compression_type, cache=cache, jobs=3),
+            compression_type)
+
+  def testEviction(self):
+    cache = build_zip.CompressionCache(self.cache_dir, 1)
+    self.build_zip("cold", "stored", cache=cache)
+    self.assertEqual([], os.listdir(self.cache_dir))
+
+  def testFailedJobStillClosesZipAndCache(self):
+    cache = build_zip.CompressionCache(self.cache_dir, 1)
+    self.files.insert(1, os.path.join(self.tmpdir, "missing"))
+    out = os.path.join(self.tmpdir, "%s-failed.zip" % self.id())
+    zip_out = build_zip.ZipWriter(
+        out, time_stamp=(1980, 1, 1, 0, 0, 0), default_mode=0o644,
+        compression_type="deflated", compression_level=6, cache=cache, jobs=2)
+    with warnings.catch_warnings(record=True) as caught:
+      warnings.simplefilter("always", ResourceWarning)
+      with self.assertRaises(FileNotFoundError):
+        with zip_out:
+          for i, path in enumerate(self.files):
+            zip_out.add_manifest_entry(manifest.ManifestEntry(
+                manifest.ENTRY_IS_FILE, "file%d" % i, path, None, None, None))
+      gc.collect()
+    # The files prepared for the writes after the failed one were closed.
+    self.assertEqual(
+        [], [w for w in caught if issubclass(w.category, ResourceWarning)])
+    self.assertIsNone(zip_out.zip_file)
+    # The cache was trimmed to its size.
+    self.assertEqual([], os.listdir(self.cache_dir))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,58 @@
+# Copyright 2026 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""toolchain to provide a zstd binary.
+
+pkg_tar compresses `.tar.zst` output with the Python zstandard module when
+it is available. Registering a zstd toolchain makes it use that binary
+instead, which keeps the output independent of the Python environment.
+"""
+
+ZstdInfo = provider(
+    doc = """Information needed to invoke zstd.""",
+    fields = {
+        "name": "The name of the toolchain",
+        "valid": "Is this toolchain valid and usable?",
+        "label": "Label of a target providing a zstd binary",
+        "path": "The path to a pre-built zstd",
+    },
+)
+
+def _zstd_toolchain_impl(ctx):
+    if ctx.attr.label and ctx.attr.path:
+        fail("zstd_toolchain must not specify both label and path.")
+    valid = bool(ctx.attr.label) or bool(ctx.attr.path)
+    toolchain_info = platform_common.ToolchainInfo(
+        zstd = ZstdInfo(
+            name = str(ctx.label),
+            valid = valid,
+            label = ctx.attr.label,
+            path = ctx.attr.path,
+        ),
+    )
+    return [toolchain_info]
+
+zstd_toolchain = rule(
+    implementation = _zstd_toolchain_impl,
+    attrs = {
+        "label": attr.label(
+            doc = "A valid label of a target to build or a prebuilt binary. Mutually exclusive with path.",
+            cfg = "exec",
+            executable = True,
+            allow_files = True,
+        ),
+        "path": attr.string(
+            doc = "The path to the zstd executable. Mutually exclusive with label.",
+        ),
+    },
+)